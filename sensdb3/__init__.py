@@ -0,0 +1 @@
+default_app_config = 'sensdb3.apps.Sensdb3Config'
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Align several time series (e.g. Formula's c1..c4 and f1) by timestamp.
+
+Series are lists of dicts with 'timestamp', 'value' and 'valid' keys in
+timestamp order (like get_unit_data() returns). Points with value None are
+ignored and if a timestamp exists more than once, the last point is used.
+
+Alignment methods (Formula.alignment):
+
+inner
+    Timestamps present in all series.
+outer
+    Timestamps present in any series, missing values are None (NaN).
+asof
+    Timestamps of the longest series, other series' nearest point within
+    tolerance.
+interpolate
+    Timestamps present in any series, other series' values are linearly
+    interpolated between their neighbouring points, if these are at most
+    tolerance apart.
+
+Rows, which miss a value of some series, are dropped except in outer
+alignment. Tolerance None means no limit.
+
+align() walks all series once in pure Python, align_arrays() does the same
+with NumPy and returns arrays.
+"""
+import datetime
+import heapq
+import itertools
+from collections import OrderedDict
+
+import pytz
+
+try:
+    import numpy as np
+except ImportError:  # align() works without NumPy
+    np = None
+
+ALIGNMENTS = ('inner', 'outer', 'asof', 'interpolate')
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def _clean(datalist):
+    """Return timestamps, values and valids of points with a value."""
+    timestamps, values, valids = [], [], []
+    for d in datalist:
+        if d['value'] is None:
+            continue
+        if timestamps and timestamps[-1] == d['timestamp']:
+            values[-1] = d['value']
+            valids[-1] = d['valid']
+        else:
+            timestamps.append(d['timestamp'])
+            values.append(d['value'])
+            valids.append(d['valid'])
+    return timestamps, values, valids
+
+
+def _walk(reference, series, how, tolerance):
+    """Return series' values and valids at reference timestamps."""
+    timestamps, values, valids = series
+    n = len(timestamps)
+    out_values, out_valids = [], []
+    j = -1  # Index of the last point at or before t
+    for t in reference:
+        while j + 1 < n and timestamps[j + 1] <= t:
+            j += 1
+        value, valid = None, True
+        if j >= 0 and timestamps[j] == t:
+            value, valid = values[j], valids[j]
+        elif how == 'asof':
+            nearest = None
+            if j >= 0:
+                nearest = j
+            if j + 1 < n and (nearest is None or
+                              timestamps[j + 1] - t < t - timestamps[j]):
+                nearest = j + 1
+            if nearest is not None and (
+                    tolerance is None or
+                    abs(timestamps[nearest] - t) <= tolerance):
+                value, valid = values[nearest], valids[nearest]
+        elif how == 'interpolate' and j >= 0 and j + 1 < n:
+            span = timestamps[j + 1] - timestamps[j]
+            if tolerance is None or span <= tolerance:
+                fraction = ((t - timestamps[j]).total_seconds() /
+                            span.total_seconds())
+                value = values[j] + (values[j + 1] - values[j]) * fraction
+                valid = valids[j] and valids[j + 1]
+        out_values.append(value)
+        out_valids.append(valid)
+    return out_values, out_valids
+
+
+def align(datalists, how='inner', tolerance=None):
+    """
+    Align series by timestamp in one pass.
+    :param datalists: OrderedDict of key -> list of data dicts
+    :param how: one of ALIGNMENTS
+    :param tolerance: timedelta or None
+    :return: (timestamps, OrderedDict of key -> list of values, valids),
+             values are None where missing
+    """
+    if how not in ALIGNMENTS:
+        raise ValueError('Unknown alignment "%s"' % how)
+    series = OrderedDict((key, _clean(datalist))
+                         for key, datalist in datalists.items())
+    if not series:
+        return [], OrderedDict(), []
+    if how == 'asof':
+        reference = max(series.values(), key=lambda s: len(s[0]))[0]
+    else:
+        merged = heapq.merge(*[s[0] for s in series.values()])
+        reference = [t for t, _ in itertools.groupby(merged)]
+    columns = OrderedDict()
+    valids = [True] * len(reference)
+    for key, s in series.items():
+        columns[key], column_valids = _walk(reference, s, how, tolerance)
+        valids = [a and b for a, b in zip(valids, column_valids)]
+    if how == 'outer':
+        return list(reference), columns, valids
+    keep = [i for i in range(len(reference))
+            if all(column[i] is not None for column in columns.values())]
+    return ([reference[i] for i in keep],
+            OrderedDict((key, [column[i] for i in keep])
+                        for key, column in columns.items()),
+            [valids[i] for i in keep])
+
+
+def timestamp_keys(timestamps):
+    """Convert timezone aware datetimes to an int64 array of epoch µs."""
+    # Plain integer arithmetic is much faster than datetime64 conversion
+    deltas = (ts - EPOCH for ts in timestamps)
+    return np.fromiter(
+        ((d.days * 86400 + d.seconds) * 1000000 + d.microseconds
+         for d in deltas),
+        dtype=np.int64, count=len(timestamps))
+
+
+def values_array(datalist):
+    """Return values of data dicts as a float array, None becomes NaN."""
+    return np.array([d['value'] for d in datalist], dtype=float)
+
+
+def _valids_array(datalist):
+    return np.array([bool(d['valid']) for d in datalist], dtype=bool)
+
+
+def _clean_arrays(datalist):
+    """NumPy version of _clean()."""
+    timestamps = np.empty(len(datalist), dtype=object)
+    timestamps[:] = [d['timestamp'] for d in datalist]
+    keys = timestamp_keys(timestamps)
+    values = values_array(datalist)
+    valids = _valids_array(datalist)
+    keep = ~np.isnan(values)
+    timestamps, keys = timestamps[keep], keys[keep]
+    values, valids = values[keep], valids[keep]
+    last = np.ones(len(keys), dtype=bool)
+    last[:-1] = keys[:-1] != keys[1:]
+    return timestamps[last], keys[last], values[last], valids[last]
+
+
+def _walk_arrays(reference, series, how, tolerance):
+    """NumPy version of _walk(), tolerance is in µs."""
+    timestamps, keys, values, valids = series
+    n = len(keys)
+    if n == 0:
+        return (np.full(len(reference), np.nan),
+                np.ones(len(reference), dtype=bool))
+    idx = np.searchsorted(keys, reference, side='right') - 1
+    has_prev = idx >= 0
+    prev = np.where(has_prev, idx, 0)
+    has_next = idx + 1 < n
+    nxt = np.where(has_next, idx + 1, n - 1)
+    exact = has_prev & (keys[prev] == reference)
+    out_values = np.where(exact, values[prev], np.nan)
+    out_valids = np.where(exact, valids[prev], True)
+    if how == 'asof':
+        dprev = np.where(has_prev, reference - keys[prev], -1)
+        dnext = np.where(has_next, keys[nxt] - reference, -1)
+        use_next = has_next & (~has_prev | (dnext < dprev))
+        nearest = np.where(use_next, nxt, prev)
+        distance = np.where(use_next, dnext, dprev)
+        found = has_prev | has_next
+        if tolerance is not None:
+            found &= distance <= tolerance
+        out_values = np.where(found, values[nearest], np.nan)
+        out_valids = np.where(found, valids[nearest], True)
+    elif how == 'interpolate':
+        span = keys[nxt] - keys[prev]
+        between = has_prev & has_next & ~exact
+        if tolerance is not None:
+            between &= span <= tolerance
+        fraction = (reference - keys[prev]) / np.where(between, span, 1)
+        interpolated = values[prev] + (values[nxt] - values[prev]) * fraction
+        out_values = np.where(between, interpolated, out_values)
+        out_valids = np.where(between, valids[prev] & valids[nxt],
+                              out_valids)
+    return out_values, out_valids
+
+
+def align_arrays(datalists, how='inner', tolerance=None):
+    """
+    NumPy version of align().
+    :return: (timestamps list, OrderedDict of key -> float array, bool
+             array of valids), missing values are NaN
+    """
+    if how not in ALIGNMENTS:
+        raise ValueError('Unknown alignment "%s"' % how)
+    if not datalists:
+        return [], OrderedDict(), np.ones(0, dtype=bool)
+    datalists = list(datalists.items())
+    first = [d['timestamp'] for d in datalists[0][1]]
+    if all([d['timestamp'] for d in datalist] == first
+           for key, datalist in datalists[1:]):
+        # Usually Units of the same Datalogger have equal timestamps
+        timestamps = first
+        columns = OrderedDict((key, values_array(datalist))
+                              for key, datalist in datalists)
+        valids = np.ones(len(timestamps), dtype=bool)
+        for key, datalist in datalists:
+            valids &= _valids_array(datalist)
+    else:
+        series = OrderedDict((key, _clean_arrays(datalist))
+                             for key, datalist in datalists)
+        if how == 'asof':
+            longest = max(series.values(), key=lambda s: len(s[1]))
+            reference_timestamps, reference = longest[0], longest[1]
+        else:
+            all_keys = np.concatenate([s[1] for s in series.values()])
+            order = np.argsort(all_keys, kind='mergesort')
+            all_keys = all_keys[order]
+            unique = np.ones(len(all_keys), dtype=bool)
+            unique[1:] = all_keys[1:] != all_keys[:-1]
+            reference = all_keys[unique]
+            reference_timestamps = np.concatenate(
+                [s[0] for s in series.values()])[order][unique]
+        if tolerance is not None:
+            tolerance = int(tolerance.total_seconds() * 1000000)
+        timestamps = reference_timestamps.tolist()
+        columns = OrderedDict()
+        valids = np.ones(len(reference), dtype=bool)
+        for key, s in series.items():
+            columns[key], column_valids = _walk_arrays(reference, s, how,
+                                                       tolerance)
+            valids &= column_valids
+    if how != 'outer':
+        keep = np.ones(len(timestamps), dtype=bool)
+        for column in columns.values():
+            keep &= ~np.isnan(column)
+        if not keep.all():
+            timestamps = [timestamps[i] for i in np.flatnonzero(keep)]
+            columns = OrderedDict((key, column[keep])
+                                  for key, column in columns.items())
+            valids = valids[keep]
+    return timestamps, columns, valids
@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.core import checks
 
 
 class Sensdb3Config(AppConfig):
     name = 'sensdb3'
+
+    def ready(self):
+        # Connect signal receivers in every process, not only in the ones
+        # which happen to import the modules
+        from sensdb3 import dataversions, generations, rollups  # noqa
+        checks.register(generations.check_shared_cache)
@@ -1,9 +1,23 @@
 # -*- coding: utf-8 -*-
+import bisect
 import math
 import pytz
 import datetime
 import sys
+from collections import OrderedDict
+from django.conf import settings
 from sensdb3.models import Data
+from sensdb3.rollups import bucket_start, get_rollup_data, RESOLUTIONS
+from sensdb3.downsampling import DOWNSAMPLE_METHODS, downsample_iter
+from sensdb3.alignment import align, align_arrays, values_array
+
+try:
+    import numpy as np
+except ImportError:  # formulas are evaluated row by row without NumPy
+    np = None
+
+# Raw Data is downsampled in chunks of this many rows to limit memory usage
+DOWNSAMPLE_CHUNK_SIZE = getattr(settings, 'DOWNSAMPLE_CHUNK_SIZE', 100000)
 
 import logging
 djangolog = logging.getLogger('django')
@@ -20,15 +34,18 @@ def check_times(st, et):
         raise ValueError("Start and end times must be timezone aware")
 
 
-def get_unit_data(unit, st, et, showinvalid=False):
+def get_unit_data(unit, st, et, showinvalid=False, resolution=None):
     """
     Return Unit's requested data between st and et.
     :param unit: Unit object or numeric id
     :param st: timezone aware datetime
     :param et: timezone aware datetime
+    :param resolution: rollup bucket width in seconds, None for raw Data
     :return: QuerySet of Data objects
     """
     check_times(st, et)
+    if resolution:  # rollups contain only valid data
+        return get_rollup_data(unit, st, et, resolution)
     data = Data.objects.filter(unit=unit)
     data = data.filter(timestamp__gte=st)
     data = data.filter(timestamp__lte=et)
@@ -39,6 +56,80 @@ def get_unit_data(unit, st, et, showinvalid=False):
     return data
 
 
+def get_unit_data_points(unit, max_points, st=None, et=None,
+                         showinvalid=False, method='lttb'):
+    """
+    Return at most max_points of Unit's data between st and et (None means
+    an open time range). Raw Data is returned if it fits, otherwise the
+    finest rollup resolution, which fits. If even the coarsest rollups don't
+    fit, they are downsampled with method ('lttb' or 'minmax'). Rollups
+    contain only valid data, so with showinvalid raw Data is downsampled.
+    Rollup levels, which don't cover all raw Data (e.g. Data written
+    without signals and not rebuilt), are skipped and if no level covers
+    the Data, raw Data is downsampled in DOWNSAMPLE_CHUNK_SIZE chunks.
+    :return: tuple (list of dicts, resolution in seconds or None,
+             downsampling method or None)
+    """
+    data = Data.objects.filter(unit=unit)
+    if st is not None:
+        data = data.filter(timestamp__gte=st)
+    if et is not None:
+        data = data.filter(timestamp__lte=et)
+    if showinvalid is False:
+        data = data.filter(valid=True)
+    data = data.order_by('timestamp')
+    raw = data.values('id', 'value', 'timestamp', 'valid')
+    # Fetch at most max_points + 1 rows per level to see if it fits
+    points = list(raw[:max_points + 1])
+    if len(points) <= max_points:
+        return points, None, None
+    raw_count = data.count()
+    if showinvalid is False:
+        for resolution in sorted(RESOLUTIONS.values()):
+            rollups = get_rollup_data(unit, st, et, resolution)
+            points = list(rollups[:max_points + 1])
+            if (len(points) <= max_points and
+                    _covers(points, data, raw_count, resolution, st, et)):
+                return points, resolution, None
+        if len(points) > max_points:
+            # Even the coarsest rollups don't fit
+            points = list(rollups)
+            if _covers(points, data, raw_count, resolution, st, et):
+                return (DOWNSAMPLE_METHODS[method](points, max_points),
+                        resolution, method)
+    # Raw Data may not fit in memory, it is downsampled in chunks
+    points = downsample_iter(raw.iterator(), raw_count, max_points, method,
+                             DOWNSAMPLE_CHUNK_SIZE)
+    return points, None, method
+
+
+def _covers(rollups, data, raw_count, resolution, st=None, et=None):
+    """
+    True if rollups aggregate (at least) raw_count Data objects and the
+    whole buckets between st and et aggregate all Data of data (a QuerySet)
+    in their time span. Buckets at the edges contain also Data outside
+    st-et, so they can't show that a bucket in the middle is missing.
+    """
+    if sum(r['count'] for r in rollups) < raw_count:
+        return False
+    start = end = None
+    if st is not None:
+        start = bucket_start(st, resolution)
+        if start < st:
+            start += datetime.timedelta(seconds=resolution)
+        data = data.filter(timestamp__gte=start)
+    if et is not None:
+        # The bucket of et is whole only if et is its last moment
+        end = bucket_start(et, resolution)
+        data = data.filter(timestamp__lt=end)
+    if start is None and end is None:
+        return True
+    whole = sum(r['count'] for r in rollups
+                if (start is None or r['timestamp'] >= start) and
+                (end is None or r['timestamp'] < end))
+    return whole >= data.count()
+
+
 def get_unit_data_measuring(unit, st, et):
     """
     Old version.
@@ -53,16 +144,19 @@ def get_unit_data_measuring(unit, st, et):
     return data
 
 
-def get_formula_data(formula, st, et, showinvalid=False):
+def get_formula_data(formula, st, et, showinvalid=False, resolution=None):
     """
     Depending on Formula's type calculate 'v-weir' or 'polynomial' values.
+    If resolution is given, values are calculated from rollups' averages.
     """
     if formula.type == 'polynomial':
         data = _calculate_polynomial_formula_data(formula, st, et,
-                                                  showinvalid=showinvalid)
+                                                  showinvalid=showinvalid,
+                                                  resolution=resolution)
     elif formula.type == 'v-weir':
         data = _calculate_v_wier_formula_data(formula, st, et,
-                                              showinvalid=showinvalid)
+                                              showinvalid=showinvalid,
+                                              resolution=resolution)
         #raise NotImplementedError('v-weir formula is not implemented yet')
     else:
         raise NotImplementedError(
@@ -70,46 +164,64 @@ def get_formula_data(formula, st, et, showinvalid=False):
     return data
 
 
-def dictionize_by_timestamp(data):
+def _get_formula_datalists(formula, st, et, resolution=None):
     """
-    Convert list of dictionaries to a dictionary, where key is the timestamp
-    from source list's dict item.
+    Fetch data of all units (which aren't None) and f1 formula (if it is
+    used) as lists of dicts.
+    :return: OrderedDict with keys c1..c4 and f1
     """
-    _dict = {}
-    for d in data:
-        ts = d['timestamp']
-        _dict[ts] = d
-    return _dict
+    datalists = OrderedDict()
+    for key, unit in [('c1', formula.unit1), ('c2', formula.unit2),
+                      ('c3', formula.unit3), ('c4', formula.unit4)]:
+        if unit:
+            datalists[key] = list(get_unit_data(unit, st, et,
+                                                resolution=resolution))
+    if formula.formula1:  # get f1 data if it is used in formula
+        datalists['f1'] = list(get_formula_data(formula.formula1, st, et,
+                               showinvalid=False, resolution=resolution))
+    return datalists
+
 
+def _log_eval_error(formula, exp, values, err):
+    msg = (u'Formula eval error in %s: Formula %d: "%s" with '
+           u'values "%s" failed on error "%s"' % (
+               formula.datalogger.idcode, formula.id, exp,
+               str(values), err))
+    djangolog.warning(msg)
 
-def _calculate_polynomial_formula_data(formula, st, et, showinvalid=False):
+
+def _calculate_polynomial_formula_data(formula, st, et, showinvalid=False,
+                                       resolution=None):
     """
     Take a formula, fetch data of all units (which aren't None),
     eval(formula.parameters) with correct data values and return
     result as a single data list containing timestamps and data values.
     """
-    # Create a list for all data of units
-    # Convert all QuerySets to lists, this speeds up accessing values
-    datalists = {}
-    datadicts = {}
-    max_len = 0
-    longest_list = None
-    for key, unit in [('c1', formula.unit1), ('c2', formula.unit2),
-                      ('c3', formula.unit3), ('c4', formula.unit4)]:
-        if unit:
-            datalists[key] = list(get_unit_data(unit, st, et))
-            datadicts[key] = dictionize_by_timestamp(datalists[key])
-            if len(datalists[key]) > max_len:
-                max_len = len(datalists[key])
-                longest_list = key
-    if formula.formula1:  # get f1 data if it is used in formula
-        key = 'f1'
-        datalists[key] = list(get_formula_data(formula.formula1, st, et,
-                              showinvalid=False))
-        datadicts[key] = dictionize_by_timestamp(datalists[key])
-        if len(datalists[key]) > max_len:
-            #max_len = len(datalists[key])
-            longest_list = key
+    datalists = _get_formula_datalists(formula, st, et, resolution=resolution)
+    timeformulas = list(formula.timeformulas.order_by('starttime'))
+    if np is not None:
+        data = _evaluate_polynomial_vectorized(formula, datalists,
+                                               timeformulas, showinvalid)
+        if data is not None:
+            return data
+    return _evaluate_polynomial_loop(formula, datalists, timeformulas,
+                                     showinvalid)
+
+
+def _get_tolerance(formula):
+    if formula.tolerance is None:
+        return None
+    return datetime.timedelta(seconds=formula.tolerance)
+
+
+def _evaluate_polynomial_loop(formula, datalists, timeformulas,
+                              showinvalid=False):
+    """
+    Evaluate formula row by row. Used when NumPy is not available or
+    the expression can't be evaluated over arrays.
+    """
+    timestamps, columns, valids = align(datalists, formula.alignment,
+                                        _get_tolerance(formula))
     data = []
     # Parameters for eval()
     exp = formula.parameters
@@ -118,61 +230,129 @@ def _calculate_polynomial_formula_data(formula, st, et, showinvalid=False):
     # Add to globals (functions) only keys that are really needed, e.g.
     # {'pi': math.pi, 'sin': math.sin }
     functions = {'__builtins__': None, 'math': math}
-    locals_dict = {}
-    timeformulas = list(formula.timeformulas.order_by('starttime'))
+    timeformulas = list(timeformulas)
     multiplier = formula.multiplier
-    # Loop through the longest list, it should contain most of timestamps
-    # other lists have
-    if longest_list is None:
-        return []  # No data at all :-O
     eval_failed = False
-    # FIXME: create instead a list which contains ALL timestamps!
-    for d in datalists[longest_list]:
-        fail = False
-        # Pick the value from all lists
-        # (usually just c1, but also others may exist in more complex formulas)
-        for key in datalists.keys():
-            if d.get('value') is None:
-                fail = True
-                continue
-            # Use longest list's timestamp to get value from all lists
-            try:
-                locals_dict[key] = datadicts[key][d['timestamp']]['value']
-            except KeyError as err:
-                # FIXME: create instead a list which contains ALL timestamps!
-                fail = True
-        if fail:
+    for i, timestamp in enumerate(timestamps):
+        locals_dict = dict((key, column[i])
+                           for key, column in columns.items())
+        valid = valids[i]
+        if None in locals_dict.values():  # outer alignment
+            data.append({'value': None, 'timestamp': timestamp,
+                         'valid': valid})
             continue
-        if timeformulas and d['timestamp'] >= timeformulas[0].starttime:
-            #print "UUSI FORMULA", d['timestamp'], timeformulas[0].starttime
+        while timeformulas and timestamp >= timeformulas[0].starttime:
             tf = timeformulas.pop(0)
             multiplier = tf.multiplier
             exp = tf.parameters
             compiled = compile(exp, '<string>', 'eval')
         # If data is invalid, don't calculate the value
-        if showinvalid or d['valid']:
+        if showinvalid or valid:
             # NOTE: eval() is evil!
             try:
                 val = eval(compiled, functions,
                            locals_dict) * multiplier
-                #print "EVAL", exp, locals_dict
             except ValueError as err:
                 # e.g. negative number cannot be raised to a fractional power
                 if eval_failed is False:  # log error once
-                    msg = (u'Formula eval error in %s: Formula %d: "%s" with '
-                           u'values "%s" failed on error "%s"' % (
-                               formula.datalogger.idcode, formula.id, exp,
-                               str(locals_dict), err))
-                    djangolog.warning(msg)
+                    _log_eval_error(formula, exp, locals_dict, err)
                     eval_failed = True
                 val = None
         else:
             val = None
-        data.append({'value': val, 'timestamp': d['timestamp'],
-                     'valid': d['valid']})
+        data.append({'value': val, 'timestamp': timestamp, 'valid': valid})
     return data
 
 
+class _Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _numpy_log(x, base=None):
+    if base is None:
+        return np.log(x)
+    return np.log(x) / np.log(base)
+
+
+if np is not None:
+    # Array versions of math module's functions. Formulas using anything
+    # else are evaluated row by row.
+    NUMPY_MATH = _Namespace(
+        pi=np.pi, e=np.e,
+        sqrt=np.sqrt, exp=np.exp, expm1=np.expm1, log=_numpy_log,
+        log10=np.log10, log1p=np.log1p, pow=np.power, fabs=np.fabs,
+        floor=np.floor, ceil=np.ceil, trunc=np.trunc, hypot=np.hypot,
+        sin=np.sin, cos=np.cos, tan=np.tan,
+        asin=np.arcsin, acos=np.arccos, atan=np.arctan, atan2=np.arctan2,
+        sinh=np.sinh, cosh=np.cosh, tanh=np.tanh,
+        degrees=np.degrees, radians=np.radians,
+    )
+
+
+def _evaluate_polynomial_vectorized(formula, datalists, timeformulas,
+                                    showinvalid=False):
+    """
+    Evaluate formula once over whole NumPy arrays. Rows are the same as in
+    _evaluate_polynomial_loop(). Timeformulas split the arrays at their
+    starttimes. NaN/inf results (where math.* raises ValueError) become None.
+    :return: list of data dicts or None if the expression can't be
+             evaluated over arrays
+    """
+    timestamps, columns, valids = align_arrays(
+        datalists, formula.alignment, _get_tolerance(formula))
+    # Rows, which have a value in all series (all, if not outer alignment)
+    ok = np.ones(len(timestamps), dtype=bool)
+    for values in columns.values():
+        ok &= ~np.isnan(values)
+    evaluate = ok if showinvalid else ok & valids
+
+    segments = []
+    start = 0
+    exp, multiplier = formula.parameters, formula.multiplier
+    for tf in timeformulas:
+        end = bisect.bisect_left(timestamps, tf.starttime)
+        segments.append((start, max(start, end), exp, multiplier))
+        start = max(start, end)
+        exp, multiplier = tf.parameters, tf.multiplier
+    segments.append((start, len(timestamps), exp, multiplier))
+
+    result = np.full(len(timestamps), np.nan)
+    functions = {'__builtins__': None, 'math': NUMPY_MATH}
+    for start, end, exp, multiplier in segments:
+        if start == end:
+            continue
+        locals_dict = dict((key, values[start:end])
+                           for key, values in columns.items())
+        try:
+            with np.errstate(all='ignore'):
+                val = eval(compile(exp, '<string>', 'eval'), functions,
+                           locals_dict) * multiplier
+                result[start:end] = np.broadcast_to(
+                    np.asarray(val, dtype=float), (end - start,))
+        except Exception:
+            # e.g. unsupported math function or a conditional expression
+            return None
+
+    evaluated = evaluate & np.isfinite(result)
+    failed = np.flatnonzero(evaluate & ~evaluated)
+    if len(failed):  # log error once
+        i = failed[0]
+        for start, end, exp, multiplier in segments:
+            if start <= i < end:
+                break
+        _log_eval_error(formula, exp,
+                        dict((key, values[i].item())
+                             for key, values in columns.items()),
+                        'result is not a finite number')
+    values = result.tolist()
+    evaluated = evaluated.tolist()
+    valids = valids.tolist()
+    return [{'value': values[i] if evaluated[i] else None,
+             'timestamp': timestamps[i], 'valid': valids[i]}
+            for i in range(len(timestamps))]
+
+
 def _v_wier(val, angle):
     """
     Q = 1381 * H^2,5 * tan(Ø/2)
@@ -181,15 +361,33 @@ def _v_wier(val, angle):
     return val
 
 
-def _calculate_v_wier_formula_data(formula, st, et, showinvalid=False):
+def _calculate_v_wier_formula_data(formula, st, et, showinvalid=False,
+                                   resolution=None):
+    """
     """
+    data = list(get_unit_data(formula.unit1, st, et, resolution=resolution))
+    return _evaluate_v_wier(formula, data)
+
+
+def _evaluate_v_wier(formula, data):
+    """
+    Replace values in data with Q, negative values with 0.0. Vectorized
+    if NumPy is available.
     """
     v_view_angle = float(formula.parameters)
     multiplier = float(formula.multiplier)
-    data = list(get_unit_data(formula.unit1, st, et))
-    for d in data:
-        try:
-            d['value'] = _v_wier(d['value'], v_view_angle) * multiplier
-        except ValueError:  # e.g. value was negative
-            d['value'] = 0.0
+    if np is None:
+        for d in data:
+            try:
+                d['value'] = _v_wier(d['value'], v_view_angle) * multiplier
+            except ValueError:  # e.g. value was negative
+                d['value'] = 0.0
+        return data
+    values = values_array(data)
+    with np.errstate(all='ignore'):
+        q = 1381 * (values / 1000.0) ** 2.5 * math.tan(
+            math.radians(v_view_angle) / 2.0) * multiplier
+    q[np.isnan(q) & ~np.isnan(values)] = 0.0  # e.g. value was negative
+    for d, val in zip(data, q.tolist()):
+        d['value'] = None if val != val else val
     return data
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Data version counters for cache invalidation.
+
+Every Unit and Datalogger has a version in Django's cache, which changes
+whenever new Data of the Unit (or of any Unit of the Datalogger) is stored.
+There is also a global version, which changes on any new Data. Cached API
+responses include the relevant versions in their keys (see
+sensdb_api.v1.views.DataVersionKeyBit), so they stay valid until new Data
+arrives and are never stale. Saving or deleting a Unit or Formula changes
+the versions too, because Datalogger's units and formulas are cached.
+"""
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from sensdb3.models import Data, Formula, Unit
+
+GLOBAL_KEY = 'sensdb3:data_version'
+UNIT_KEY = 'sensdb3:data_version:unit:{}'
+DATALOGGER_KEY = 'sensdb3:data_version:datalogger:{}'
+
+
+def _next_version():
+    try:
+        return cache.incr(GLOBAL_KEY)
+    except ValueError:  # The key didn't exist or was evicted
+        # Don't start from a value, which some cached response may use
+        version = int(time.time() * 1000000)
+        cache.set(GLOBAL_KEY, version, None)
+        return version
+
+
+def _get_versions(keys):
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        # An evicted version must not return to an earlier value
+        version = _next_version()
+        cache.set_many(dict((key, version) for key in missing), None)
+        versions.update((key, version) for key in missing)
+    return [versions[key] for key in keys]
+
+
+def get_global_version():
+    return _get_versions([GLOBAL_KEY])[0]
+
+
+def get_unit_versions(unit_ids):
+    """Return versions of Units in the same order as unit_ids."""
+    return _get_versions([UNIT_KEY.format(id) for id in unit_ids])
+
+
+def get_datalogger_version(datalogger_id):
+    return _get_versions([DATALOGGER_KEY.format(datalogger_id)])[0]
+
+
+def bump_data_versions(unit_ids=(), datalogger_ids=()):
+    """
+    Change versions of Units, Dataloggers and the global version with two
+    cache operations. Versions are values of the global counter, so they
+    never return to an earlier value.
+    """
+    version = _next_version()
+    keys = [UNIT_KEY.format(id) for id in set(unit_ids)]
+    keys += [DATALOGGER_KEY.format(id) for id in set(datalogger_ids)]
+    if keys:
+        cache.set_many(dict((key, version) for key in keys), None)
+    return version
+
+
+@receiver(post_save, sender=Data)
+@receiver(post_delete, sender=Data)
+def data_changed(sender, instance, **kwargs):
+    # Data.objects.bulk_create() sends no signals, process_dataposts bumps
+    # the versions itself
+    datalogger_ids = []
+    if instance.unit_id is not None:
+        datalogger_ids = [instance.unit.datalogger_id]
+    transaction.on_commit(
+        lambda: bump_data_versions([instance.unit_id], datalogger_ids))
+
+
+@receiver(post_save, sender=Unit)
+@receiver(post_delete, sender=Unit)
+def unit_changed(sender, instance, **kwargs):
+    # Deleting clears instance.pk before the transaction commits
+    unit_ids, datalogger_ids = [instance.pk], [instance.datalogger_id]
+    transaction.on_commit(
+        lambda: bump_data_versions(unit_ids, datalogger_ids))
+
+
+@receiver(post_save, sender=Formula)
+@receiver(post_delete, sender=Formula)
+def formula_changed(sender, instance, **kwargs):
+    datalogger_ids = [instance.datalogger_id]
+    transaction.on_commit(
+        lambda: bump_data_versions(datalogger_ids=datalogger_ids))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Reduce the number of points of a time series for plotting.
+
+Both functions take a list of dicts, which have at least 'timestamp' and
+'value' keys (like get_unit_data() returns) in timestamp order, and return
+a subset of the same dicts in the same order. downsample_iter() applies them
+to an iterator in chunks.
+"""
+import datetime
+import math
+
+import pytz
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def _seconds(timestamp):
+    return (timestamp - EPOCH).total_seconds()
+
+
+def lttb(points, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling (Sveinn Steinarsson, 2013).
+    Keeps the first and last point and from every bucket between them the
+    point, which forms the largest triangle with the previously selected
+    point and the average of the next bucket. Preserves the visual shape of
+    the series well.
+    """
+    n = len(points)
+    if threshold >= n:
+        return list(points)
+    if threshold <= 2:
+        return [points[0], points[-1]][:threshold]
+    xs = [_seconds(p['timestamp']) for p in points]
+    ys = [p['value'] for p in points]
+    sampled = [points[0]]
+    every = (n - 2) / float(threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_len = avg_end - avg_start
+        avg_x = sum(xs[avg_start:avg_end]) / avg_len
+        avg_y = sum(ys[avg_start:avg_end]) / avg_len
+        range_start = int(i * every) + 1
+        range_end = int((i + 1) * every) + 1
+        ax, ay = xs[a], ys[a]
+        max_area = -1.0
+        next_a = range_start
+        for j in range(range_start, range_end):
+            area = abs((ax - avg_x) * (ys[j] - ay) -
+                       (ax - xs[j]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                next_a = j
+        sampled.append(points[next_a])
+        a = next_a
+    sampled.append(points[-1])
+    return sampled
+
+
+def minmax(points, threshold):
+    """
+    Split points into threshold / 2 equally sized buckets and keep the
+    smallest and the largest value of every bucket. Preserves all spikes.
+    """
+    n = len(points)
+    if threshold >= n:
+        return list(points)
+    buckets = max(threshold // 2, 1)
+    every = n / float(buckets)
+    sampled = []
+    for i in range(buckets):
+        bucket = range(int(i * every), int((i + 1) * every))
+        lo = min(bucket, key=lambda j: points[j]['value'])
+        hi = max(bucket, key=lambda j: points[j]['value'])
+        for j in sorted(set([lo, hi])):
+            sampled.append(points[j])
+    return sampled[:threshold]
+
+
+DOWNSAMPLE_METHODS = {
+    'lttb': lttb,
+    'minmax': minmax,
+}
+
+
+def downsample_iter(points, count, threshold, method='lttb',
+                    chunk_size=100000):
+    """
+    Downsample an iterator of count points (e.g. QuerySet.iterator()) with
+    method, keeping at most about chunk_size + 2 * threshold points in
+    memory. Every chunk_size points are first downsampled to twice their
+    share of threshold and the result is downsampled to threshold.
+    """
+    downsample = DOWNSAMPLE_METHODS[method]
+    if count <= chunk_size:
+        return downsample(list(points), threshold)
+    share = max(int(math.ceil(2.0 * threshold * chunk_size / count)), 2)
+    sampled = []
+    chunk = []
+    for point in points:
+        chunk.append(point)
+        if len(chunk) == chunk_size:
+            sampled.extend(downsample(chunk, share))
+            chunk = []
+    if chunk:
+        sampled.extend(downsample(chunk, share))
+    return downsample(sampled, threshold)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Generation counters of in-memory caches of long running processes.
+
+process_dataposts and Celery workers keep Units and active Alerts in memory
+(see sensdb_api.management.commands.tools). Saving or deleting a Unit or an
+Alert in any process, e.g. in admin, changes the model's generation and the
+caches are cleared when they notice a changed generation. Creating an Alert
+doesn't change the generation.
+
+A generation has two parts: a counter of this process, which changes at
+once, and a counter in Django's cache, which changes when the transaction
+commits. Other processes see the latter only if all processes use a shared
+cache backend (see check_shared_cache()).
+
+The receivers are connected in Sensdb3Config.ready(), so that they work in
+every process.
+"""
+import time
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from sensdb3.models import Alert, Unit
+
+UNIT_GENERATION_KEY = 'sensdb3:unit_cache_generation'
+ALERT_GENERATION_KEY = 'sensdb3:alert_cache_generation'
+# Cache backends, which are not shared by processes
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+_local_generations = {}
+
+
+def get_generation(key):
+    """Return the current generation, compare it with ==."""
+    return _local_generations.get(key, 0), cache.get(key)
+
+
+def _bump_shared_generation(key):
+    try:
+        cache.incr(key)
+    except ValueError:  # The key didn't exist or was evicted
+        # Don't start from a value, which some process may have seen
+        cache.set(key, int(time.time() * 1000000), None)
+
+
+def bump_generation(key):
+    _local_generations[key] = _local_generations.get(key, 0) + 1
+    transaction.on_commit(lambda: _bump_shared_generation(key))
+
+
+@receiver(post_save, sender=Unit)
+@receiver(post_delete, sender=Unit)
+def unit_changed(sender, instance, **kwargs):
+    bump_generation(UNIT_GENERATION_KEY)
+
+
+@receiver(post_save, sender=Alert)
+@receiver(post_delete, sender=Alert)
+def alert_changed(sender, instance, created=False, **kwargs):
+    # Caches don't need to forget a new Alert, Units without a cached
+    # Alert are always checked from the database
+    if not created:
+        bump_generation(ALERT_GENERATION_KEY)
+
+
+def is_shared_cache():
+    """Return False if the default cache is local to each process."""
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    return backend not in LOCAL_CACHE_BACKENDS
+
+
+def check_shared_cache(app_configs, **kwargs):
+    """System check: web and worker processes need a shared cache."""
+    if not is_shared_cache():
+        return [checks.Warning(
+            'The default cache backend %s is not shared by processes.' %
+            settings.CACHES['default']['BACKEND'],
+            hint='Configure a shared cache (e.g. memcached or database) '
+                 'in CACHES, so that process_dataposts and Celery workers '
+                 'notice Units and Alerts changed in other processes and '
+                 'new Dataposts are processed without follow-up drains.',
+            id='sensdb3.W001')]
+    return []
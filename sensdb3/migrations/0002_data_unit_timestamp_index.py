@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+INDEX_NAME = 'sensdb3_data_unit_id_timestamp_idx'
+
+
+def create_index(apps, schema_editor):
+    """
+    Create (unit_id, timestamp) index. On PostgreSQL 11+ the index covers
+    also value and valid, so range scans don't need to visit the table.
+    IF NOT EXISTS makes this a no-op if the index has already been built
+    with `manage.py create_data_index` (CREATE INDEX CONCURRENTLY).
+    """
+    connection = schema_editor.connection
+    include = ''
+    if connection.vendor == 'postgresql' and \
+            connection.pg_version >= 110000:
+        include = ' INCLUDE (value, valid)'
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS {} ON sensdb3_data '
+        '(unit_id, timestamp){}'.format(INDEX_NAME, include))
+
+
+def drop_index(apps, schema_editor):
+    schema_editor.execute('DROP INDEX IF EXISTS {}'.format(INDEX_NAME))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sensdb3', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(create_index, drop_index),
+            ],
+            state_operations=[
+                migrations.AlterIndexTogether(
+                    name='data',
+                    index_together=set([('unit', 'timestamp')]),
+                ),
+            ],
+        ),
+    ]
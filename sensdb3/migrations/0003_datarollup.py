@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-17 00:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sensdb3', '0002_data_unit_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.IntegerField(choices=[(60, '1 min'), (3600, '1 h'), (86400, '1 day')], verbose_name='Resolution')),
+                ('timestamp', models.DateTimeField(verbose_name='Bucket start time')),
+                ('count', models.IntegerField(default=0)),
+                ('value', models.FloatField(verbose_name='Average')),
+                ('min', models.FloatField()),
+                ('max', models.FloatField()),
+                ('first', models.FloatField()),
+                ('firsttimestamp', models.DateTimeField()),
+                ('last', models.FloatField()),
+                ('lasttimestamp', models.DateTimeField()),
+                ('unit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='sensdb3.Unit')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='datarollup',
+            unique_together=set([('unit', 'resolution', 'timestamp')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-17 00:26
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sensdb3', '0003_datarollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='formula',
+            name='alignment',
+            field=models.CharField(choices=[('inner', 'Only timestamps present in all series'), ('outer', 'All timestamps, missing values give no result'), ('asof', 'Nearest value within tolerance'), ('interpolate', 'Linear interpolation within tolerance')], default='inner', max_length=16, verbose_name='Timestamp alignment'),
+        ),
+        migrations.AddField(
+            model_name='formula',
+            name='tolerance',
+            field=models.FloatField(blank=True, null=True, verbose_name='Alignment tolerance (seconds)'),
+        ),
+    ]
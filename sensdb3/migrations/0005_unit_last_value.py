@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-17 00:43
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_last_values(apps, schema_editor):
+    # One (unit_id, timestamp) index lookup per Unit
+    Unit = apps.get_model('sensdb3', 'Unit')
+    Data = apps.get_model('sensdb3', 'Data')
+    for unit in Unit.objects.all().only('id'):
+        latest = Data.objects.filter(
+            unit_id=unit.id, valid=True, timestamp__isnull=False,
+        ).order_by('-timestamp').values_list('value', 'timestamp').first()
+        if latest is not None:
+            Unit.objects.filter(id=unit.id).update(
+                lastvalue=latest[0], lasttimestamp=latest[1])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sensdb3', '0004_formula_alignment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unit',
+            name='lasttimestamp',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Last timestamp'),
+        ),
+        migrations.AddField(
+            model_name='unit',
+            name='lastvalue',
+            field=models.FloatField(blank=True, editable=False, null=True, verbose_name='Last value'),
+        ),
+        migrations.RunPython(fill_last_values, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-17 14:05
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Max, Min
+
+
+def recompute_aggregates(apps, schema_editor):
+    # Aggregates are updated incrementally from now on, start from correct
+    # values (see Datalogger.set_aggregates())
+    Datalogger = apps.get_model('sensdb3', 'Datalogger')
+    Datapost = apps.get_model('sensdb3', 'Datapost')
+    Data = apps.get_model('sensdb3', 'Data')
+    for datalogger in Datalogger.objects.all().only('id', 'idcode'):
+        dataposts = Datapost.objects.filter(idcode=datalogger.idcode)\
+            .aggregate(count=Count('id'), last=Max('created'))
+        data = Data.objects.filter(unit__datalogger_id=datalogger.id)\
+            .aggregate(count=Count('id'), first=Min('timestamp'),
+                       last=Max('timestamp'))
+        Datalogger.objects.filter(id=datalogger.id).update(
+            datapostcount=dataposts['count'],
+            lastdatapost=dataposts['last'],
+            measuringcount=data['count'],
+            firstmeasuring=data['first'],
+            lastmeasuring=data['last'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sensdb3', '0006_datalogger_claim'),
+    ]
+
+    operations = [
+        migrations.RunPython(recompute_aggregates, migrations.RunPython.noop),
+    ]
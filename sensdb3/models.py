@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 
-import re
 import math
 import string
 import random
@@ -10,12 +9,14 @@ import zlib
 import base64
 import os
 
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericRelation
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
-from django.db.models import Q
+from django.db.models import Q, F, Value
+from django.db.models.functions import Coalesce, Greatest, Least
 from django.core.exceptions import ValidationError
 
 
@@ -197,6 +198,12 @@ class Datalogger(models.Model):
     lastdatapost = models.DateTimeField(blank=True, null=True, editable=False,
                                         verbose_name=_(
                                             'Latest datapost received'))
+    # Lease of a process_dataposts worker, which is processing this
+    # Datalogger's Dataposts (on databases without SKIP LOCKED)
+    claimed_by = models.CharField(max_length=100, blank=True, default='',
+                                  editable=False)
+    claimed_until = models.DateTimeField(blank=True, null=True,
+                                         editable=False)
 
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
@@ -253,13 +260,53 @@ class Datalogger(models.Model):
             self.datapostcount = 0
             self.lastdatapost = None
         data_obj = Data.objects.filter(unit__in=self.units.all())
-        if data_obj.count() > 0:
+        self.measuringcount = data_obj.count()
+        if self.measuringcount > 0:
             self.firstmeasuring = data_obj.order_by('timestamp')[0].timestamp
             self.lastmeasuring = data_obj.order_by('-timestamp')[0].timestamp
         else:
             self.firstmeasuring = None
             self.lastmeasuring = None
 
+    def update_aggregates(self, datapostcount=0, lastdatapost=None,
+                          measuringcount=0, firstmeasuring=None,
+                          lastmeasuring=None):
+        """
+        Update aggregate fields incrementally with one atomic UPDATE, using
+        counts and min/max timestamps of newly processed Dataposts and Data.
+        Unlike set_aggregates() this doesn't scan Logger's all Data, but
+        the counts may drift, e.g. when Data is deleted. Use
+        `manage.py recompute_aggregates` to fix them.
+
+        Args:
+            datapostcount (int): number of new Dataposts
+            lastdatapost (datetime): latest creation time of new Dataposts
+            measuringcount (int): number of new Data objects
+            firstmeasuring (datetime): earliest timestamp of new Data
+            lastmeasuring (datetime): latest timestamp of new Data
+        """
+        def latest(field, value):
+            value = Value(value, output_field=models.DateTimeField())
+            return Greatest(Coalesce(field, value), value)
+
+        def earliest(field, value):
+            value = Value(value, output_field=models.DateTimeField())
+            return Least(Coalesce(field, value), value)
+
+        updates = {'updated': timezone.now()}
+        if datapostcount:
+            updates['datapostcount'] = F('datapostcount') + datapostcount
+        if lastdatapost is not None:
+            updates['lastdatapost'] = latest('lastdatapost', lastdatapost)
+        if measuringcount:
+            updates['measuringcount'] = F('measuringcount') + measuringcount
+        if firstmeasuring is not None:
+            updates['firstmeasuring'] = earliest('firstmeasuring',
+                                                 firstmeasuring)
+        if lastmeasuring is not None:
+            updates['lastmeasuring'] = latest('lastmeasuring', lastmeasuring)
+        Datalogger.objects.filter(pk=self.pk).update(**updates)
+
     def save(self, *args, **kwargs):
         """
         Check that time zone is set before saving and activating logger.
@@ -302,6 +349,13 @@ class DataloggerUser(models.Model):
         return "%s -> %s (%s)" % (self.user, self.datalogger, self.role)
 
 
+# Header names (as in Datapost.httpheaders, e.g. 'USER_AGENT' or
+# 'CONTENT_TYPE') stored in Datapost.httpheaders. None stores all headers.
+DATAPOST_HEADERS = getattr(settings, 'DATAPOST_HEADERS', None)
+if DATAPOST_HEADERS is not None:
+    DATAPOST_HEADERS = frozenset(DATAPOST_HEADERS)
+HTTP_PREFIX_LEN = len('HTTP_')
+
 DATAPOST_STATUS_CHOICES = [
     (-1, _('Deleted')),
     (0, _('New')),
@@ -363,13 +417,16 @@ class Datapost(models.Model):
         # Try to get X-Real-IP header from nginx first, then REMOTE_ADDR
         self.ip = request.META.get('HTTP_X_REAL_IP',
                                    request.META.get('REMOTE_ADDR'))
-        regex = re.compile('^HTTP_')
-        header_tuples = [(regex.sub('', header), value) for (header, value)
-                         in request.META.items() if header.startswith('HTTP_')]
+        header_tuples = [(header[HTTP_PREFIX_LEN:], value)
+                         for (header, value) in request.META.items()
+                         if header.startswith('HTTP_')]
         for header in ['REQUEST_METHOD', 'CONTENT_LENGTH', 'CONTENT_TYPE']:
             val = request.META.get(header)
             if val:
                 header_tuples.append((header, val))
+        if DATAPOST_HEADERS is not None:
+            header_tuples = [(h, v) for h, v in header_tuples
+                             if h in DATAPOST_HEADERS]
         header_tuples.sort()
         try:
             self.httpheaders = "\n".join(['%s: %s' % (h, v)
@@ -481,6 +538,12 @@ class Unit(models.Model):
     mplparams = models.CharField(
         max_length=250, blank=True,
         verbose_name=_('Matplotlib graph extra parameters'))
+    # Latest valid Data, maintained by update_unit_last_values()
+    lastvalue = models.FloatField(blank=True, null=True, editable=False,
+                                  verbose_name=_('Last value'))
+    lasttimestamp = models.DateTimeField(blank=True, null=True,
+                                         editable=False,
+                                         verbose_name=_('Last timestamp'))
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
@@ -506,9 +569,54 @@ class Data(models.Model):
     def __str__(self):
         return '%.3f' % self.value
 
-    # class Meta:
-    #     unique_together = [["unit", "timestamp"],]
-    #     index_together = [["unit", "timestamp"],]
+    class Meta:
+        # unique_together = [["unit", "timestamp"],]
+        # Almost all Data queries filter by unit and a time range. On
+        # PostgreSQL the index covers also value and valid, see migration
+        # 0002 and `manage.py create_data_index`.
+        index_together = [["unit", "timestamp"],]
+
+
+# Rollup bucket widths in seconds, keyed by the name used in API requests
+ROLLUP_RESOLUTIONS = [
+    ('1min', 60),
+    ('1h', 60 * 60),
+    ('1d', 24 * 60 * 60),
+]
+
+ROLLUP_RESOLUTION_CHOICES = [
+    (60, _('1 min')),
+    (60 * 60, _('1 h')),
+    (24 * 60 * 60, _('1 day')),
+]
+
+
+class DataRollup(models.Model):
+    """
+    Aggregated valid Data of one Unit in a time bucket, e.g. one hour.
+    Buckets start at multiples of resolution seconds since the Unix epoch
+    (so days are UTC days). Rollups are updated by process_dataposts and
+    can be rebuilt with `manage.py rebuild_rollups`.
+    Field names match Data's fields, so the same filters work for both.
+    """
+    unit = models.ForeignKey(Unit, related_name='rollups')
+    resolution = models.IntegerField(choices=ROLLUP_RESOLUTION_CHOICES,
+                                     verbose_name=_('Resolution'))
+    timestamp = models.DateTimeField(verbose_name=_('Bucket start time'))
+    count = models.IntegerField(default=0)
+    value = models.FloatField(verbose_name=_('Average'))
+    min = models.FloatField()
+    max = models.FloatField()
+    first = models.FloatField()
+    firsttimestamp = models.DateTimeField()
+    last = models.FloatField()
+    lasttimestamp = models.DateTimeField()
+
+    def __str__(self):
+        return '%s %s %.3f' % (self.timestamp, self.resolution, self.value)
+
+    class Meta:
+        unique_together = (("unit", "resolution", "timestamp"),)
 
 
 LOGGERLOG_TYPE_CHOICES = (
@@ -602,6 +710,14 @@ FORMULACHOICES = (
     ('polynomial', _('Polynomial')),
 )
 
+# How values of c1..c4/f1 are matched by timestamp, see sensdb3/alignment.py
+ALIGNMENTCHOICES = (
+    ('inner', _('Only timestamps present in all series')),
+    ('outer', _('All timestamps, missing values give no result')),
+    ('asof', _('Nearest value within tolerance')),
+    ('interpolate', _('Linear interpolation within tolerance')),
+)
+
 
 class Formula(models.Model):
     """
@@ -647,6 +763,12 @@ class Formula(models.Model):
                                   verbose_name=_(
                                       u"Parameters (',' separated list)"))
     multiplier = models.FloatField(default=1, verbose_name=_('Multiplier'))
+    alignment = models.CharField(max_length=16, choices=ALIGNMENTCHOICES,
+                                 default='inner',
+                                 verbose_name=_('Timestamp alignment'))
+    tolerance = models.FloatField(blank=True, null=True,
+                                  verbose_name=_(
+                                      'Alignment tolerance (seconds)'))
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
@@ -785,6 +907,35 @@ def update_grouplogger_aggregates(datalogger):
         gl.save()
 
 
+def update_unit_last_values(dataitems):
+    """
+    Update Units' lastvalue and lasttimestamp from new Data objects. Only
+    valid Data with a timestamp is used. There is one conditional UPDATE
+    per Unit, so older Data processed late doesn't overwrite newer values.
+
+    Args:
+        dataitems (list): Data objects
+
+    Returns:
+        int: number of Units whose latest Data was in dataitems
+    """
+    latest = {}
+    for dataitem in dataitems:
+        if not dataitem.valid or dataitem.timestamp is None:
+            continue
+        current = latest.get(dataitem.unit_id)
+        if current is None or dataitem.timestamp >= current.timestamp:
+            latest[dataitem.unit_id] = dataitem
+    for unit_id, dataitem in latest.items():
+        Unit.objects.filter(
+            Q(lasttimestamp__isnull=True) |
+            Q(lasttimestamp__lte=dataitem.timestamp),
+            id=unit_id,
+        ).update(lastvalue=dataitem.value,
+                 lasttimestamp=dataitem.timestamp)
+    return len(latest)
+
+
 CONVERSION_CHOICES = (
     ('raw_eng', _('Raw->Eng')),  # Default value
     ('le_float', _('Little Endian Float->Eng')),
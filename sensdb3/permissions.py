@@ -1,14 +1,31 @@
 from __future__ import absolute_import, unicode_literals, print_function
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.db.models import Q
+from django.db.models.signals import (m2m_changed, post_delete, post_init,
+                                      post_save)
+from django.dispatch import receiver
 from sensdb3.models import (
     Datalogger,
     Unit,
     Data,
+    DataRollup,
     Formula,
     Grouplogger,
     Dataloggerlog,
+    Organization,
 )
 
+User = get_user_model()
+
+# Visible Unit ids of a user are cached for this many seconds. Signals below
+# invalidate them immediately, the timeout limits staleness if a change was
+# made in a process with another (e.g. local memory) cache.
+VISIBLE_UNITS_TIMEOUT = getattr(settings, 'VISIBLE_UNITS_CACHE_TIMEOUT',
+                                5 * 60)
+VISIBLE_UNITS_VERSION_KEY = 'sensdb3:visible_units_version'
+
 
 # TODO: it would probably be wise to implement these as Manager methods in
 # data.models, e.g. Datalogger.objects.for_user(user)
@@ -115,6 +132,32 @@ def get_units(user, datalogger=None):
     return units
 
 
+def get_visible_unit_ids(user):
+    """
+    Return a list of ids of Units user can view (same as get_units(user)).
+    The list is computed once and cached until some membership,
+    Organization, Datalogger's active or organization, Unit's active or
+    visibility or user's is_staff changes (see invalidate_visible_units()).
+    """
+    if not user.is_authenticated():
+        return []
+    version = cache.get(VISIBLE_UNITS_VERSION_KEY, 0)
+    key = 'sensdb3:visible_units:{}:{}'.format(version, user.pk)
+    unit_ids = cache.get(key)
+    if unit_ids is None:
+        unit_ids = list(get_units(user).values_list('id', flat=True))
+        cache.set(key, unit_ids, VISIBLE_UNITS_TIMEOUT)
+    return unit_ids
+
+
+def invalidate_visible_units():
+    """Invalidate cached visible Unit ids of all users."""
+    try:
+        cache.incr(VISIBLE_UNITS_VERSION_KEY)
+    except ValueError:  # The key didn't exist
+        cache.set(VISIBLE_UNITS_VERSION_KEY, 1, None)
+
+
 def get_formulas(user, datalogger=None):
     formulas = _get_objects(Formula, user, datalogger=datalogger)
     formulas = formulas.filter(active=True)
@@ -125,8 +168,21 @@ def get_logs(user, datalogger=None):
     return _get_objects(Dataloggerlog, user, datalogger=datalogger)
 
 
-def get_data(user):
-    units = get_units(user)
+def get_data(user, resolution=None):
+    """
+    Return Data of Units user can view or, if resolution is given,
+    DataRollups of that resolution.
+    """
+    if user.is_authenticated() and user.is_staff:
+        # Staff's Units don't need the membership joins and the id list
+        # could be very long
+        units = get_units(user)
+    else:
+        units = get_visible_unit_ids(user)
+    if resolution:
+        return DataRollup.objects.filter(unit__in=units,
+                                         resolution=resolution)\
+            .order_by("-timestamp")
     return Data.objects.filter(unit__in=units).order_by("-timestamp")
 
 
@@ -203,9 +259,155 @@ def can_edit(user, instance, check_api_read_only=True):
     return False
 
 
+def _datalogger_ids(instances):
+    """Return ids of Dataloggers of Dataloggers, Units and Formulas."""
+    return set(instance.pk if isinstance(instance, Datalogger)
+               else instance.datalogger_id for instance in instances)
+
+
+def _active_datalogger_ids(instances):
+    ids = set(instance.datalogger_id for instance in instances
+              if isinstance(instance, (Unit, Formula)))
+    if not ids:
+        return set()
+    return set(Datalogger.objects.filter(id__in=ids, active=True)
+               .values_list('id', flat=True))
+
+
+def can_view_many(user, instances):
+    """
+    Bulk version of can_view(): return a list of booleans, one per instance,
+    with a constant number of queries.
+    """
+    instances = list(instances)
+    for instance in instances:
+        if not isinstance(instance, (Datalogger, Unit, Formula)):
+            raise ValueError(
+                    "instance must be either a Datalogger, Unit or Formula")
+    if not instances or not user.is_authenticated():
+        return [False] * len(instances)
+
+    active_ids = _active_datalogger_ids(instances)
+    if user.is_staff:
+        viewable_ids = None
+    else:
+        viewable_ids = set(Datalogger.objects.filter(
+            Q(viewers__id=user.id) | Q(admins__id=user.id) | Q(user=user) |
+            Q(organization__viewers__id=user.id) |
+            Q(organization__admins__id=user.id),
+            id__in=_datalogger_ids(instances),
+        ).values_list('id', flat=True))
+
+    result = []
+    for instance in instances:
+        if isinstance(instance, Datalogger):
+            datalogger_id = instance.pk
+            active = instance.active
+        else:
+            datalogger_id = instance.datalogger_id
+            active = datalogger_id in active_ids and instance.active
+        result.append(bool(active) and (viewable_ids is None or
+                                        datalogger_id in viewable_ids))
+    return result
+
+
+def can_edit_many(user, instances, check_api_read_only=True):
+    """
+    Bulk version of can_edit(): return a list of booleans, one per instance,
+    with a constant number of queries.
+    """
+    instances = list(instances)
+    for instance in instances:
+        _check_valid_model(instance)
+    if not instances or not user.is_authenticated():
+        return [False] * len(instances)
+
+    dataloggers = [i for i in instances if not isinstance(i, Grouplogger)]
+    active_ids = _active_datalogger_ids(dataloggers)
+    if user.is_staff:
+        editable_ids = grouplogger_ids = None
+    else:
+        editable_ids = set()
+        if dataloggers:
+            editable_ids = set(Datalogger.objects.filter(
+                Q(admins__id=user.id) | Q(organization__admins__id=user.id),
+                id__in=_datalogger_ids(dataloggers),
+            ).values_list('id', flat=True))
+        grouplogger_ids = set(i.pk for i in instances
+                              if isinstance(i, Grouplogger))
+        if grouplogger_ids:
+            grouplogger_ids = set(Grouplogger.objects.filter(
+                admins__id=user.id, id__in=grouplogger_ids,
+            ).values_list('id', flat=True))
+
+    result = []
+    for instance in instances:
+        if isinstance(instance, Formula):
+            result.append(False)  # TODO: see can_edit()
+            continue
+        if isinstance(instance, Grouplogger):
+            allowed_ids, id = grouplogger_ids, instance.pk
+            editable = instance.active
+        elif isinstance(instance, Datalogger):
+            allowed_ids, id = editable_ids, instance.pk
+            editable = instance.active
+        else:
+            allowed_ids, id = editable_ids, instance.datalogger_id
+            editable = id in active_ids and instance.active
+            if check_api_read_only:
+                editable = editable and not instance.api_read_only
+        result.append(bool(editable) and (allowed_ids is None or
+                                          id in allowed_ids))
+    return result
+
+
 def has_editable_dataloggers(user):
     dataloggers = get_dataloggers(user)
-    for dl in dataloggers:
-        if can_edit(user, dl):
-            return True
-    return False
+    return any(can_edit_many(user, dataloggers))
+
+
+# Fields, whose change affects the Units users can view
+VISIBILITY_FIELDS = {
+    Datalogger: ('active', 'organization_id'),
+    Unit: ('active', 'visibility', 'datalogger_id'),
+    User: ('is_staff', 'is_active'),
+}
+
+
+def _visibility_state(instance):
+    # Deferred fields are not loaded, they are missing from __dict__
+    return tuple(instance.__dict__.get(field, instance)
+                 for field in VISIBILITY_FIELDS[type(instance)])
+
+
+@receiver(post_init, sender=Datalogger)
+@receiver(post_init, sender=Unit)
+@receiver(post_init, sender=User)
+def remember_visibility_state(sender, instance, **kwargs):
+    instance._visibility_state = _visibility_state(instance)
+
+
+@receiver(post_save, sender=Datalogger)
+@receiver(post_save, sender=Unit)
+@receiver(post_save, sender=User)
+def visibility_saved(sender, instance, created, **kwargs):
+    # E.g. Datalogger is saved after every Datapost, usually nothing
+    # relevant has changed
+    state = _visibility_state(instance)
+    if created or state != instance._visibility_state:
+        invalidate_visible_units()
+    instance._visibility_state = state
+
+
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+@receiver(post_delete, sender=Datalogger)
+@receiver(post_delete, sender=Unit)
+@receiver(post_delete, sender=User)
+@receiver(m2m_changed, sender=Datalogger.admins.through)
+@receiver(m2m_changed, sender=Datalogger.viewers.through)
+@receiver(m2m_changed, sender=Organization.admins.through)
+@receiver(m2m_changed, sender=Organization.viewers.through)
+def visibility_changed(sender, **kwargs):
+    if kwargs.get('action', 'post_').startswith('post_'):
+        invalidate_visible_units()
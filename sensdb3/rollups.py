@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Maintain and query DataRollup objects, i.e. per Unit min/max/avg/count/
+first/last aggregates of valid Data in fixed time buckets.
+
+process_dataposts adds its bulk created Data with update_rollups(). Data
+saved or deleted one by one (API, admin, QuerySet.delete()) updates rollups
+through the signal receivers below, which Sensdb3Config.ready() connects.
+Data changed without signals (QuerySet.update(), bulk_create(), SQL) needs
+rebuild_rollups().
+"""
+import calendar
+import datetime
+
+import pytz
+from django.db import transaction
+from django.db.models import BooleanField, Value
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from sensdb3.models import Data, DataRollup, ROLLUP_RESOLUTIONS
+
+RESOLUTIONS = dict(ROLLUP_RESOLUTIONS)
+# Rebuild rollups in windows of this many seconds to limit memory usage.
+# Must be a multiple of every resolution.
+REBUILD_WINDOW = 30 * 24 * 60 * 60
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def get_resolution(name):
+    """
+    Return resolution in seconds for a resolution name (e.g. '1h') or None
+    if the name is empty or unknown.
+    """
+    return RESOLUTIONS.get(name)
+
+
+def get_resolution_name(resolution):
+    """Return name of a resolution given in seconds, e.g. 3600 -> '1h'."""
+    for name, seconds in ROLLUP_RESOLUTIONS:
+        if seconds == resolution:
+            return name
+    return None
+
+
+def bucket_start(timestamp, resolution):
+    """
+    Return the start time of the resolution seconds wide bucket, which
+    contains timezone aware timestamp.
+    """
+    seconds = calendar.timegm(timestamp.utctimetuple())
+    return EPOCH + datetime.timedelta(seconds=seconds - seconds % resolution)
+
+
+class RollupStats(object):
+    """Running aggregates of one bucket."""
+    __slots__ = ('count', 'total', 'min', 'max', 'first', 'firsttimestamp',
+                 'last', 'lasttimestamp')
+
+    def __init__(self, timestamp, value):
+        self.count = 1
+        self.total = value
+        self.min = self.max = self.first = self.last = value
+        self.firsttimestamp = self.lasttimestamp = timestamp
+
+    def add(self, timestamp, value):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if timestamp < self.firsttimestamp:
+            self.first, self.firsttimestamp = value, timestamp
+        if timestamp >= self.lasttimestamp:
+            self.last, self.lasttimestamp = value, timestamp
+
+    def merge_into(self, rollup):
+        """Add these aggregates to an existing DataRollup object."""
+        count = rollup.count + self.count
+        rollup.value = (rollup.value * rollup.count + self.total) / count
+        rollup.count = count
+        rollup.min = min(rollup.min, self.min)
+        rollup.max = max(rollup.max, self.max)
+        if self.firsttimestamp < rollup.firsttimestamp:
+            rollup.first = self.first
+            rollup.firsttimestamp = self.firsttimestamp
+        if self.lasttimestamp >= rollup.lasttimestamp:
+            rollup.last = self.last
+            rollup.lasttimestamp = self.lasttimestamp
+
+    def to_rollup(self, unit_id, resolution, timestamp):
+        return DataRollup(
+            unit_id=unit_id, resolution=resolution, timestamp=timestamp,
+            count=self.count, value=self.total / self.count,
+            min=self.min, max=self.max,
+            first=self.first, firsttimestamp=self.firsttimestamp,
+            last=self.last, lasttimestamp=self.lasttimestamp)
+
+
+def aggregate(rows, resolutions=None):
+    """
+    Aggregate (unit_id, timestamp, value) rows into buckets.
+
+    Returns:
+        dict: (unit_id, resolution, bucket start) -> RollupStats
+    """
+    if resolutions is None:
+        resolutions = RESOLUTIONS.values()
+    buckets = {}
+    for unit_id, timestamp, value in rows:
+        for resolution in resolutions:
+            key = (unit_id, resolution, bucket_start(timestamp, resolution))
+            stats = buckets.get(key)
+            if stats is None:
+                buckets[key] = RollupStats(timestamp, value)
+            else:
+                stats.add(timestamp, value)
+    return buckets
+
+
+def update_rollups(dataitems, resolutions=None):
+    """
+    Add new Data objects to rollups. Existing buckets are locked and
+    updated, new buckets are created with one bulk_create().
+    Invalid Data and Data without timestamp are ignored.
+    """
+    rows = [(d.unit_id, d.timestamp, d.value) for d in dataitems
+            if d.valid and d.timestamp is not None]
+    if not rows:
+        return 0
+    buckets = aggregate(rows, resolutions)
+    unit_ids = set(key[0] for key in buckets)
+    new_rollups = []
+    with transaction.atomic():
+        for resolution in set(key[1] for key in buckets):
+            timestamps = [key[2] for key in buckets if key[1] == resolution]
+            existing = DataRollup.objects.select_for_update().filter(
+                unit_id__in=unit_ids, resolution=resolution,
+                timestamp__gte=min(timestamps),
+                timestamp__lte=max(timestamps))
+            for rollup in existing:
+                key = (rollup.unit_id, resolution, rollup.timestamp)
+                stats = buckets.pop(key, None)
+                if stats is not None:
+                    stats.merge_into(rollup)
+                    rollup.save()
+        for (unit_id, resolution, timestamp), stats in buckets.items():
+            new_rollups.append(stats.to_rollup(unit_id, resolution,
+                                               timestamp))
+        DataRollup.objects.bulk_create(new_rollups, batch_size=1000)
+    return len(rows)
+
+
+def rebuild_rollups(unit, st=None, et=None, resolutions=None):
+    """
+    Recompute Unit's rollups from Data between st and et. The time range is
+    extended to whole buckets of the widest resolution. If st or et is
+    None, Unit's first or last Data timestamp is used.
+
+    Returns:
+        int: number of created DataRollup objects
+    """
+    if resolutions is None:
+        resolutions = list(RESOLUTIONS.values())
+    data = Data.objects.filter(unit=unit, valid=True,
+                               timestamp__isnull=False)
+    if st is None or et is None:
+        timestamps = data.order_by('timestamp').values_list('timestamp',
+                                                            flat=True)
+        st = st or timestamps.first()
+        et = et or timestamps.last()
+        if st is None or et is None:
+            return 0  # No data at all
+    widest = max(resolutions)
+    st = bucket_start(st, widest)
+    et = bucket_start(et, widest) + datetime.timedelta(seconds=widest)
+    count = 0
+    window = datetime.timedelta(seconds=REBUILD_WINDOW)
+    while st < et:
+        window_end = min(st + window, et)
+        rows = data.filter(timestamp__gte=st, timestamp__lt=window_end)\
+            .order_by('timestamp').values_list('unit_id', 'timestamp',
+                                               'value')
+        buckets = aggregate(rows.iterator(), resolutions)
+        with transaction.atomic():
+            DataRollup.objects.filter(
+                unit=unit, resolution__in=resolutions,
+                timestamp__gte=st, timestamp__lt=window_end).delete()
+            DataRollup.objects.bulk_create(
+                [stats.to_rollup(*key) for key, stats in buckets.items()],
+                batch_size=1000)
+        count += len(buckets)
+        st = window_end
+    return count
+
+
+def get_rollup_data(unit, st, et, resolution):
+    """
+    Return Unit's rollups, whose bucket overlaps st-et, as a QuerySet of
+    dicts, which have the same keys as get_unit_data() returns and also
+    min, max and count of the bucket. st or et may be None for an open
+    time range.
+    """
+    data = DataRollup.objects.filter(unit=unit, resolution=resolution)
+    if st is not None:
+        data = data.filter(timestamp__gte=bucket_start(st, resolution))
+    if et is not None:
+        data = data.filter(timestamp__lte=et)
+    data = data.order_by('timestamp')
+    # Rollups contain only valid Data
+    data = data.annotate(valid=Value(True, output_field=BooleanField()))
+    data = data.values('id', 'value', 'timestamp', 'valid', 'min', 'max',
+                       'count')
+    return data
+
+
+# unit_id -> starts of the widest buckets, which must be rebuilt when the
+# transaction commits
+_pending_rebuilds = {}
+
+
+def _rebuild_pending():
+    while _pending_rebuilds:
+        unit_id, days = _pending_rebuilds.popitem()
+        for day in sorted(days):
+            rebuild_rollups(unit_id, day, day)
+
+
+def rebuild_later(unit_id, timestamps):
+    """
+    Rebuild Unit's buckets containing timestamps when the transaction
+    commits. Deleting many Data objects in one transaction rebuilds every
+    bucket once.
+    """
+    widest = max(RESOLUTIONS.values())
+    days = _pending_rebuilds.setdefault(unit_id, set())
+    days.update(bucket_start(t, widest) for t in timestamps if t is not None)
+    transaction.on_commit(_rebuild_pending)
+
+
+@receiver(pre_save, sender=Data)
+def remember_old_timestamp(sender, instance, raw=False, **kwargs):
+    # The bucket of the old timestamp changes, if Data is moved
+    instance._rollup_old_timestamp = None
+    if instance.pk is not None and not raw:
+        instance._rollup_old_timestamp = Data.objects.filter(
+            pk=instance.pk).values_list('timestamp', flat=True).first()
+
+
+@receiver(post_save, sender=Data)
+def data_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        update_rollups([instance])
+    elif instance.unit_id is not None:
+        rebuild_later(instance.unit_id, [
+            instance.timestamp,
+            getattr(instance, '_rollup_old_timestamp', None)])
+
+
+@receiver(post_delete, sender=Data)
+def data_deleted(sender, instance, **kwargs):
+    if instance.unit_id is not None:
+        rebuild_later(instance.unit_id, [instance.timestamp])
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import random
+import time
+
+import pytz
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from .create_data_index import get_index_sql
+
+TABLE = 'sensdb3_data_benchmark'
+START_TIME = datetime.datetime(2010, 1, 1, tzinfo=pytz.utc)
+# Insert synthetic rows in chunks of this size
+CHUNK_SIZE = 1000000
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', action='store', dest='rows', type=int,
+                            default=50000000,
+                            help=u'Number of synthetic Data rows')
+        parser.add_argument('--units', action='store', dest='units',
+                            type=int, default=100,
+                            help=u'Number of synthetic Units')
+        parser.add_argument('--queries', action='store', dest='queries',
+                            type=int, default=200,
+                            help=u'Number of range queries to run')
+        parser.add_argument('--hours', action='store', dest='hours',
+                            type=int, default=24,
+                            help=u'Length of queried time range in hours')
+        parser.add_argument('--keep', action='store_true', dest='keep',
+                            help=u"Don't drop the synthetic table")
+
+    args = ''
+    help = ("Benchmark Data range scans (unit + time range) with and without "
+            "the composite (unit_id, timestamp) index on a synthetic table "
+            "'{}'. Data is stored once per minute for every Unit.".format(
+                TABLE))
+
+    def handle(self, *args, **options):
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            raise CommandError('Only PostgreSQL and SQLite are supported.')
+        self.rows = options['rows']
+        self.units = options['units']
+        starttime = time.time()
+        with connection.cursor() as cursor:
+            self.create_table(cursor)
+            self.stdout.write('Created {} rows in {:.1f} seconds.'.format(
+                self.rows, time.time() - starttime))
+            queries = self.get_queries(options['queries'], options['hours'])
+            before = self.run_queries(cursor, queries)
+            self.report('timestamp index only', before)
+            starttime = time.time()
+            cursor.execute(get_index_sql(concurrently=False, table=TABLE,
+                                         name=TABLE + '_unit_ts'))
+            cursor.execute('ANALYZE {}'.format(TABLE))
+            self.stdout.write('Created (unit_id, timestamp) index in {:.1f} '
+                              'seconds.'.format(time.time() - starttime))
+            after = self.run_queries(cursor, queries)
+            self.report('(unit_id, timestamp) index', after)
+            self.stdout.write(self.style.SUCCESS(
+                'Median latency {:.2f} ms -> {:.2f} ms ({:.1f}x)'.format(
+                    percentile(before, 50), percentile(after, 50),
+                    percentile(before, 50) / max(percentile(after, 50),
+                                                 0.001))))
+            if not options['keep']:
+                cursor.execute('DROP TABLE {}'.format(TABLE))
+
+    def create_table(self, cursor):
+        """
+        Create a table like sensdb3_data, which has separate unit_id and
+        timestamp indexes only, and fill it with synthetic data.
+        """
+        cursor.execute('DROP TABLE IF EXISTS {}'.format(TABLE))
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                'CREATE TABLE {} (id serial PRIMARY KEY, '
+                'unit_id integer NOT NULL, value double precision NOT NULL, '
+                'valid boolean NOT NULL, timestamp timestamp with time zone '
+                'NULL)'.format(TABLE))
+            insert = (
+                'INSERT INTO {0} (unit_id, value, valid, timestamp) '
+                'SELECT i %% {1} + 1, random() * 100, true, '
+                '%s + (i / {1}) * interval \'1 minute\' '
+                'FROM generate_series(%s, %s) AS i'.format(TABLE, self.units))
+        else:
+            cursor.execute(
+                'CREATE TABLE {} (id integer PRIMARY KEY AUTOINCREMENT, '
+                'unit_id integer NOT NULL, value real NOT NULL, '
+                'valid bool NOT NULL, timestamp datetime NULL)'.format(TABLE))
+            insert = (
+                'WITH RECURSIVE seq(i) AS (SELECT %s UNION ALL '
+                'SELECT i + 1 FROM seq WHERE i < %s) '
+                'INSERT INTO {0} (unit_id, value, valid, timestamp) '
+                'SELECT i %% {1} + 1, abs(random() %% 10000) / 100.0, 1, '
+                'datetime(%s, \'+\' || (i / {1}) || \' minutes\') '
+                'FROM seq'.format(TABLE, self.units))
+        start = connection.ops.adapt_datetimefield_value(START_TIME)
+        for first in range(0, self.rows, CHUNK_SIZE):
+            last = min(first + CHUNK_SIZE, self.rows) - 1
+            if connection.vendor == 'postgresql':
+                cursor.execute(insert, [start, first, last])
+            else:
+                cursor.execute(insert, [first, last, start])
+        cursor.execute('CREATE INDEX {0}_unit_id ON {0} (unit_id)'.format(
+            TABLE))
+        cursor.execute('CREATE INDEX {0}_timestamp ON {0} (timestamp)'.format(
+            TABLE))
+        cursor.execute('ANALYZE {}'.format(TABLE))
+
+    def get_queries(self, count, hours):
+        """Return random (unit_id, start, end) tuples."""
+        rnd = random.Random(count)
+        minutes = self.rows // self.units
+        queries = []
+        for _ in range(count):
+            start = START_TIME + datetime.timedelta(
+                minutes=rnd.randint(0, max(minutes - hours * 60, 0)))
+            end = start + datetime.timedelta(hours=hours)
+            queries.append((rnd.randint(1, self.units),
+                            connection.ops.adapt_datetimefield_value(start),
+                            connection.ops.adapt_datetimefield_value(end)))
+        return queries
+
+    def run_queries(self, cursor, queries):
+        """Run queries the same way as get_unit_data() and return latencies
+        in milliseconds."""
+        sql = ('SELECT id, value, timestamp, valid FROM {} '
+               'WHERE unit_id = %s AND timestamp >= %s AND timestamp <= %s '
+               'AND valid ORDER BY timestamp'.format(TABLE))
+        latencies = []
+        for params in queries:
+            t = time.time()
+            cursor.execute(sql, params)
+            cursor.fetchall()
+            latencies.append((time.time() - t) * 1000)
+        return latencies
+
+    def report(self, title, latencies):
+        self.stdout.write(
+            '{:<28} median {:8.2f} ms  p95 {:8.2f} ms  max {:8.2f} ms'.format(
+                title, percentile(latencies, 50), percentile(latencies, 95),
+                max(latencies)))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import random
+import time
+
+import pytz
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from sensdb3.models import Data
+from sensdb_api.v1 import serializers
+
+START_TIME = datetime.datetime(2010, 1, 1, tzinfo=pytz.utc)
+
+
+def make_rows(rows, units, seed=1):
+    """Return synthetic values_list(*FastDataSerializer.FIELDS) tuples."""
+    rnd = random.Random(seed)
+    return [(i + 1, START_TIME + datetime.timedelta(seconds=i // units * 60),
+             rnd.uniform(-10, 100), i % units + 1)
+            for i in range(rows)]
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', action='store', dest='rows', type=int,
+                            default=100000,
+                            help=u'Number of synthetic Data rows')
+        parser.add_argument('--units', action='store', dest='units',
+                            type=int, default=10,
+                            help=u'Number of distinct Units in the rows')
+        parser.add_argument('--page-size', action='store', dest='page_size',
+                            type=int, default=1000,
+                            help=u'Rows per serialized page, like '
+                                 u'DATA_PAGE_SIZE of the v1 data endpoints')
+
+    args = ''
+    help = ('Benchmark serializing and rendering Data pages of the v1 data '
+            'endpoints with DataSerializer (model instances, unit URL '
+            'reversed per row) and FastDataSerializer (values_list() tuples, '
+            'unit URL reversed once per Unit) on synthetic in-memory rows. '
+            'Database queries are not included.')
+
+    def handle(self, *args, **options):
+        rows = make_rows(options['rows'], options['units'])
+        page_size = options['page_size']
+        pages = [rows[i:i + page_size]
+                 for i in range(0, len(rows), page_size)]
+        # Unit URLs are absolute, so the request needs an allowed host
+        hosts = [h for h in settings.ALLOWED_HOSTS if '*' not in h]
+        factory = APIRequestFactory(
+            HTTP_HOST=hosts[0].lstrip('.') if hosts else 'localhost')
+
+        def serialize_models(page, request):
+            # Model instances are what the ORM would build from the rows
+            instances = [Data(id=id, timestamp=timestamp, value=value,
+                              unit_id=unit_id)
+                         for id, timestamp, value, unit_id in page]
+            return serializers.DataSerializer(
+                instances, many=True, context={'request': request}).data
+
+        def serialize_tuples(page, request):
+            return serializers.FastDataSerializer(
+                page, many=True, context={'request': request}).data
+
+        timings = []
+        for name, func, url in [
+                ('DataSerializer', serialize_models, '/api/v1/data/'),
+                ('FastDataSerializer', serialize_tuples, '/api/v1/data/'),
+                ('FastDataSerializer compact', serialize_tuples,
+                 '/api/v1/data/?compact=true')]:
+            renderer = JSONRenderer()
+            starttime = time.time()
+            for page in pages:
+                # A new request per page, like the API does
+                request = Request(factory.get(url))
+                renderer.render({'results': func(page, request)})
+            timing = time.time() - starttime
+            timings.append(timing)
+            self.stdout.write('{:<28} {:8.3f} s  {:10.0f} rows/s'.format(
+                name, timing, len(rows) / max(timing, 1e-9)))
+        self.stdout.write(self.style.SUCCESS(
+            'FastDataSerializer is {:.1f}x faster.'.format(
+                timings[0] / max(timings[1], 1e-9))))
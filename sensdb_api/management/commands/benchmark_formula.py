@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import random
+import time
+
+import pytz
+from django.core.management.base import BaseCommand, CommandError
+
+from sensdb3 import datatools
+from sensdb3.models import Datalogger, Formula, Timeformula
+
+START_TIME = datetime.datetime(2010, 1, 1, tzinfo=pytz.utc)
+
+
+def make_datalist(points, step, seed):
+    """Return synthetic data dicts like get_unit_data() returns."""
+    rnd = random.Random(seed)
+    return [{'id': i, 'value': rnd.uniform(-10, 100),
+             'timestamp': START_TIME + datetime.timedelta(seconds=i * step),
+             'valid': rnd.random() > 0.01}
+            for i in range(points)]
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--points', action='store', dest='points',
+                            type=int, default=1000000,
+                            help=u'Number of points per Unit')
+        parser.add_argument('--parameters', action='store',
+                            dest='parameters',
+                            default='c1 * 0.5 + math.sqrt(c2) - 3',
+                            help=u'Formula expression (c1 and c2 are set)')
+
+    args = ''
+    help = ('Benchmark evaluating a polynomial Formula with two Units and a '
+            'Timeformula row by row and vectorized with NumPy on synthetic '
+            'in-memory data. Database queries are not included.')
+
+    def handle(self, *args, **options):
+        if datatools.np is None:
+            raise CommandError('NumPy is not installed.')
+        points = options['points']
+        self.stdout.write('Creating {} synthetic points per Unit...'.format(
+            points))
+        datalists = datatools.OrderedDict([
+            ('c1', make_datalist(points, 60, 1)),
+            ('c2', make_datalist(points, 60, 2)),
+        ])
+        formula = Formula(id=0, datalogger=Datalogger(idcode='benchmark'),
+                          type='polynomial',
+                          parameters=options['parameters'], multiplier=1.5)
+        timeformulas = [Timeformula(
+            formula=formula, parameters=options['parameters'] + ' + 1',
+            multiplier=2.0,
+            starttime=START_TIME + datetime.timedelta(minutes=points // 2))]
+
+        results = {}
+        timings = {}
+        for name, func in [
+                ('row by row', datatools._evaluate_polynomial_loop),
+                ('vectorized', datatools._evaluate_polynomial_vectorized)]:
+            starttime = time.time()
+            results[name] = func(formula, datalists, timeformulas)
+            timings[name] = time.time() - starttime
+            if results[name] is None:
+                raise CommandError('Expression can not be vectorized.')
+            self.stdout.write('{:<12} {:8.3f} s  {:10.0f} points/s'.format(
+                name, timings[name], points / max(timings[name], 1e-9)))
+
+        loop, vectorized = results['row by row'], results['vectorized']
+        same = len(loop) == len(vectorized) and all(
+            a['timestamp'] == b['timestamp'] and
+            (a['value'] is None and b['value'] is None or
+             a['value'] is not None and b['value'] is not None and
+             abs(a['value'] - b['value']) <= 1e-9 * max(1.0, abs(a['value'])))
+            for a, b in zip(loop, vectorized))
+        if not same:
+            raise CommandError('Results differ!')
+        self.stdout.write(self.style.SUCCESS(
+            'Results are identical, vectorized is {:.1f}x faster.'.format(
+                timings['row by row'] / max(timings['vectorized'], 1e-9))))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+import logging
+log = logging.getLogger('datapost')
+
+# Same name as in sensdb3/migrations/0002_data_unit_timestamp_index.py
+INDEX_NAME = 'sensdb3_data_unit_id_timestamp_idx'
+
+
+def get_index_sql(concurrently=True, covering=True, table='sensdb3_data',
+                  name=INDEX_NAME):
+    """
+    Return CREATE INDEX statement for Data's (unit_id, timestamp) index.
+    CONCURRENTLY and INCLUDE are used only on PostgreSQL (INCLUDE requires
+    PostgreSQL 11 or newer).
+    """
+    create = 'CREATE INDEX'
+    include = ''
+    if connection.vendor == 'postgresql':
+        if concurrently:
+            create = 'CREATE INDEX CONCURRENTLY'
+        if covering and connection.pg_version >= 110000:
+            include = ' INCLUDE (value, valid)'
+    return '{} IF NOT EXISTS {} ON {} (unit_id, timestamp){}'.format(
+        create, name, table, include)
+
+
+def drop_invalid_index(cursor, name=INDEX_NAME):
+    """
+    An interrupted CREATE INDEX CONCURRENTLY leaves an invalid index behind,
+    which must be dropped before building it again.
+    """
+    cursor.execute(
+        'SELECT NOT i.indisvalid FROM pg_index i '
+        'JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s',
+        [name])
+    row = cursor.fetchone()
+    if row and row[0]:
+        cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
+        return True
+    return False
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--no-covering',
+                            action='store_false',
+                            dest='covering',
+                            help=u"Don't INCLUDE value and valid columns in "
+                                 u"the index (PostgreSQL 11+ only)")
+        parser.add_argument('--sql',
+                            action='store_true',
+                            dest='sql',
+                            help=u'Print the SQL statement only')
+
+    args = ''
+    help = ("Create Data's (unit_id, timestamp) index without locking the "
+            "table for writes (CREATE INDEX CONCURRENTLY on PostgreSQL). "
+            "Run this before `manage.py migrate` on a large live database.")
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        sql = get_index_sql(concurrently=True, covering=options['covering'])
+        if options['sql']:
+            self.stdout.write(sql)
+            return
+        if connection.vendor != 'postgresql' and verbosity > 0:
+            self.stdout.write(self.style.WARNING(
+                'Warning: {} does not support building indexes concurrently, '
+                'the table is locked until the index is ready.'.format(
+                    connection.vendor)))
+        starttime = time.time()
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                if drop_invalid_index(cursor) and verbosity > 0:
+                    self.stdout.write(self.style.WARNING(
+                        'Dropped invalid index {}.'.format(INDEX_NAME)))
+            cursor.execute(sql)
+        msg = u'Index {} is ready ({:.2f} seconds).'.format(
+            INDEX_NAME, time.time() - starttime)
+        log.info(msg)
+        if verbosity > 0:
+            self.stdout.write(self.style.SUCCESS(msg))
@@ -1,31 +1,197 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import functools
+import multiprocessing
+import os
+import random
+import socket
 import time
+import uuid
+import zlib
 import pytz
 import dateutil.parser
 import re
 from dateutil import tz
 import json
 
-from django.db import transaction
-from django.db.models import Count
-from django.core.management.base import BaseCommand
+from django import db
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.utils import timezone
+from django.core.management.base import BaseCommand, CommandError
 
-from sensdb3.models import Datalogger, Data, Unit
+from sensdb3.models import Datalogger, Data
 from sensdb3.models import update_grouplogger_aggregates
+from sensdb3.models import update_unit_last_values
 from sensdb3.models import Datapost
-from .tools import check_alerts
+from sensdb3.dataversions import bump_data_versions
+from sensdb3.rollups import update_rollups
+from .tools import check_alerts_many
 from .tools import apply_filter
+from .tools import unit_cache
+from .tools import UNIT_CACHE_SIZE
 
 import logging
 log = logging.getLogger('datapost')
 
+# Max number of Data rows in one INSERT statement
+BULK_CREATE_BATCH_SIZE = 1000
+# Seconds a worker may hold Dataloggers claimed without SKIP LOCKED, a
+# batch must be processed in this time
+DATAPOST_CLAIM_LEASE = getattr(settings, 'DATAPOST_CLAIM_LEASE', 300)
+# Default --batchsize of --workers
+WORKER_BATCH_SIZE = 500
+# Attempts to process a leased batch, if SQLite database is locked
+LOCKED_RETRIES = 10
+# Status of Dataposts, which couldn't be parsed
+FAILED_STATUS = -2
+
+
+class DataBatch(object):
+    """
+    Collects unsaved Data objects and processed Dataposts of one or more
+    Dataposts, so that they can be written into the database at once.
+    """
+
+    def __init__(self, known_last_values=None):
+        self.dataitems = []
+        self.dataposts = []
+        # Dataposts, whose parser failed
+        self.failed = []
+        self.dataloggers = {}
+        # Latest value of each Unit, unit.id -> (timestamp, value)
+        self.last_values = {}
+        # Latest values of earlier, committed batches (see LastValues)
+        self.known_last_values = known_last_values
+
+    def add_data(self, datalogger, dataitem):
+        self.dataloggers[datalogger.pk] = datalogger
+        self.dataitems.append(dataitem)
+        self.last_values[dataitem.unit.pk] = (dataitem.timestamp,
+                                              dataitem.value)
+
+    def add_datapost(self, datapost, datalogger, status):
+        self.dataloggers[datalogger.pk] = datalogger
+        datapost.status = status
+        datapost.datalogger = datalogger
+        self.dataposts.append(datapost)
+
+    def add_failed(self, datapost):
+        datapost.status = FAILED_STATUS
+        self.failed.append(datapost)
+
+    def mark(self):
+        """Return the current state, which rollback() can restore."""
+        return (len(self.dataitems), len(self.dataposts),
+                dict(self.dataloggers), dict(self.last_values))
+
+    def rollback(self, mark):
+        """Discard everything added after mark() was called."""
+        dataitems, dataposts, dataloggers, last_values = mark
+        del self.dataitems[dataitems:]
+        del self.dataposts[dataposts:]
+        self.dataloggers = dataloggers
+        self.last_values = last_values
+
+    def get_last_value(self, unit):
+        """
+        Return (timestamp, value) of Unit's latest Data or None, taking into
+        account also Data added to this batch but not yet saved.
+        """
+        if unit.pk not in self.last_values:
+            if (self.known_last_values is not None and
+                    unit.pk in self.known_last_values):
+                self.last_values[unit.pk] = self.known_last_values[unit.pk]
+            else:
+                last_data = Data.objects.filter(unit=unit)\
+                    .order_by('-timestamp')\
+                    .values_list('timestamp', 'value')[:1]
+                self.last_values[unit.pk] = last_data[0] if last_data \
+                    else None
+        return self.last_values[unit.pk]
+
+    def write(self):
+        """
+        Save all collected Data with bulk_create(), update rollups, Units'
+        last values and Dataposts' status and then check alerts and update
+        aggregates once per Datalogger.
+
+        Returns:
+            int: number of saved Data objects
+        """
+        Data.objects.bulk_create(self.dataitems,
+                                 batch_size=BULK_CREATE_BATCH_SIZE)
+        update_rollups(self.dataitems)
+        update_unit_last_values(self.dataitems)
+        updates = {}
+        for datapost in self.dataposts:
+            key = (datapost.status, datapost.datalogger.pk)
+            updates.setdefault(key, []).append(datapost.pk)
+        for (status, datalogger_id), pks in updates.items():
+            Datapost.objects.filter(pk__in=pks).update(
+                status=status, datalogger=self.dataloggers[datalogger_id])
+        if self.failed:
+            Datapost.objects.filter(pk__in=[d.pk for d in self.failed])\
+                .update(status=FAILED_STATUS)
+        dataitems_by_logger = {}
+        for dataitem in self.dataitems:
+            datalogger_id = dataitem.unit.datalogger_id
+            dataitems_by_logger.setdefault(datalogger_id, []).append(dataitem)
+        dataposts_by_logger = {}
+        for datapost in self.dataposts:
+            datalogger_id = datapost.datalogger.pk
+            dataposts_by_logger.setdefault(datalogger_id, []).append(datapost)
+        for datalogger_id, datalogger in self.dataloggers.items():
+            dataitems = dataitems_by_logger.get(datalogger_id, [])
+            dataposts = dataposts_by_logger.get(datalogger_id, [])
+            check_alerts_many(datalogger, dataitems)
+            timestamps = [d.timestamp for d in dataitems
+                          if d.timestamp is not None]
+            datalogger.update_aggregates(
+                datapostcount=len(dataposts),
+                lastdatapost=max([d.created for d in dataposts] or [None]),
+                measuringcount=len(dataitems),
+                firstmeasuring=min(timestamps) if timestamps else None,
+                lastmeasuring=max(timestamps) if timestamps else None,
+            )
+            update_grouplogger_aggregates(datalogger)
+        if self.dataitems:
+            # Invalidate cached API responses of these Units when the new
+            # Data is visible to other connections
+            unit_ids = [d.unit_id for d in self.dataitems]
+            datalogger_ids = list(dataitems_by_logger)
+            transaction.on_commit(
+                lambda: bump_data_versions(unit_ids, datalogger_ids))
+        return len(self.dataitems)
+
 
 def process_datapost_sensdb(datapost, verbosity=0):
     """
     Process one data.Datapost record and insert values into the database.
     Update also Datalogger's aggregate fields.
+    """
+    batch = DataBatch()
+    success = parse_datapost_sensdb(datapost, batch, verbosity)
+    batch.write()
+    return success
+
+
+def process_datapost_espeasy(datapost, verbosity=0):
+    """
+    Process one data.Datapost record and insert values into the database.
+    Update also Datalogger's aggregate fields.
+    """
+    batch = DataBatch()
+    success = parse_datapost_espeasy(datapost, batch, verbosity)
+    batch.write()
+    return success
+
+
+def parse_datapost_sensdb(datapost, batch, verbosity=0):
+    """
+    Parse one data.Datapost record and add its values to a DataBatch.
     E.g.
     SERVER,2014-05-13T01:30:01Z,pg_database_size=156517176,datalogger_objects=8,measuring_objects=136020,data_objects=273365
     """
@@ -54,6 +220,9 @@ def process_datapost_sensdb(datapost, verbosity=0):
         datalogger = Datalogger.objects.get(idcode=idcode)
     try:
         logger_timezone = pytz.timezone(datalogger.timezone)
+        # Parse all lines first to get all Units with one query
+        rows = []
+        uniquenames = set()
         for line in lines:  # loop all "lines" (originally separated by '*')
             line = line.split('*')[0]
             if line.strip() == '':
@@ -80,38 +249,28 @@ def process_datapost_sensdb(datapost, verbosity=0):
             if utctime.tzinfo is None:
                 from_zone = tz.gettz('UTC')
                 utctime = utctime.replace(tzinfo=from_zone)
+            values = []
             try:
                 for sensor in t:
                     if sensor.find("=") < 0:
                         continue
                     key, val = sensor.split('=')
                     val = float(val)
-                    try:
-                        unit = Unit.objects.filter(
-                            datalogger=datalogger).filter(uniquename=key)
-                        if unit:
-                            unit = unit[0]
-                        else:
-                            unit = Unit(uniquename=key,
-                                        datalogger=datalogger, name=key)
-                            unit.save()
-                    except Unit.DoesNotExist:
-                        print("NO UNIT")
-                        pass
-                    dataitem = Data(unit=unit, value=val, datapost=datapost, timestamp=utctime)
-                    # Make data invalid if it is below or exceeds filter limits
-                    dataitem.valid = apply_filter(unit, val)
-                    dataitem.save()
-                    check_alerts(datalogger, dataitem)
+                    values.append((key, val))
+                    uniquenames.add(key)
             except ValueError as err:
                 print(err)
                 raise
-        datapost.status = 1
-        datapost.datalogger = datalogger
-        datapost.save()
-        datalogger.set_aggregates()
-        datalogger.save()
-        update_grouplogger_aggregates(datalogger)
+            rows.append((utctime, values))
+        units, created = unit_cache.get_many(datalogger, uniquenames)
+        for utctime, values in rows:
+            for key, val in values:
+                unit = units[key]
+                dataitem = Data(unit=unit, value=val, datapost=datapost, timestamp=utctime)
+                # Make data invalid if it is below or exceeds filter limits
+                dataitem.valid = apply_filter(unit, val)
+                batch.add_data(datalogger, dataitem)
+        batch.add_datapost(datapost, datalogger, 1)
     except Exception as err:
         print("DATALINE", line)
         print(str(err))
@@ -119,42 +278,40 @@ def process_datapost_sensdb(datapost, verbosity=0):
     return True
 
 
-def process_datapost_espeasy(datapost, verbosity=0):
+def add_espeasy_values(datapost, batch, datalogger, sensor, data,
+                       timestamp):
     """
-    Process one data.Datapost record and insert values into the database.
-    Update also Datalogger's aggregate fields.
-    {"data": "Temperature=21.75", "idcode": "logger_idcode", "sensor": "outside_temp", "id": "0"}
+    Add values of one ESPEASY reading ("Temperature=21.75,Humidity=40") of
+    sensor to a DataBatch, if they differ enough from Units' last values.
+
+    Returns:
+        bool: True if some value was added
     """
-    if datapost.protocol != 'ESPEASY':  # process only ESPEASY Dataposts
-        return False
-    all_data = json.loads(datapost.get_data())
-    data = all_data.get('data')
-    idcode = all_data.get('idcode')
-    sensor = all_data.get('sensor')
-    # Remove newline characters, trailing asterisk and split to lines
-    datalogger = Datalogger.objects.get(idcode=idcode)
     # Some reasonable(?) defaults
     MIN_TIME = 30
     MAX_TIME = 60 * 30
     # MAX_TIME = 60 * 10
     MIN_CHANGE = 1.0
-    datapost_has_saved_data = False
+    has_saved_data = False
     try:
+        values = []
         for keyval in data.split(','):
             if keyval.find("=") < 0:
                 continue
             key, val = keyval.split('=')
             key = '{}_{}'.format(sensor, key)
             val = float(val)
-            unit, created = Unit.objects.get_or_create(datalogger=datalogger, uniquename=key)
-            if created:
-                unit.name = key
-                unit.save()
-                print('created {}'.format(unit))
-            last_data = Data.objects.filter(unit=unit).order_by('-timestamp')
-            if last_data.count() > 0:
-                last_val = last_data[0].value
-                last_age = (datapost.created - last_data[0].timestamp).total_seconds()
+            values.append((key, val))
+        units, created = unit_cache.get_many(datalogger,
+                                             [key for key, val in values])
+        for unit in created:
+            print('created {}'.format(unit))
+        for key, val in values:
+            unit = units[key]
+            last_data = batch.get_last_value(unit)
+            if last_data is not None:
+                last_timestamp, last_val = last_data
+                last_age = (timestamp - last_timestamp).total_seconds()
             else:
                 last_val = -9999999999
                 last_age = 9999999999
@@ -167,33 +324,181 @@ def process_datapost_espeasy(datapost, verbosity=0):
                     (last_age >= min_time and abs(last_val - val) >= min_change)
                   or last_age >= max_time
             ):
-                dataitem = Data(unit=unit, value=val, datapost=datapost, timestamp=datapost.created)
+                dataitem = Data(unit=unit, value=val, datapost=datapost, timestamp=timestamp)
                 # Make data invalid if it is below or exceeds filter limits
                 dataitem.valid = apply_filter(unit, val)
-                dataitem.save()
-                datapost_has_saved_data = True
-                check_alerts(datalogger, dataitem)
-                # print('SAVED     {} {} {} {}'.format(last_age, last_val, val, key))
+                batch.add_data(datalogger, dataitem)
+                has_saved_data = True
+                # print('SAVED     {} {} {} {}'.format(last_age, last_val, val, key))
             else:
                 pass
-                # print('NOT SAVED {} {} {} {}'.format(last_age, last_val, val, key))
+                # print('NOT SAVED {} {} {} {}'.format(last_age, last_val, val, key))
     except ValueError as err:
         print(err)
         raise
-    if datapost_has_saved_data:
-        datapost.status = 1
+    return has_saved_data
+
+
+def parse_datapost_espeasy(datapost, batch, verbosity=0):
+    """
+    Parse one data.Datapost record and add its values to a DataBatch.
+    {"data": "Temperature=21.75", "idcode": "logger_idcode", "sensor": "outside_temp", "id": "0"}
+    """
+    if datapost.protocol != 'ESPEASY':  # process only ESPEASY Dataposts
+        return False
+    all_data = json.loads(datapost.get_data())
+    data = all_data.get('data')
+    idcode = all_data.get('idcode')
+    sensor = all_data.get('sensor')
+    # Remove newline characters, trailing asterisk and split to lines
+    datalogger = Datalogger.objects.get(idcode=idcode)
+    if add_espeasy_values(datapost, batch, datalogger, sensor, data,
+                          datapost.created):
+        status = 1
     else:
-        datapost.status = 3
-    datapost.datalogger = datalogger
-    datapost.save()
-    datalogger.set_aggregates()
-    datalogger.save()
-    update_grouplogger_aggregates(datalogger)
+        status = 3
+    batch.add_datapost(datapost, datalogger, status)
     return True
 
 
+def parse_datapost_espeasy_bulk(datapost, batch, verbosity=0):
+    """
+    Parse one data.Datapost record of the bulk endpoint and add its values
+    to a DataBatch. Every line is one ESPEASY reading of the Datapost's
+    Datalogger, timestamp is optional (Datapost's creation time is used):
+    {"sensor": "outside_temp", "data": "Temperature=21.75", "timestamp": "2017-07-11T08:00:00Z"}
+    """
+    if datapost.protocol != 'ESPEASY_BULK':
+        return False
+    datalogger = Datalogger.objects.get(idcode=datapost.idcode)
+    logger_timezone = pytz.timezone(datalogger.timezone)
+    has_saved_data = False
+    for line in datapost.get_data().splitlines():
+        if not line.strip():
+            continue
+        reading = json.loads(line)
+        timestamp = datapost.created
+        if reading.get('timestamp'):
+            timestamp = dateutil.parser.parse(reading['timestamp'])
+            if timestamp.tzinfo is None:
+                if datalogger.in_utc:
+                    timestamp = pytz.utc.localize(timestamp)
+                else:
+                    timestamp = logger_timezone.localize(timestamp)
+        if add_espeasy_values(datapost, batch, datalogger,
+                              reading.get('sensor'), reading.get('data', ''),
+                              timestamp):
+            has_saved_data = True
+    batch.add_datapost(datapost, datalogger, 1 if has_saved_data else 3)
+    return True
+
+
+PARSERS = {
+    'SENSDB': parse_datapost_sensdb,
+    'ESPEASY': parse_datapost_espeasy,
+    'ESPEASY_BULK': parse_datapost_espeasy_bulk,
+}
+
+
+class LastValues(dict):
+    """
+    Latest (timestamp, value) of Units, kept by a worker across batches.
+    This is only correct if no other process saves Data of the Units, e.g.
+    in a --sharded worker, which alone processes its Dataloggers.
+    """
+
+    def __init__(self, maxsize=UNIT_CACHE_SIZE):
+        super(LastValues, self).__init__()
+        self.maxsize = maxsize
+
+    def merge(self, last_values):
+        if len(self) + len(last_values) > self.maxsize:
+            self.clear()
+        self.update(last_values)
+
+
+def get_shard(idcode, shards):
+    """Return shard number of a Datalogger, stable across processes."""
+    return (zlib.crc32(idcode.encode('utf-8')) & 0xffffffff) % shards
+
+
+def parse_datapost(parser, datapost, batch, verbosity=0):
+    """
+    Parse one Datapost into batch in a savepoint. If the parser fails,
+    its Data and database changes are discarded and the Datapost is marked
+    failed, so that the rest of the batch can still be written.
+    """
+    mark = batch.mark()
+    try:
+        with transaction.atomic():
+            return parser(datapost, batch, verbosity)
+    except Exception as err:
+        log.exception('Failed to parse Datapost %s', datapost.pk)
+        if verbosity > 0:
+            print('Datapost {} failed: {}'.format(datapost.pk, err))
+        batch.rollback(mark)
+        # Units created by the parser were rolled back
+        unit_cache.clear()
+        batch.add_failed(datapost)
+        return False
+
+
+def process_datapost_batch(dataposts, verbosity=0, last_values=None):
+    """
+    Parse a list of Dataposts in memory and write all resulting Data
+    with one DataBatch. Batch's last values are merged into last_values
+    (LastValues) when the transaction commits. Dataposts, which have no
+    parser or whose parser fails, are marked failed (see parse_datapost()).
+
+    Returns:
+        tuple: success count, failed count and number of saved Data objects
+    """
+    successcount = failedcount = 0
+    batch = DataBatch(last_values)
+    unit_cache.check_generation()
+    try:
+        for datapost in dataposts:
+            parser = PARSERS.get(datapost.protocol)
+            if parser is None:
+                print('No handler for protocol "{}"'.format(
+                    datapost.protocol))
+                success = False
+            else:
+                success = parse_datapost(parser, datapost, batch, verbosity)
+            if success:
+                successcount += 1
+            else:
+                failedcount += 1
+                if datapost.status == 0:
+                    # A pending Datapost would be claimed again and again
+                    batch.add_failed(datapost)
+        datacount = batch.write()
+    except Exception:
+        # The transaction is rolled back with Units created meanwhile
+        unit_cache.clear()
+        raise
+    if last_values is not None:
+        transaction.on_commit(
+            functools.partial(last_values.merge, batch.last_values))
+    return successcount, failedcount, datacount
+
+
 def process_dataposts(command, limit=None, idcode=None,
-                      maxprocessingtime=None, verbosity=0, pk=None):
+                      maxprocessingtime=None, verbosity=0, pk=None,
+                      batchsize=None, pks=None, shard=None):
+    """
+    Process pending Dataposts one by one or, if batchsize is given,
+    batchsize Dataposts at a time. Either way Dataposts are claimed per
+    Datalogger (see process_dataposts_in_batches()). pk or a list of pks
+    limits processing to those Dataposts.
+
+    shard (index, count) limits processing to Dataloggers, whose
+    get_shard() is index. Shards don't share Dataloggers, so Units' last
+    values are kept in memory for the whole run.
+
+    Returns:
+        tuple: success count, failed count and number of saved Data objects
+    """
     # Get all Dataposts, which have existing Datalogger in the database
     starttime = time.time()
     available_dataloggers = Datalogger.objects.filter(active=True)\
@@ -203,36 +508,218 @@ def process_dataposts(command, limit=None, idcode=None,
         dataposts = dataposts.filter(idcode=idcode)
     if pk:
         dataposts = dataposts.filter(pk=pk)
+    if pks is not None:
+        dataposts = dataposts.filter(pk__in=pks)
+    last_values = None
+    if shard is not None:
+        index, count = shard
+        available_dataloggers = [
+            i for i in available_dataloggers if get_shard(i, count) == index]
+        last_values = LastValues()
     dataposts = dataposts.filter(idcode__in=available_dataloggers)
     dataposts = dataposts.order_by('created', 'idcode')
-    successcount = failedcount = 0
-    # Limit, if called with --limit <n> switch
-    if limit is not None:
-        dataposts = dataposts[:limit]
-    for datapost in dataposts:
-        if maxprocessingtime and time.time() > starttime + maxprocessingtime:
-            msg = u'Maximum processing time %s seconds is exceeded.' % (
-                maxprocessingtime)
-            log.warning(msg)
-            return successcount, failedcount
-        # TODO: use --verbose instead
+    try:
+        # Also one by one processing claims Dataloggers, so that it can run
+        # at the same time with batch workers
+        return process_dataposts_in_batches(
+            command, dataposts, batchsize, starttime, limit=limit,
+            maxprocessingtime=maxprocessingtime, verbosity=verbosity,
+            last_values=last_values)
+    except Exception:
+        # E.g. a failed commit, Units created in it don't exist
+        unit_cache.clear()
+        raise
+
+
+def get_claim_token():
+    """Return a string, which identifies this worker process."""
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                             uuid.uuid4().hex[:8])
+
+
+def claim_dataloggers(dataposts, batchsize, token):
+    """
+    Claim Dataloggers, whose pending Dataposts (in dataposts queryset) the
+    calling worker may process. A Datalogger is processed by one worker at
+    a time, so its Dataposts are always processed in order.
+
+    On databases supporting SKIP LOCKED (PostgreSQL) Datalogger rows are
+    locked with SELECT ... FOR UPDATE SKIP LOCKED, which must be called in
+    the transaction processing the batch. Other databases (SQLite) use a
+    DATAPOST_CLAIM_LEASE seconds long lease in Datalogger.claimed_by and
+    claimed_until, which must be released with release_dataloggers().
+
+    Returns:
+        list: idcodes of claimed Dataloggers, oldest pending Dataposts first
+    """
+    # About as many Dataloggers as the oldest batchsize Dataposts have
+    count = len(set(dataposts.values_list('idcode', flat=True)[:batchsize]))
+    if count == 0:
+        return []
+    oldest = dataposts.filter(idcode=OuterRef('idcode'))\
+        .order_by('created').values('created')[:1]
+    candidates = Datalogger.objects.filter(active=True)\
+        .annotate(oldest=Subquery(oldest))\
+        .filter(oldest__isnull=False).order_by('oldest')
+    if connection.features.has_select_for_update_skip_locked:
+        return list(candidates.select_for_update(skip_locked=True)
+                    .values_list('idcode', flat=True)[:count])
+    now = timezone.now()
+    free = Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+    idcodes = list(candidates.filter(free).values_list(
+        'idcode', flat=True)[:count])
+    # The conditional UPDATE makes sure no other worker claimed them
+    # meanwhile
+    Datalogger.objects.filter(free, idcode__in=idcodes).update(
+        claimed_by=token,
+        claimed_until=now + datetime.timedelta(seconds=DATAPOST_CLAIM_LEASE))
+    claimed = set(Datalogger.objects.filter(
+        claimed_by=token, idcode__in=idcodes).values_list('idcode', flat=True))
+    return [idcode for idcode in idcodes if idcode in claimed]
+
+
+def release_dataloggers(token):
+    """Release leases of claim_dataloggers()."""
+    Datalogger.objects.filter(claimed_by=token).update(
+        claimed_by='', claimed_until=None)
+
+
+def claim_batch(dataposts, batchsize, token):
+    """
+    Return a list of at most batchsize oldest pending Dataposts of
+    Dataloggers claimed with claim_dataloggers().
+    """
+    idcodes = claim_dataloggers(dataposts, batchsize, token)
+    if not idcodes:
+        return []
+    return list(dataposts.filter(idcode__in=idcodes)[:batchsize])
+
+
+def log_batch(command, batch, verbosity, min_verbosity=2):
+    for datapost in batch:
         msg = u'%s %s' % (datapost, datapost.created)
         log.info(msg)
-        if verbosity > 0:
+        if verbosity >= min_verbosity:
             command.stdout.write(msg + '\n')
+
+
+def process_claimed_batch(command, dataposts, batchsize, token,
+                          verbosity=0, last_values=None, log_verbosity=2):
+    """
+    Claim and process one batch in one transaction. Dataposts are written
+    to command's stdout, if verbosity is at least log_verbosity.
+
+    Returns:
+        tuple: Datapost count, success count, failed count and number of
+        saved Data objects
+    """
+    if connection.features.has_select_for_update_skip_locked:
         with transaction.atomic():
-            if datapost.protocol == 'SENSDB':
-                success = process_datapost_sensdb(datapost, verbosity)
-            elif datapost.protocol == 'ESPEASY':
-                success = process_datapost_espeasy(datapost, verbosity)
-            else:
-                success = False
-                print('No handler for protocol "{}"'.format(datapost.protocol))
-            if success:
-                successcount += 1
-            else:
-                failedcount += 1
-    return successcount, failedcount
+            batch = claim_batch(dataposts, batchsize, token)
+            if not batch:
+                return 0, 0, 0, 0
+            log_batch(command, batch, verbosity, log_verbosity)
+            return (len(batch),) + process_datapost_batch(
+                batch, verbosity, last_values)
+    # Leases are committed before processing, so other workers see them
+    batch = claim_batch(dataposts, batchsize, token)
+    if not batch:
+        return 0, 0, 0, 0
+    pks = [dp.pk for dp in batch]
+    try:
+        for attempt in range(LOCKED_RETRIES):
+            try:
+                with transaction.atomic():
+                    # Renew the lease. Starting with a write makes SQLite
+                    # wait for other writers instead of failing later.
+                    Datalogger.objects.filter(claimed_by=token).update(
+                        claimed_until=timezone.now() + datetime.timedelta(
+                            seconds=DATAPOST_CLAIM_LEASE))
+                    # Skip Dataposts which were processed before the lease
+                    batch = list(Datapost.objects.filter(
+                        pk__in=pks, status=0).order_by('created', 'idcode'))
+                    log_batch(command, batch, verbosity, log_verbosity)
+                    return (len(batch),) + process_datapost_batch(
+                        batch, verbosity, last_values)
+            except OperationalError as err:
+                # SQLite fails at once, if another process writes when a
+                # transaction turns from reading to writing
+                if 'locked' not in str(err) or attempt + 1 == LOCKED_RETRIES:
+                    raise
+                # Units created in the rolled back transaction don't exist
+                unit_cache.clear()
+                # Random delay, so that workers don't collide again
+                time.sleep(random.uniform(0.05, 0.1) * (attempt + 1))
+    finally:
+        release_dataloggers(token)
+
+
+def process_dataposts_in_batches(command, dataposts, batchsize, starttime,
+                                 maxprocessingtime=None, verbosity=0,
+                                 limit=None, last_values=None):
+    """
+    Claim batchsize pending Dataposts at a time and process each batch in
+    one transaction. Dataposts are claimed per Datalogger (see
+    claim_dataloggers()), so several processes can do this concurrently.
+    If batchsize is None, Dataposts are processed one by one.
+    """
+    one_by_one = batchsize is None
+    if one_by_one:
+        batchsize = 1
+    token = get_claim_token()
+    successcount = failedcount = datacount = 0
+    while True:
+        if maxprocessingtime and time.time() > starttime + maxprocessingtime:
+            msg = u'Maximum processing time %s seconds is exceeded.' % (
+                maxprocessingtime)
+            log.warning(msg)
+            break
+        size = batchsize
+        if limit is not None:
+            size = min(batchsize, limit - successcount - failedcount)
+            if size <= 0:
+                break
+        claimed, success, failed, count = process_claimed_batch(
+            command, dataposts, size, token, verbosity, last_values,
+            log_verbosity=1 if one_by_one else 2)
+        if claimed == 0 or success + failed == 0:
+            # Don't claim the same unprocessed Dataposts again
+            break
+        successcount += success
+        failedcount += failed
+        datacount += count
+        if verbosity > 0 and not one_by_one:
+            command.stdout.write(
+                u'Batch of %d Dataposts, %d Data rows saved.\n' % (
+                    claimed, count))
+    return successcount, failedcount, datacount
+
+
+def process_dataposts_worker(kwargs):
+    """Run process_dataposts() in a --workers process."""
+    # Connections must not be shared with the parent process
+    db.connections.close_all()
+    return process_dataposts(None, **kwargs)
+
+
+def process_dataposts_in_pool(workers, sharded=False, **kwargs):
+    """
+    Run process_dataposts() in batch mode in workers forked processes,
+    which claim disjoint batches. If sharded, every worker processes only
+    its shard of Dataloggers (see get_shard()).
+    """
+    worker_kwargs = [dict(kwargs) for i in range(workers)]
+    if sharded:
+        for i, options in enumerate(worker_kwargs):
+            options['shard'] = (i, workers)
+    db.connections.close_all()
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(process_dataposts_worker, worker_kwargs)
+    finally:
+        pool.close()
+        pool.join()
+    return tuple(sum(counts) for counts in zip(*results))
 
 
 class Command(BaseCommand):
@@ -263,6 +750,36 @@ class Command(BaseCommand):
                         type=int,
                         default=None,
                         help=u'Process only Datapost which has "pk"')
+        parser.add_argument('--batchsize',
+                        action='store',
+                        dest='batchsize',
+                        type=int,
+                        default=None,
+                        help=u'Process "batchsize" Dataposts at a time and '
+                             u'save their Data in one bulk insert')
+        parser.add_argument('--workers',
+                        action='store',
+                        dest='workers',
+                        type=int,
+                        default=None,
+                        help=u'Process Dataposts in "workers" parallel '
+                             u'processes, which claim batches of different '
+                             u'Dataloggers (implies --batchsize %d, '
+                             u'--limit is per worker)' % WORKER_BATCH_SIZE)
+        parser.add_argument('--sharded',
+                        action='store_true',
+                        dest='sharded',
+                        default=False,
+                        help=u'Needs --workers, assign every Datalogger to '
+                             u'one worker by idcode hash and keep Units\' '
+                             u'last values in memory')
+        parser.add_argument('--shard',
+                        action='store',
+                        dest='shard',
+                        default=None,
+                        help=u'Process only Dataloggers of shard "K/N" '
+                             u'(e.g. 0/4), for one sharded worker per host. '
+                             u'Not with --workers')
 
     args = ''
     help = 'Processes Dataposts'
@@ -271,6 +788,7 @@ class Command(BaseCommand):
         limit = options.get('limit')
         idcode = options.get('idcode')
         pk = options.get('pk')
+        batchsize = options.get('batchsize')
         maxprocessingtime = options.get('maxprocessingtime')
         try:
             verbosity = int(options.get('verbosity', 1))  # 0, 1 (default) or 2
@@ -280,15 +798,39 @@ class Command(BaseCommand):
             limit = int(limit)
         if maxprocessingtime is not None:
             maxprocessingtime = int(maxprocessingtime)
+        workers = options.get('workers')
+        shard = options.get('shard')
+        if shard is not None:
+            try:
+                index, count = [int(x) for x in shard.split('/')]
+            except ValueError:
+                raise CommandError('--shard must be K/N, e.g. 0/4')
+            if not 0 <= index < count:
+                raise CommandError('--shard K/N needs 0 <= K < N')
+            shard = (index, count)
+        parallel = workers is not None and workers > 1
+        if options.get('sharded') and not parallel:
+            raise CommandError('--sharded needs --workers N with N > 1')
+        if shard is not None and parallel:
+            raise CommandError('--shard runs one shard, use --sharded with '
+                               '--workers')
         starttime = time.time()
-        successcount, failedcount = process_dataposts(
-            self, limit,
-            idcode=idcode, maxprocessingtime=maxprocessingtime,
-            verbosity=verbosity, pk=pk)
+        if parallel:
+            successcount, failedcount, datacount = process_dataposts_in_pool(
+                workers, sharded=options.get('sharded'), limit=limit,
+                idcode=idcode, maxprocessingtime=maxprocessingtime,
+                verbosity=0, pk=pk, batchsize=batchsize or WORKER_BATCH_SIZE)
+        else:
+            successcount, failedcount, datacount = process_dataposts(
+                self, limit,
+                idcode=idcode, maxprocessingtime=maxprocessingtime,
+                verbosity=verbosity, pk=pk, batchsize=batchsize, shard=shard)
         secs = time.time() - starttime
         if successcount + failedcount > 0:
-            msg = u'Processed %d Dataposts and failed %d in %.2f seconds.' % \
-                  (successcount, failedcount, secs)
+            rate = datacount / secs if secs > 0 else 0.0
+            msg = (u'Processed %d Dataposts and failed %d in %.2f seconds '
+                   u'(%d Data rows, %.1f rows/s).' % (
+                       successcount, failedcount, secs, datacount, rate))
             log.info(msg)
             if verbosity > 0:
                 self.stdout.write(msg + '\n')
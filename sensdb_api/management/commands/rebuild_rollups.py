@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import dateutil.parser
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from sensdb3.models import Unit, ROLLUP_RESOLUTIONS
+from sensdb3.rollups import rebuild_rollups, get_resolution
+
+import logging
+log = logging.getLogger('datapost')
+
+
+def parse_time(value):
+    if value is None:
+        return None
+    try:
+        timestamp = dateutil.parser.parse(value)
+    except ValueError:
+        raise CommandError('Invalid time "{}".'.format(value))
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp, timezone.utc)
+    return timestamp
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--idcode',
+                            action='store',
+                            dest='idcode',
+                            default=None,
+                            help=u'Rebuild only rollups of Units of "idcode"')
+        parser.add_argument('--unit',
+                            action='store',
+                            dest='unit',
+                            type=int,
+                            default=None,
+                            help=u'Rebuild only rollups of Unit with this id')
+        parser.add_argument('--start',
+                            action='store',
+                            dest='start',
+                            default=None,
+                            help=u'Start time (ISO 8601, UTC if naive)')
+        parser.add_argument('--end',
+                            action='store',
+                            dest='end',
+                            default=None,
+                            help=u'End time (ISO 8601, UTC if naive)')
+        parser.add_argument('--resolution',
+                            action='append',
+                            dest='resolution',
+                            choices=[name for name, _ in ROLLUP_RESOLUTIONS],
+                            help=u'Rebuild only this resolution (repeatable)')
+
+    args = ''
+    help = ('Backfill or repair Data rollups (1min, 1h and 1d aggregates) '
+            'from raw Data.')
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        st = parse_time(options['start'])
+        et = parse_time(options['end'])
+        resolutions = None
+        if options['resolution']:
+            resolutions = [get_resolution(name)
+                           for name in options['resolution']]
+        units = Unit.objects.order_by('pk')
+        if options['idcode']:
+            units = units.filter(datalogger__idcode=options['idcode'])
+        if options['unit']:
+            units = units.filter(pk=options['unit'])
+        starttime = time.time()
+        unitcount = rollupcount = 0
+        for unit in units:
+            count = rebuild_rollups(unit, st, et, resolutions)
+            unitcount += 1
+            rollupcount += count
+            if verbosity > 1:
+                self.stdout.write(u'{}: {} rollups'.format(unit, count))
+        msg = (u'Rebuilt {} rollups of {} Units in {:.2f} seconds.'.format(
+            rollupcount, unitcount, time.time() - starttime))
+        log.info(msg)
+        if verbosity > 0:
+            self.stdout.write(self.style.SUCCESS(msg))
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from sensdb3.models import Datalogger
+from sensdb3.models import update_grouplogger_aggregates
+
+import logging
+log = logging.getLogger('datapost')
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--idcode',
+                            action='store',
+                            dest='idcode',
+                            default=None,
+                            help=u'Recompute only aggregates of "idcode"')
+
+    args = ''
+    help = ('Recompute Dataloggers\' aggregate fields from all Dataposts and '
+            'Data. Repairs drift of incrementally updated aggregates.')
+
+    def handle(self, *args, **options):
+        idcode = options.get('idcode')
+        verbosity = int(options.get('verbosity', 1))
+        dataloggers = Datalogger.objects.order_by('idcode')
+        if idcode:
+            dataloggers = dataloggers.filter(idcode=idcode)
+            if not dataloggers.exists():
+                raise CommandError(
+                    'A Datalogger with idcode "{}" does not exist.'.format(
+                        idcode))
+        starttime = time.time()
+        count = 0
+        for datalogger in dataloggers:
+            old = (datalogger.datapostcount, datalogger.measuringcount)
+            datalogger.set_aggregates()
+            datalogger.save()
+            update_grouplogger_aggregates(datalogger)
+            count += 1
+            new = (datalogger.datapostcount, datalogger.measuringcount)
+            if old != new:
+                msg = (u'{}: Dataposts {} -> {}, Data {} -> {}'.format(
+                    datalogger.idcode, old[0], new[0], old[1], new[1]))
+                log.info(msg)
+                if verbosity > 0:
+                    self.stdout.write(msg)
+        if verbosity > 0:
+            self.stdout.write(self.style.SUCCESS(
+                'Recomputed aggregates of {} Dataloggers in {:.2f} '
+                'seconds.'.format(count, time.time() - starttime)))
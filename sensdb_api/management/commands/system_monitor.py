@@ -1,7 +1,7 @@
 from django.conf import settings
 from django.db import connection
 from sensdb3.models import Datapost, Datalogger, Data, Unit
-from sensdb_api.tasks import process_dataposts_task
+from sensdb_api.tasks import queue_dataposts
 import datetime
 import psutil
 import pytz
@@ -78,7 +78,7 @@ def save_datapost(idcode, data, version):
     dp.protocol = 'SENSDB'
     dp.version = version
     dp.save()
-    process_dataposts_task.delay(dp.pk)
+    queue_dataposts()
     return dp
 
 
@@ -1,59 +1,221 @@
 import datetime
-from django.core.mail import send_mail
+import functools
+import re
+from collections import OrderedDict
+from django.db import transaction
 from django.utils import timezone
 
-from sensdb3.models import Alert
+from sensdb3.generations import (ALERT_GENERATION_KEY, UNIT_GENERATION_KEY,
+                                 get_generation)
+from sensdb3.models import Alert, Unit
+from sensdb3.permissions import invalidate_visible_units
+from sensdb_api.tasks import send_alert_email_task
 from django.conf import settings
 
+try:
+    import numpy as np
+except ImportError:  # Alert limits are compared in a loop without NumPy
+    np = None
+
+import logging
+log = logging.getLogger('datapost')
+
 
 def get(key, default):
     return getattr(settings, key, default)
 
 
 FROM_EMAIL = get('DEFAULT_FROM_EMAIL', 'noreply@non-existing.example.com')
-# EXPIRE_TIME = get('ALERT_EXPIRE_TIME', 2 * 60 * 60) # seconds
-EXPIRE_TIME = 2 * 60 * 60  # seconds
+EXPIRE_TIME = get('ALERT_EXPIRE_TIME', 2 * 60 * 60)  # seconds
+# Max number of Units kept in a worker process' UnitCache
+UNIT_CACHE_SIZE = get('UNIT_CACHE_SIZE', 10000)
+ALERT_EMAIL_SPLIT_RE = re.compile(r'[\s,;]+')
+
+
+def _alert_flags_arrays(dataitems):
+    """NumPy version of _alert_flags()."""
+    n = len(dataitems)
+    values = np.fromiter((d.value for d in dataitems), dtype=float, count=n)
+    # Missing limits are NaN, comparisons with NaN are always False
+    lows = np.array([d.unit.alertlow for d in dataitems], dtype=float)
+    highs = np.array([d.unit.alerthigh for d in dataitems], dtype=float)
+    return (values < lows).tolist(), (values > highs).tolist()
+
+
+def _alert_flags(dataitems):
+    """Return lists of low and high alert flags of dataitems."""
+    if np is not None:
+        return _alert_flags_arrays(dataitems)
+    lows, highs = [], []
+    for d in dataitems:
+        lows.append(d.unit.alertlow is not None and d.value < d.unit.alertlow)
+        highs.append(d.unit.alerthigh is not None and
+                     d.value > d.unit.alerthigh)
+    return lows, highs
+
+
+def find_alerts(dataitems):
+    """
+    Compare values of a batch of Data objects to their Units' alert limits
+    at once and return the first out of limits Data of each Unit.
+
+    Args:
+        dataitems (list): Data objects
+
+    Returns:
+        list: (dataitem, low_alert, high_alert) tuples, one per Unit
+    """
+    if not dataitems:
+        return []
+    found = OrderedDict()
+    lows, highs = _alert_flags(dataitems)
+    for dataitem, low_alert, high_alert in zip(dataitems, lows, highs):
+        if (low_alert or high_alert) and dataitem.unit_id not in found:
+            found[dataitem.unit_id] = (dataitem, low_alert, high_alert)
+    return list(found.values())
+
 
+def get_alert_emails(datalogger):
+    """Return datalogger's alert e-mail addresses as a list."""
+    # alertemail was a MultiEmailField, now it is a text field
+    return [email for email in ALERT_EMAIL_SPLIT_RE.split(
+        datalogger.alertemail or '') if email]
 
-def check_alerts(datalogger, dataitem):
+
+def format_alert(datalogger, dataitem, low_alert, high_alert):
+    """
+    Return subject and message of an alert e-mail.
+    """
+    # TODO: add site / domain info to message
+    unit = dataitem.unit
+    subject = u'[Alert] {} {}'.format(datalogger.idcode, datalogger.name)
+    msg = []
+    msg.append(u"Alert in logger {}. {}".format(datalogger.idcode, unit.name))
+    if low_alert:
+        msg.append(u"LOW:  %.3f < %.3f" % (dataitem.value, unit.alertlow))
+    if high_alert:
+        msg.append(u"HIGH: %.3f > %.3f" % (dataitem.value, unit.alerthigh))
+    return subject, u'\r\n'.join(msg)
+
+
+def queue_alert_email(alert_id, subject, message, recipients):
+    """
+    Hand an alert e-mail to the Celery worker, which retries failed
+    deliveries. A broker failure is logged but doesn't stop ingestion.
     """
-    Create an Alert if data value is lower than data channel's lower threshold
-    or higher than upper threshold.
+    try:
+        send_alert_email_task.delay(alert_id, subject, message, FROM_EMAIL,
+                                    recipients)
+    except Exception:
+        log.exception('Could not queue e-mail of Alert %s', alert_id)
+
+
+def check_alerts_many(datalogger, dataitems):
+    """
+    Check alerts of a list of Data objects, e.g. all Data of a processed
+    batch of Dataposts. An Alert is created for every Unit, which has out of
+    limits Data and no unexpired Alert. Alert e-mails are queued when the
+    transaction commits and sent by a Celery worker, so ingestion doesn't
+    wait for the mail server.
 
     Args:
         datalogger (Datalogger): a Datalogger object
-        dataitem (Data): a Data object
+        dataitems (list): Data objects of datalogger's Units
+
+    Returns:
+        list: created Alert objects
+    """
+    found = find_alerts(dataitems)
+    if not found:
+        return []
+    now = timezone.now()
+    active_units = active_alerts.get_active(
+        [d.unit_id for d, low, high in found], now)
+    expires = now + datetime.timedelta(seconds=EXPIRE_TIME)
+    recipients = get_alert_emails(datalogger)
+    alerts = []
+    for dataitem, low_alert, high_alert in found:
+        if dataitem.unit_id in active_units:
+            continue
+        # Alerts are rare, so they are saved one by one to get their ids
+        alert = Alert.objects.create(state='NEW', unit=dataitem.unit,
+                                     expires=expires)
+        active_alerts.set(dataitem.unit_id, expires)
+        alerts.append(alert)
+        if not recipients:
+            continue
+        subject, message = format_alert(datalogger, dataitem, low_alert,
+                                        high_alert)
+        transaction.on_commit(functools.partial(
+            queue_alert_email, alert.pk, subject, message, recipients))
+    return alerts
+
+
+class ActiveAlertCache(object):
+    """
+    Expiry times of unexpired Alerts keyed by unit id, so that a Unit whose
+    values stay out of limits needs no Alert query until its Alert expires.
 
+    Only Alerts known to be active are cached. Units without a cached
+    unexpired Alert are checked from the database, because other processes
+    may have created Alerts meanwhile. Changing or deleting an Alert in any
+    process (e.g. closing it in admin) changes the Alert generation (see
+    sensdb3.generations) and get_active() clears the cache when it notices
+    that. Creating an Alert doesn't, so check_alerts_many() caches the
+    Alerts it creates.
     """
-    low_alert = dataitem.unit.alertlow is not None and \
-                dataitem.value < dataitem.unit.alertlow
-    high_alert = dataitem.unit.alerthigh is not None and \
-                 dataitem.value > dataitem.unit.alerthigh
-    # alertexpression = dataitem.unit.alertexpression
-    if low_alert or high_alert:
-        # TODO: add site / domain info to message
-        now = timezone.now()
-        active_alerts = Alert.objects.filter(unit=dataitem.unit).filter(
-            expires__gt=now)
-        if active_alerts.count() == 0:
-            expires = now + datetime.timedelta(seconds=EXPIRE_TIME)
-            unit = dataitem.unit
-            a = Alert(state='NEW', unit=unit, expires=expires)
-            a.save()
-            subject = u'[Alert] {} {}'.format(datalogger.idcode, datalogger.name)
-            msg = []
-            msg.append(u"Alert in logger {}. {}".format(datalogger.idcode, unit.name))
-            if low_alert:
-                msg.append(u"LOW:  %.3f < %.3f" % (
-                    dataitem.value, dataitem.unit.alertlow))
-            if high_alert:
-                msg.append(u"HIGH: %.3f > %.3f" % (
-                    dataitem.value, dataitem.unit.alerthigh))
-            tos = []
-            if datalogger.alertemail:
-                tos += datalogger.alertemail  # Was MultiEmailField
-            send_mail(subject, u'\r\n'.join(msg), FROM_EMAIL,
-                      tos, fail_silently=True)
+
+    def __init__(self):
+        self.generation = None
+        self._expires = {}
+
+    def __len__(self):
+        return len(self._expires)
+
+    def set(self, unit_id, expires):
+        """Cache expires, if it is later than the cached one."""
+        current = self._expires.get(unit_id)
+        if current is None or expires > current:
+            self._expires[unit_id] = expires
+
+    def invalidate(self, unit_id):
+        self._expires.pop(unit_id, None)
+
+    def clear(self):
+        self._expires.clear()
+
+    def check_generation(self):
+        """Clear the cache if some process has changed Alerts meanwhile."""
+        generation = get_generation(ALERT_GENERATION_KEY)
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+    def get_active(self, unit_ids, now):
+        """
+        Return the set of unit_ids, which have an Alert expiring after now.
+        Units not in the cache are fetched with one query.
+        """
+        self.check_generation()
+        active = set()
+        missing = []
+        for unit_id in unit_ids:
+            expires = self._expires.get(unit_id)
+            if expires is not None and expires > now:
+                active.add(unit_id)
+            else:
+                self._expires.pop(unit_id, None)  # expired
+                missing.append(unit_id)
+        if missing:
+            for unit_id, expires in Alert.objects.filter(
+                    unit_id__in=missing,
+                    expires__gt=now).values_list('unit_id', 'expires'):
+                self.set(unit_id, expires)
+                active.add(unit_id)
+        return active
+
+
+active_alerts = ActiveAlertCache()
 
 
 def apply_filter(unit, value):
@@ -72,3 +234,120 @@ def apply_filter(unit, value):
         return False
     else:
         return True
+
+
+class UnitCache(object):
+    """
+    A bounded LRU cache of Units keyed by (datalogger_id, uniquename), so
+    that processing Dataposts doesn't need a query for every key=value pair.
+
+    Units created by get_many() are cached only when the transaction
+    commits. Callers must clear() the cache if processing fails, because
+    created Units may have been rolled back.
+
+    Saving or deleting a Unit in any process (e.g. in admin) changes its
+    generation (see sensdb3.generations), which check_generation() notices.
+    """
+
+    def __init__(self, maxsize=UNIT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.generation = None
+        self._units = OrderedDict()
+        # Units created in a transaction, which hasn't committed yet
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._units)
+
+    def _get(self, key):
+        unit = self._units.pop(key, None)
+        if unit is not None:
+            self._units[key] = unit  # move to the end, most recently used
+            return unit
+        return self._pending.get(key)
+
+    def _set(self, unit):
+        key = (unit.datalogger_id, unit.uniquename)
+        self._units.pop(key, None)
+        self._units[key] = unit
+        while len(self._units) > self.maxsize:
+            self._units.popitem(last=False)
+
+    def _commit(self, units):
+        for unit in units:
+            key = (unit.datalogger_id, unit.uniquename)
+            if self._pending.pop(key, None) is unit:
+                self._set(unit)
+
+    def invalidate(self, unit):
+        key = (unit.datalogger_id, unit.uniquename)
+        self._units.pop(key, None)
+        self._pending.pop(key, None)
+
+    def clear(self):
+        """
+        Clear all cached Units. Call this when a transaction, which may have
+        created Units, is rolled back.
+        """
+        self._units.clear()
+        self._pending.clear()
+
+    def check_generation(self):
+        """Clear the cache if some process has changed Units meanwhile."""
+        generation = get_generation(UNIT_GENERATION_KEY)
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+    def get_many(self, datalogger, uniquenames):
+        """
+        Return datalogger's Units having uniquenames. Cache misses are
+        fetched with one query and missing Units are created with one
+        bulk_create().
+
+        Args:
+            datalogger (Datalogger): a Datalogger object
+            uniquenames (iterable): Unit uniquenames
+
+        Returns:
+            tuple: dict of uniquename -> Unit and a list of created Units
+        """
+        units = {}
+        missing = set()
+        for uniquename in uniquenames:
+            unit = self._get((datalogger.pk, uniquename))
+            if unit is None:
+                missing.add(uniquename)
+            else:
+                units[uniquename] = unit
+        if not missing:
+            return units, []
+        for unit in Unit.objects.filter(datalogger=datalogger,
+                                        uniquename__in=missing):
+            units[unit.uniquename] = unit
+            missing.discard(unit.uniquename)
+        for unit in units.values():
+            self._set(unit)
+        created = []
+        if missing:
+            new_units = [Unit(uniquename=uniquename, datalogger=datalogger,
+                              name=uniquename)
+                         for uniquename in sorted(missing)]
+            # Dataloggers are claimed by one process at a time (see
+            # process_dataposts), so no other process creates these Units
+            Unit.objects.bulk_create(new_units)
+            # bulk_create() doesn't set primary keys on all databases
+            for unit in Unit.objects.filter(datalogger=datalogger,
+                                            uniquename__in=missing):
+                units[unit.uniquename] = unit
+                created.append(unit)
+                self._pending[(datalogger.pk, unit.uniquename)] = unit
+            # Created Units don't exist, if the transaction is rolled back
+            transaction.on_commit(functools.partial(self._commit, created))
+            # bulk_create() doesn't send post_save signals
+            invalidate_visible_units()
+        return units, created
+
+
+unit_cache = UnitCache()
+
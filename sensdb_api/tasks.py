@@ -1,9 +1,126 @@
 from __future__ import absolute_import
 
+import time
+
 from celery import task
-from django.core import management
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import send_mail
+
+from sensdb3.generations import is_shared_cache
+from sensdb3.models import Alert, Datalogger, Datapost
+
+# Failed alert e-mails are retried ALERT_EMAIL_MAX_RETRIES times, waiting
+# ALERT_EMAIL_RETRY_DELAY seconds before the first retry and doubling the
+# delay after every failure.
+ALERT_EMAIL_MAX_RETRIES = getattr(settings, 'ALERT_EMAIL_MAX_RETRIES', 5)
+ALERT_EMAIL_RETRY_DELAY = getattr(settings, 'ALERT_EMAIL_RETRY_DELAY', 60)
+# Coalescing of Datapost processing, see queue_dataposts(). Times are in
+# seconds.
+DATAPOST_QUEUE_DEBOUNCE = getattr(settings, 'DATAPOST_QUEUE_DEBOUNCE', 1.0)
+DATAPOST_QUEUE_MAX_LATENCY = getattr(settings, 'DATAPOST_QUEUE_MAX_LATENCY',
+                                     10.0)
+DATAPOST_QUEUE_BATCH_SIZE = getattr(settings, 'DATAPOST_QUEUE_BATCH_SIZE', 500)
+QUEUE_SCHEDULED_KEY = 'sensdb3:datapost_queue:scheduled'
+QUEUE_LAST_KEY = 'sensdb3:datapost_queue:last'
+
+
+def _process_dataposts(**kwargs):
+    # Imported here, management commands import this module
+    from sensdb_api.management.commands.process_dataposts import (
+        process_dataposts)
+    return process_dataposts(None, **kwargs)
 
 
 @task(name='tasks.process_dataposts_task')
 def process_dataposts_task(pk):
-    management.call_command('process_dataposts', verbosity=0, pk=pk)
+    """Process one Datapost. New Dataposts are queued with queue_dataposts()."""
+    _process_dataposts(pk=pk)
+
+
+def queue_dataposts():
+    """
+    Schedule processing of new Dataposts. Calls within
+    DATAPOST_QUEUE_DEBOUNCE seconds of each other are coalesced into one
+    drain_dataposts_task, which processes all pending Dataposts in batches,
+    but a Datapost waits at most DATAPOST_QUEUE_MAX_LATENCY seconds.
+
+    The queue state must be in a cache shared by the web and worker
+    processes (see sensdb3.generations.check_shared_cache()). Otherwise
+    the drain can't clear the web process' scheduled key and drains
+    schedule follow-up drains, see drain_dataposts_task().
+    """
+    now = time.time()
+    cache.set(QUEUE_LAST_KEY, now, DATAPOST_QUEUE_MAX_LATENCY)
+    # The first call schedules the drain, add() is atomic
+    if cache.add(QUEUE_SCHEDULED_KEY, now, DATAPOST_QUEUE_MAX_LATENCY):
+        drain_dataposts_task.apply_async(countdown=DATAPOST_QUEUE_DEBOUNCE)
+
+
+def get_drain_delay(now):
+    """
+    Return seconds to wait before draining: until no Dataposts have been
+    queued for DATAPOST_QUEUE_DEBOUNCE seconds or the first one has waited
+    DATAPOST_QUEUE_MAX_LATENCY seconds.
+    """
+    first = cache.get(QUEUE_SCHEDULED_KEY)
+    last = cache.get(QUEUE_LAST_KEY)
+    if first is None or last is None:
+        return 0
+    return min(last + DATAPOST_QUEUE_DEBOUNCE,
+               first + DATAPOST_QUEUE_MAX_LATENCY) - now
+
+
+def has_pending_dataposts():
+    """Return True if some active Datalogger has unprocessed Dataposts."""
+    return Datapost.objects.filter(
+        status=0, idcode__in=Datalogger.objects.filter(active=True)
+        .values_list('idcode', flat=True)).exists()
+
+
+@task(name='tasks.drain_dataposts_task', bind=True)
+def drain_dataposts_task(self, followup=False):
+    """
+    Process all pending Dataposts in DATAPOST_QUEUE_BATCH_SIZE batches.
+
+    If Dataposts are still pending afterwards (e.g. they arrived during
+    the drain), a new drain is queued, but only if this drain processed
+    something. Dataposts claimed by another worker are processed by that
+    worker. With a per-process cache the
+    web process keeps its scheduled key for DATAPOST_QUEUE_MAX_LATENCY
+    seconds and doesn't queue Dataposts meanwhile, so a follow-up drain
+    checks them after that time.
+    """
+    delay = get_drain_delay(time.time())
+    if delay > 0:
+        self.apply_async(kwargs={'followup': followup}, countdown=delay)
+        return None
+    # Dataposts queued from now on schedule a new drain
+    cache.delete_many([QUEUE_SCHEDULED_KEY, QUEUE_LAST_KEY])
+    result = _process_dataposts(batchsize=DATAPOST_QUEUE_BATCH_SIZE)
+    if (result[0] or result[1]) and has_pending_dataposts():
+        queue_dataposts()
+    elif not is_shared_cache() and (not followup or result[0] or result[1]):
+        self.apply_async(kwargs={'followup': True},
+                         countdown=DATAPOST_QUEUE_MAX_LATENCY)
+    return result
+
+
+@task(name='tasks.send_alert_email_task', bind=True,
+      max_retries=ALERT_EMAIL_MAX_RETRIES)
+def send_alert_email_task(self, alert_id, subject, message, from_email,
+                          recipients):
+    """
+    Send an alert e-mail and mark the Alert SENT, or FAILED when all
+    retries have failed.
+    """
+    try:
+        send_mail(subject, message, from_email, recipients)
+    except Exception as exc:
+        if self.request.retries >= self.max_retries:
+            Alert.objects.filter(pk=alert_id).update(state='FAILED')
+            raise
+        raise self.retry(
+            exc=exc,
+            countdown=ALERT_EMAIL_RETRY_DELAY * 2 ** self.request.retries)
+    Alert.objects.filter(pk=alert_id).update(state='SENT')
@@ -4,8 +4,51 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import datetime
+import json
+import smtplib
+import struct
+import time
+import unittest
 
-from django.test import TestCase
+import pytz
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+from model_mommy import mommy
+try:
+    from unittest import mock
+except ImportError:  # Python 2
+    import mock
+from rest_framework.reverse import reverse
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from sensdb3 import datatools, dataversions, generations
+from sensdb3.alignment import align, align_arrays
+from sensdb3.datatools import get_unit_data, get_unit_data_points
+from sensdb3.downsampling import downsample_iter, lttb, minmax
+from sensdb3.dataversions import get_unit_versions
+from sensdb3.models import (Alert, Data, DataRollup, Datapost, Datalogger,
+                             DataloggerUser, Formula, Organization,
+                             Timeformula, Unit)
+from sensdb3.permissions import (can_edit, can_edit_many, can_view,
+                                  can_view_many, get_data,
+                                  get_visible_unit_ids)
+from sensdb3.rollups import rebuild_rollups
+from sensdb_api.management.commands.process_dataposts import process_dataposts
+from sensdb_api.management.commands import process_dataposts as \
+    process_dataposts_cmd
+from sensdb_api.management.commands import tools
+from sensdb_api.management.commands.tools import UnitCache, unit_cache
+from sensdb_api import tasks
+from sensdb_api.tasks import send_alert_email_task
+from sensdb_api.v1 import export, renderers, serializers
 
 
 class SimpleTest(TestCase):
@@ -14,3 +57,1699 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def make_sensdb_datapost(idcode, lines):
+    data = '\n'.join(lines)
+    return Datapost.objects.create(idcode=idcode, data=data,
+                                   protocol='SENSDB')
+
+
+def make_espeasy_datapost(idcode, sensor, data):
+    data = json.dumps({'idcode': idcode, 'sensor': sensor, 'data': data})
+    return Datapost.objects.create(idcode=idcode, data=data,
+                                   protocol='ESPEASY')
+
+
+class ProcessDatapostsTests(TestCase):
+    def setUp(self):
+        unit_cache.clear()
+        self.datalogger = mommy.make(Datalogger, idcode='logger1',
+                                     timezone='UTC', active=True)
+        for minute in range(5):
+            make_sensdb_datapost('logger1', [
+                'logger1,2017-07-11T08:%02d:00Z,temp=%d,hum=50' % (
+                    minute, minute),
+            ])
+
+    def test_single_mode(self):
+        successcount, failedcount, datacount = process_dataposts(None)
+        self.assertEqual((successcount, failedcount, datacount), (5, 0, 10))
+        self.assertEqual(Data.objects.count(), 10)
+        self.assertEqual(Datapost.objects.filter(status=1).count(), 5)
+
+    def test_batch_mode(self):
+        successcount, failedcount, datacount = process_dataposts(
+            None, batchsize=2)
+        self.assertEqual((successcount, failedcount, datacount), (5, 0, 10))
+        self.assertEqual(Data.objects.filter(unit__uniquename='temp')
+                         .order_by('timestamp')
+                         .values_list('value', flat=True)[4], 4.0)
+        self.assertEqual(
+            Datapost.objects.filter(status=1,
+                                    datalogger=self.datalogger).count(), 5)
+        datalogger = Datalogger.objects.get(pk=self.datalogger.pk)
+        self.assertEqual(datalogger.datapostcount, 5)
+        self.assertEqual(datalogger.lastmeasuring.minute, 4)
+
+    def test_incremental_aggregates(self):
+        process_dataposts(None, batchsize=2)
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-10T08:00:00Z,temp=1',  # earlier than others
+        ])
+        process_dataposts(None)
+        datalogger = Datalogger.objects.get(pk=self.datalogger.pk)
+        self.assertEqual(datalogger.datapostcount, 6)
+        self.assertEqual(datalogger.measuringcount, 11)
+        self.assertEqual(datalogger.firstmeasuring.day, 10)
+        self.assertEqual(datalogger.lastmeasuring.minute, 4)
+        # Drift is repaired by recompute_aggregates
+        Data.objects.filter(timestamp__day=10).delete()
+        call_command('recompute_aggregates', idcode='logger1',
+                     stdout=StringIO())
+        datalogger = Datalogger.objects.get(pk=self.datalogger.pk)
+        self.assertEqual(datalogger.measuringcount, 10)
+        self.assertEqual(datalogger.firstmeasuring.day, 11)
+
+    def test_batch_mode_espeasy_deadband(self):
+        # Values inside one batch are compared to each other too
+        for val in ['20.0', '20.1', '25.0']:
+            make_espeasy_datapost('logger1', 'bme280',
+                                  'Temperature={}'.format(val))
+        Datapost.objects.filter(protocol='ESPEASY').update(
+            created='2017-07-11T09:00:00Z')
+        process_dataposts(None, batchsize=10)
+        values = Data.objects.filter(unit__uniquename='bme280_Temperature')\
+            .values_list('value', flat=True)
+        self.assertEqual(list(values), [20.0])
+        self.assertEqual(Datapost.objects.filter(status=3).count(), 2)
+
+    def test_failing_datapost_doesnt_fail_batch(self):
+        make_espeasy_datapost('logger1', 'bme280', 'Temperature=abc')
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-11T08:10:00Z,temp=10,hum=oops',
+        ])
+        successcount, failedcount, datacount = process_dataposts(
+            None, batchsize=10)
+        self.assertEqual((successcount, failedcount, datacount), (5, 2, 10))
+        self.assertEqual(Datapost.objects.filter(status=1).count(), 5)
+        self.assertEqual(Datapost.objects.filter(status=-2).count(), 2)
+        self.assertFalse(Data.objects.filter(value=10).exists())
+
+    def test_unknown_protocol_is_failed(self):
+        Datapost.objects.create(idcode='logger1', data='x', protocol='FOO')
+        for batchsize in [None, 10]:
+            Datapost.objects.filter(protocol='FOO').update(status=0)
+            successcount, failedcount, datacount = process_dataposts(
+                None, batchsize=batchsize)
+            self.assertEqual(failedcount, 1)
+            self.assertEqual(
+                Datapost.objects.get(protocol='FOO').status, -2)
+
+    def test_command_reports_throughput(self):
+        out = StringIO()
+        call_command('process_dataposts', batchsize=3, stdout=out)
+        self.assertIn('10 Data rows', out.getvalue())
+        self.assertIn('rows/s', out.getvalue())
+
+
+class UnitCacheTests(TestCase):
+    def setUp(self):
+        unit_cache.clear()
+        self.datalogger = mommy.make(Datalogger, idcode='logger1',
+                                     timezone='UTC', active=True)
+
+    def test_get_many_creates_missing_units(self):
+        cache = UnitCache()
+        # SELECT, INSERT and SELECT
+        with self.assertNumQueries(3):
+            units, created = cache.get_many(self.datalogger, ['a', 'b'])
+        self.assertEqual(sorted(units.keys()), ['a', 'b'])
+        self.assertEqual(len(created), 2)
+        self.assertEqual(units['a'].name, 'a')
+        with self.assertNumQueries(0):
+            units, created = cache.get_many(self.datalogger, ['a', 'b'])
+        self.assertEqual(created, [])
+
+    def test_lru_eviction(self):
+        cache = UnitCache(maxsize=2)
+        # Units created by get_many() would be cached only on commit
+        for uniquename in ('a', 'b', 'c'):
+            mommy.make(Unit, datalogger=self.datalogger,
+                       uniquename=uniquename)
+        cache.get_many(self.datalogger, ['a', 'b'])
+        cache.get_many(self.datalogger, ['a'])  # 'b' is now the oldest
+        cache.get_many(self.datalogger, ['c'])
+        self.assertEqual(len(cache), 2)
+        with self.assertNumQueries(0):
+            cache.get_many(self.datalogger, ['a', 'c'])
+
+    def test_signals_invalidate(self):
+        units, created = unit_cache.get_many(self.datalogger, ['a'])
+        unit = Unit.objects.get(pk=units['a'].pk)
+        unit.alertlow = 10.0
+        unit.save()
+        # process_datapost_batch() checks the generation
+        unit_cache.check_generation()
+        units, created = unit_cache.get_many(self.datalogger, ['a'])
+        self.assertEqual(units['a'].alertlow, 10.0)
+
+    def test_changes_in_other_processes_invalidate(self):
+        mommy.make(Unit, datalogger=self.datalogger, uniquename='a')
+        unit_cache.check_generation()
+        unit_cache.get_many(self.datalogger, ['a'])
+        # Another process commits a Unit change
+        generations._bump_shared_generation(generations.UNIT_GENERATION_KEY)
+        unit_cache.check_generation()
+        self.assertEqual(len(unit_cache), 0)
+
+    def test_shared_cache_check(self):
+        with self.settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            errors = generations.check_shared_cache(None)
+        self.assertEqual([e.id for e in errors], ['sensdb3.W001'])
+        with self.settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                'LOCATION': 'cache'}}):
+            self.assertEqual(generations.check_shared_cache(None), [])
+
+    def test_no_unit_queries_for_known_units(self):
+        lines = ['logger1,2017-07-11T08:%02d:00Z,temp=1,hum=2' % minute
+                 for minute in range(60)]
+        make_sensdb_datapost('logger1', lines)
+        make_sensdb_datapost('logger1', lines)
+        process_dataposts(None, limit=1)
+        with CaptureQueriesContext(connection) as queries:
+            process_dataposts(None)
+        unit_queries = [q['sql'] for q in queries.captured_queries
+                        if q['sql'].startswith('SELECT "sensdb3_unit"')]
+        self.assertEqual(unit_queries, [])
+
+
+class UnitCacheRollbackTests(TransactionTestCase):
+    def setUp(self):
+        unit_cache.clear()
+        mommy.make(Datalogger, idcode='logger1', timezone='UTC', active=True)
+        make_sensdb_datapost('logger1',
+                             ['logger1,2017-07-11T08:00:00Z,temp=1'])
+
+    def test_units_of_rolled_back_batch_are_not_cached(self):
+        for batchsize in (None, 10):
+            with mock.patch.object(process_dataposts_cmd, 'update_rollups',
+                                   side_effect=RuntimeError):
+                with self.assertRaises(RuntimeError):
+                    process_dataposts(None, batchsize=batchsize)
+            self.assertFalse(Unit.objects.exists())
+            self.assertEqual(len(unit_cache), 0)
+        process_dataposts(None)
+        unit = Unit.objects.select_related('datalogger').get(
+            uniquename='temp')
+        self.assertEqual(Data.objects.get().unit_id, unit.pk)
+        # Committed Units are cached
+        with self.assertNumQueries(0):
+            unit_cache.get_many(unit.datalogger, ['temp'])
+
+
+class RollupTests(APITestCase):
+    def setUp(self):
+        unit_cache.clear()
+        cache.clear()  # Responses are cached
+        self.datalogger = mommy.make(Datalogger, idcode='logger1',
+                                     timezone='UTC', active=True)
+        lines = ['logger1,2017-07-11T%02d:%02d:00Z,temp=%d' % (
+            hour, minute, hour * 100 + minute)
+            for hour in (8, 9) for minute in (10, 30, 50)]
+        make_sensdb_datapost('logger1', lines[:4])
+        make_sensdb_datapost('logger1', lines[4:])
+        self.st = datetime.datetime(2017, 7, 11, tzinfo=pytz.utc)
+        self.et = self.st + datetime.timedelta(days=1)
+
+    def test_process_dataposts_updates_rollups(self):
+        # Second batch updates existing 1h and 1d buckets
+        process_dataposts(None, batchsize=1)
+        unit = Unit.objects.get(uniquename='temp')
+        hours = unit.rollups.filter(resolution=3600).order_by('timestamp')
+        self.assertEqual(
+            [(r.count, r.value, r.min, r.max, r.first, r.last)
+             for r in hours],
+            [(3, 830.0, 810.0, 850.0, 810.0, 850.0),
+             (3, 930.0, 910.0, 950.0, 910.0, 950.0)])
+        day = unit.rollups.get(resolution=86400)
+        self.assertEqual((day.count, day.value, day.min, day.max),
+                         (6, 880.0, 810.0, 950.0))
+        self.assertEqual(unit.rollups.filter(resolution=60).count(), 6)
+
+    def test_rebuild_rollups(self):
+        process_dataposts(None)
+        unit = Unit.objects.get(uniquename='temp')
+        expected = list(unit.rollups.order_by('resolution', 'timestamp')
+                        .values_list('resolution', 'timestamp', 'count',
+                                     'value', 'min', 'max'))
+        Data.objects.filter(unit=unit, value=950).update(valid=False)
+        DataRollup.objects.all().delete()
+        self.assertEqual(rebuild_rollups(unit), 5 + 2 + 1)
+        day = unit.rollups.get(resolution=86400)
+        self.assertEqual((day.count, day.max), (5, 930.0))
+        Data.objects.filter(unit=unit).update(valid=True)
+        call_command('rebuild_rollups', start='2017-07-11',
+                     stdout=StringIO())
+        self.assertEqual(
+            list(unit.rollups.order_by('resolution', 'timestamp')
+                 .values_list('resolution', 'timestamp', 'count', 'value',
+                              'min', 'max')),
+            expected)
+
+    def test_get_unit_data_resolution(self):
+        process_dataposts(None)
+        unit = Unit.objects.get(uniquename='temp')
+        data = list(get_unit_data(unit, self.st, self.et, resolution=3600))
+        self.assertEqual([d['value'] for d in data], [830.0, 930.0])
+        self.assertEqual([d['count'] for d in data], [3, 3])
+        self.assertTrue(all(d['valid'] for d in data))
+
+    def test_data_api_resolution(self):
+        process_dataposts(None)
+        user = User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.force_authenticate(user)
+        response = self.client.get(reverse('v1:data-list'),
+                                   {'resolution': '1h'})
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]['value'], 930.0)
+        self.assertEqual(results[0]['count'], 3)
+        response = self.client.get(reverse('v1:data-list'))
+        self.assertEqual(len(response.data['results']), 6)
+
+
+class RollupSignalTests(APITransactionTestCase):
+    # Rollups of deleted and edited Data are rebuilt on commit
+    def setUp(self):
+        cache.clear()
+        datalogger = mommy.make(Datalogger, idcode='logger1',
+                                timezone='UTC', active=True)
+        self.unit = mommy.make(Unit, datalogger=datalogger,
+                               uniquename='temp', api_read_only=False)
+        user = User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.force_authenticate(user)
+
+    def hours(self):
+        return list(self.unit.rollups.filter(resolution=3600)
+                    .order_by('timestamp').values_list('count', 'min', 'max'))
+
+    def test_api_admin_and_deletes_update_rollups(self):
+        for value, minute in [(1, 10), (5, 20)]:
+            response = self.client.post(reverse('v1:data-list'), {
+                'unit': reverse('v1:unit-detail', args=[self.unit.id]),
+                'value': value,
+                'timestamp': '2017-07-10T08:%02d:00Z' % minute})
+            self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.hours(), [(2, 1.0, 5.0)])
+        # Editing e.g. in admin, also moving Data to another bucket
+        data = Data.objects.get(value=5)
+        data.value = 3
+        data.timestamp = datetime.datetime(2017, 7, 10, 9, tzinfo=pytz.utc)
+        data.save()
+        self.assertEqual(self.hours(), [(1, 1.0, 1.0), (1, 3.0, 3.0)])
+        Data.objects.filter(value=1).delete()
+        self.assertEqual(self.hours(), [(1, 3.0, 3.0)])
+        self.assertEqual(self.unit.rollups.get(resolution=86400).count, 1)
+
+
+class DownsamplingTests(APITestCase):
+    def setUp(self):
+        unit_cache.clear()
+        cache.clear()  # Responses are cached
+        self.datalogger = mommy.make(Datalogger, idcode='logger1',
+                                     timezone='UTC', active=True)
+        # 3 hours of minute data, a spike at 09:17
+        lines = ['logger1,2017-07-11T%02d:%02d:00Z,temp=%d' % (
+            hour, minute, 1000 if (hour, minute) == (9, 17) else minute)
+            for hour in (8, 9, 10) for minute in range(60)]
+        make_sensdb_datapost('logger1', lines)
+        process_dataposts(None)
+        self.unit = Unit.objects.get(uniquename='temp')
+        self.st = datetime.datetime(2017, 7, 11, tzinfo=pytz.utc)
+        self.points = list(get_unit_data(self.unit, self.st,
+                                         self.st + datetime.timedelta(1)))
+
+    def test_lttb(self):
+        sampled = lttb(self.points, 20)
+        self.assertEqual(len(sampled), 20)
+        self.assertEqual(sampled[0], self.points[0])
+        self.assertEqual(sampled[-1], self.points[-1])
+        self.assertIn(1000, [p['value'] for p in sampled])
+        timestamps = [p['timestamp'] for p in sampled]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual(lttb(self.points[:5], 20), self.points[:5])
+
+    def test_minmax(self):
+        sampled = minmax(self.points, 20)
+        self.assertLessEqual(len(sampled), 20)
+        values = [p['value'] for p in sampled]
+        self.assertIn(1000, values)
+        self.assertIn(0, values)
+
+    def test_get_unit_data_points_selects_level(self):
+        points, resolution, method = get_unit_data_points(self.unit, 500)
+        self.assertEqual((len(points), resolution, method), (180, None, None))
+        points, resolution, method = get_unit_data_points(self.unit, 100)
+        self.assertEqual((len(points), resolution, method), (3, 3600, None))
+        points, resolution, method = get_unit_data_points(self.unit, 2)
+        self.assertEqual((len(points), resolution, method), (1, 86400, None))
+        points, resolution, method = get_unit_data_points(
+            self.unit, 10, showinvalid=True)
+        self.assertEqual((len(points), resolution, method),
+                         (10, None, 'lttb'))
+
+    def test_get_unit_data_points_without_rollups(self):
+        # E.g. Data from before rollups existed
+        DataRollup.objects.filter(resolution=3600).delete()
+        points, resolution, method = get_unit_data_points(self.unit, 100)
+        self.assertEqual((len(points), resolution, method), (1, 86400, None))
+        DataRollup.objects.all().delete()
+        points, resolution, method = get_unit_data_points(self.unit, 100)
+        self.assertEqual((len(points), resolution, method),
+                         (100, None, 'lttb'))
+        self.assertIn(1000, [p['value'] for p in points])
+        # Partial rollups are skipped too
+        rebuild_rollups(self.unit, et=datetime.datetime(
+            2017, 7, 11, 8, 59, tzinfo=pytz.utc), resolutions=[3600])
+        points, resolution, method = get_unit_data_points(self.unit, 100)
+        self.assertEqual((len(points), resolution, method),
+                         (100, None, 'lttb'))
+
+    def test_get_unit_data_points_with_missing_bucket(self):
+        # Buckets at the edges of st-et contain Data outside of it, they
+        # don't make up for a missing bucket in the middle
+        DataRollup.objects.filter(
+            resolution=3600,
+            timestamp=datetime.datetime(2017, 7, 11, 9, tzinfo=pytz.utc),
+        ).delete()
+        st = datetime.datetime(2017, 7, 11, 8, 30, tzinfo=pytz.utc)
+        et = datetime.datetime(2017, 7, 11, 10, 29, tzinfo=pytz.utc)
+        points, resolution, method = get_unit_data_points(
+            self.unit, 100, st, et)
+        self.assertEqual((len(points), resolution, method), (1, 86400, None))
+
+    def test_downsample_iter(self):
+        for method in ('lttb', 'minmax'):
+            sampled = downsample_iter(iter(self.points), len(self.points),
+                                      20, method, chunk_size=50)
+            self.assertLessEqual(len(sampled), 20)
+            self.assertIn(1000, [p['value'] for p in sampled])
+            timestamps = [p['timestamp'] for p in sampled]
+            self.assertEqual(timestamps, sorted(timestamps))
+        with mock.patch.object(datatools, 'DOWNSAMPLE_CHUNK_SIZE', 50):
+            points, resolution, method = get_unit_data_points(
+                self.unit, 20, showinvalid=True)
+        self.assertEqual((len(points), resolution, method),
+                         (20, None, 'lttb'))
+
+    def test_api_max_points(self):
+        user = User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.force_authenticate(user)
+        url = reverse('v1:unit-data', args=[self.unit.id])
+        response = self.client.get(url, {'max_points': 100})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['resolution'], '1h')
+        self.assertEqual(response.data['count'], 3)
+        response = self.client.get(reverse('v1:data-list'), {
+            'max_points': 50, 'unit_ids': self.unit.id,
+            'show_invalid': 'true', 'downsample': 'minmax'})
+        self.assertEqual(response.status_code, 200)
+        result = response.data['results'][0]
+        self.assertEqual(result['downsample'], 'minmax')
+        self.assertLessEqual(result['count'], 50)
+        response = self.client.get(reverse('v1:data-list'),
+                                   {'max_points': 50})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {'max_points': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+
+class FormulaEngineTests(TestCase):
+    def setUp(self):
+        self.datalogger = mommy.make(Datalogger, idcode='logger1',
+                                     timezone='UTC', active=True)
+        self.st = datetime.datetime(2017, 7, 11, tzinfo=pytz.utc)
+        minute = datetime.timedelta(minutes=1)
+        self.c1 = [{'value': float(i - 5), 'timestamp': self.st + i * minute,
+                    'valid': i != 3} for i in range(20)]
+        # c2 lacks every third timestamp
+        self.c2 = [{'value': float(i) * 2,
+                    'timestamp': self.st + i * minute, 'valid': True}
+                   for i in range(20) if i % 3]
+        self.timeformulas = [
+            Timeformula(parameters='c1 - c2', multiplier=3.0,
+                        starttime=self.st + 12 * minute)]
+
+    def evaluate(self, parameters, showinvalid=False, timeformulas=()):
+        formula = mommy.make(Formula, datalogger=self.datalogger,
+                             type='polynomial', parameters=parameters,
+                             multiplier=2.0)
+        datalists = datatools.OrderedDict([('c1', self.c1),
+                                           ('c2', self.c2)])
+        return (
+            datatools._evaluate_polynomial_loop(
+                formula, datalists, timeformulas, showinvalid),
+            datatools._evaluate_polynomial_vectorized(
+                formula, datalists, timeformulas, showinvalid))
+
+    def test_vectorized_equals_loop(self):
+        for parameters in ['c1 * c2 + 1', 'math.sqrt(c1) + math.log(c2, 2)',
+                           'math.pi * c1 ** 2', '4']:
+            for showinvalid in (False, True):
+                loop, vectorized = self.evaluate(parameters, showinvalid,
+                                                 self.timeformulas)
+                self.assertEqual(loop, vectorized, parameters)
+        loop, vectorized = self.evaluate('math.sqrt(c1)')
+        self.assertIsNone(vectorized[0]['value'])  # ValueError in loop
+        self.assertEqual(vectorized[-1]['value'], 2.0 * 14 ** 0.5)
+        # Rows with a None value in any list are skipped
+        self.c2[0]['value'] = None
+        formula = Formula(parameters='c1 + c2', multiplier=1.0)
+        vectorized = datatools._evaluate_polynomial_vectorized(
+            formula, datatools.OrderedDict([('c1', self.c1),
+                                            ('c2', self.c2)]), [])
+        self.assertEqual(vectorized[0]['timestamp'], self.c2[1]['timestamp'])
+
+    def test_unsupported_expression_falls_back(self):
+        loop, vectorized = self.evaluate('c1 if c1 > 0 else 0')
+        self.assertIsNone(vectorized)
+        loop, vectorized = self.evaluate('math.factorial(2)')
+        self.assertIsNone(vectorized)
+
+    def test_v_wier(self):
+        formula = Formula(type='v-weir', parameters='90', multiplier=1.0)
+        data = [{'value': v} for v in (-1.0, 0.0, 100.0)]
+        expected = [0.0, 0.0, datatools._v_wier(100.0, 90.0)]
+        self.assertEqual([d['value'] for d in datatools._evaluate_v_wier(
+            formula, data)], expected)
+
+
+class AlignmentTests(TestCase):
+    def setUp(self):
+        self.st = datetime.datetime(2017, 7, 11, tzinfo=pytz.utc)
+        second = datetime.timedelta(seconds=1)
+        # c2's clock is 10 seconds late and it misses one point
+        self.datalists = datatools.OrderedDict([
+            ('c1', [{'value': float(i), 'valid': True,
+                     'timestamp': self.st + i * 60 * second}
+                    for i in range(6)]),
+            ('c2', [{'value': float(i) * 10, 'valid': i != 4,
+                     'timestamp': self.st + (i * 60 + 10) * second}
+                    for i in range(6) if i != 2]),
+        ])
+
+    def assertAligned(self, how, tolerance, expected):
+        def rows(timestamps, columns, valids):
+            return [(int((t - self.st).total_seconds()),) +
+                    tuple(None if columns[key][i] is None or
+                          columns[key][i] != columns[key][i]  # NaN
+                          else round(columns[key][i], 9)
+                          for key in ('c1', 'c2')) + (bool(valids[i]),)
+                    for i, t in enumerate(timestamps)]
+        tolerance = tolerance and datetime.timedelta(seconds=tolerance)
+        expected = [(t, round(c1, 9), round(c2, 9), valid)
+                    for t, c1, c2, valid in expected]
+        self.assertEqual(rows(*align(self.datalists, how, tolerance)),
+                         expected)
+        self.assertEqual(rows(*align_arrays(self.datalists, how, tolerance)),
+                         expected)
+
+    def test_inner(self):
+        self.assertAligned('inner', None, [])
+        self.datalists['c2'][0]['timestamp'] = self.st
+        self.assertAligned('inner', None, [(0, 0.0, 0.0, True)])
+
+    def test_outer(self):
+        timestamps, columns, valids = align(self.datalists, 'outer')
+        self.assertEqual(len(timestamps), 11)
+        self.assertEqual(columns['c1'][:2], [0.0, None])
+        self.assertEqual(columns['c2'][:2], [None, 0.0])
+        timestamps, columns, valids = align_arrays(self.datalists, 'outer')
+        self.assertEqual(len(timestamps), 11)
+        formula = Formula(parameters='c1 + c2', multiplier=1.0,
+                          alignment='outer')
+        for evaluate in (datatools._evaluate_polynomial_loop,
+                         datatools._evaluate_polynomial_vectorized):
+            data = evaluate(formula, self.datalists, [])
+            self.assertEqual(len(data), 11)
+            self.assertIsNone(data[0]['value'])
+
+    def test_asof(self):
+        self.assertAligned('asof', 15, [
+            (0, 0.0, 0.0, True), (60, 1.0, 10.0, True),
+            (180, 3.0, 30.0, True), (240, 4.0, 40.0, False),
+            (300, 5.0, 50.0, True)])
+
+    def test_interpolate(self):
+        # c1 is interpolated at c2's timestamps and vice versa, c2's gap
+        # 70-190 s is longer than the tolerance and c1 ends at 300 s
+        self.assertAligned('interpolate', 60, [
+            (10, 10.0 / 60, 0.0, True), (60, 1.0, 50 / 6.0, True),
+            (70, 70.0 / 60, 10.0, True),
+            (190, 190.0 / 60, 30.0, True), (240, 4.0, 30 + 50 / 6.0, False),
+            (250, 250.0 / 60, 40.0, False), (300, 5.0, 40 + 50 / 6.0, False)])
+
+
+class StreamingExportTests(APITestCase):
+    def setUp(self):
+        unit_cache.clear()
+        self.datalogger = mommy.make(Datalogger, idcode='logger1',
+                                     timezone='UTC', active=True)
+        # Every 2nd temp is on an odd minute, so series interleave
+        lines = ['logger1,2017-07-%02dT08:%02d:00Z,temp=%d,hum=%d' % (
+            day, minute, minute, minute * 2)
+            for day in (10, 20) for minute in range(0, 10, 2)]
+        lines += ['logger1,2017-07-%02dT08:%02d:00Z,temp=%d' % (
+            day, minute, minute) for day in (10, 20)
+            for minute in range(1, 10, 2)]
+        make_sensdb_datapost('logger1', lines)
+        process_dataposts(None)
+        self.temp = Unit.objects.get(uniquename='temp')
+        self.hum = Unit.objects.get(uniquename='hum')
+        self.formula = mommy.make(Formula, datalogger=self.datalogger,
+                                  type='polynomial', parameters='c1 * 10',
+                                  multiplier=1.0, unit1=self.hum,
+                                  active=True)
+        user = User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.force_authenticate(user)
+        self.params = {
+            'start': '2017-07-01T00:00:00Z', 'end': '2017-07-31T00:00:00Z',
+            'unit_ids': '%d,%d' % (self.temp.id, self.hum.id),
+            'formula_ids': str(self.formula.id),
+        }
+
+    def get(self, **params):
+        params.update(self.params)
+        response = self.client.get(reverse('v1:export-data'), params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_ndjson_is_merged_by_timestamp(self):
+        rows = [json.loads(line)
+                for line in self.get(stream='ndjson').splitlines()]
+        self.assertEqual(len(rows), 20 + 10 + 10)
+        timestamps = [row['timestamp'] for row in rows]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual(rows[0]['timestamp'], '2017-07-10T08:00:00Z')
+        formula_rows = [row for row in rows if row['formula']]
+        self.assertEqual([row['value'] for row in formula_rows[:3]],
+                         [0.0, 40.0, 80.0])
+        # Same content as the non-streaming export
+        response = self.client.get(reverse('v1:export-data'), self.params)
+        self.assertEqual(len(response.data['results']), len(rows))
+
+    def test_csv_and_columnar(self):
+        lines = self.get(stream='csv').splitlines()
+        self.assertEqual(lines[0], 'timestamp,value,unit,formula,id,raw')
+        self.assertEqual(len(lines), 1 + 40)
+        columns = json.loads(self.get(stream='columnar'))
+        self.assertEqual(len(columns['timestamp']), 40)
+        self.assertEqual(columns['raw'].count(False), 10)
+        rollups = json.loads(self.get(stream='columnar', resolution='1d'))
+        # Two days of hum, temp and formula (calculated from averages)
+        self.assertEqual(sorted(c for c in rollups['count'] if c),
+                         [5, 5, 10, 10])
+        self.assertEqual(rollups['formula'].count(None), 4)
+
+    def test_formula_rollups_across_windows(self):
+        # The bucket of 2017-07-08 is in the first and second 7 day window
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-08T08:00:00Z,hum=3'])
+        process_dataposts(None)
+        st = datetime.datetime(2017, 7, 1, 12, tzinfo=pytz.utc)
+        et = datetime.datetime(2017, 7, 31, tzinfo=pytz.utc)
+        for alignment in ('inner', 'asof'):
+            self.formula.alignment = alignment
+            self.formula.save()
+            expected = [(r['timestamp'], r['value'])
+                        for r in datatools.get_formula_data(
+                            self.formula, st, et, resolution=86400)]
+            rows = export.iter_formula_series(None, self.formula, st, et,
+                                              resolution=86400)
+            self.assertEqual([(row[0], row[1]) for row in rows], expected)
+            self.assertEqual(len(expected), 3)
+
+    def test_invalid_format(self):
+        response = self.client.get(reverse('v1:export-data'),
+                                   dict(self.params, stream='xml'))
+        self.assertEqual(response.status_code, 400)
+
+
+class KeysetPaginationTests(APITestCase):
+    def setUp(self):
+        cache.clear()  # Responses are cached
+        datalogger = mommy.make(Datalogger, idcode='logger1', timezone='UTC',
+                                active=True)
+        self.unit = mommy.make(Unit, datalogger=datalogger,
+                               uniquename='temp')
+        start = datetime.datetime(2017, 7, 1, tzinfo=pytz.utc)
+        # Two rows per timestamp, so the id is needed to order rows
+        Data.objects.bulk_create([
+            Data(unit=self.unit, value=i, valid=True,
+                 timestamp=start + datetime.timedelta(minutes=i // 2))
+            for i in range(2100)])
+        user = User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.force_authenticate(user)
+
+    def walk(self, url, params):
+        ids, pages = [], []
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.data)
+            ids.extend(row['id'] for row in response.data['results'])
+            if not response.data['next']:
+                return ids, pages
+            response = self.client.get(response.data['next'])
+
+    def test_walk_all_pages(self):
+        ids, pages = self.walk(reverse('v1:data-list'),
+                               {'pagination': 'cursor'})
+        expected = list(Data.objects.order_by('-timestamp', '-id')
+                        .values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+        self.assertEqual([len(p['results']) for p in pages], [1000, 1000, 100])
+        self.assertIsNone(pages[0]['count'])
+        self.assertIsNone(pages[0]['previous'])
+
+    def test_previous_link(self):
+        response = self.client.get(reverse('v1:data-list'),
+                                   {'pagination': 'cursor'})
+        first = [row['id'] for row in response.data['results']]
+        response = self.client.get(response.data['next'])
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([row['id'] for row in response.data['results']],
+                         first)
+        self.assertIsNone(response.data['previous'])
+        self.assertIsNotNone(response.data['next'])
+
+    def test_count_is_optional(self):
+        response = self.client.get(reverse('v1:data-list'),
+                                   {'pagination': 'cursor', 'count': 'true'})
+        self.assertEqual(response.data['count'], 2100)
+
+    def test_unit_data_keeps_unit_link(self):
+        url = reverse('v1:unit-data', args=[self.unit.id])
+        ids, pages = self.walk(url, {'pagination': 'cursor'})
+        self.assertEqual(len(ids), 2100)
+        self.assertEqual(len(set(ids)), 2100)
+        for page in pages:
+            self.assertTrue(page['unit'].endswith(
+                reverse('v1:unit-detail', args=[self.unit.id])))
+
+    def test_deep_page_has_no_offset_or_count(self):
+        response = self.client.get(reverse('v1:data-list'),
+                                   {'pagination': 'cursor'})
+        response = self.client.get(response.data['next'])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 100)
+        sql = ' '.join(q['sql'] for q in queries.captured_queries).upper()
+        self.assertNotIn('OFFSET', sql)
+        self.assertNotIn('COUNT(', sql)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('v1:data-list'),
+                                   {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+
+class VisibleUnitsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('viewer', password='x')
+        self.datalogger = mommy.make(Datalogger, idcode='logger1',
+                                     timezone='UTC', active=True)
+        self.unit = mommy.make(Unit, datalogger=self.datalogger,
+                               uniquename='temp', visibility='E')
+        self.hidden = mommy.make(Unit, datalogger=self.datalogger,
+                                 uniquename='hum', visibility='A')
+        mommy.make(Data, unit=self.unit, value=1.0)
+
+    def test_memberships_invalidate(self):
+        self.assertEqual(get_visible_unit_ids(self.user), [])
+        self.datalogger.viewers.add(self.user)
+        self.assertEqual(get_visible_unit_ids(self.user), [self.unit.id])
+        self.datalogger.viewers.remove(self.user)
+        self.datalogger.admins.add(self.user)
+        self.assertEqual(get_visible_unit_ids(self.user),
+                         [self.unit.id, self.hidden.id])
+        self.datalogger.admins.clear()
+        organization = mommy.make(Organization)
+        organization.viewers.add(self.user)
+        self.assertEqual(get_visible_unit_ids(self.user), [])
+        self.datalogger.organization = organization
+        self.datalogger.save()
+        self.assertEqual(get_visible_unit_ids(self.user), [self.unit.id])
+
+    def test_fields_invalidate(self):
+        self.datalogger.viewers.add(self.user)
+        self.assertEqual(get_visible_unit_ids(self.user), [self.unit.id])
+        self.hidden.visibility = 'E'
+        self.hidden.save()
+        self.assertEqual(get_visible_unit_ids(self.user),
+                         [self.unit.id, self.hidden.id])
+        self.unit.active = False
+        self.unit.save()
+        self.assertEqual(get_visible_unit_ids(self.user), [self.hidden.id])
+        self.datalogger.active = False
+        self.datalogger.save()
+        self.assertEqual(get_visible_unit_ids(self.user), [])
+
+    def test_cached(self):
+        self.datalogger.viewers.add(self.user)
+        get_visible_unit_ids(self.user)
+        # Saving without relevant changes keeps the cached ids
+        Datalogger.objects.get(pk=self.datalogger.pk).save()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_visible_unit_ids(self.user), [self.unit.id])
+
+    def test_data_query_has_no_membership_joins(self):
+        self.datalogger.viewers.add(self.user)
+        get_visible_unit_ids(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            values = list(get_data(self.user).values_list('value', flat=True))
+        self.assertEqual(values, [1.0])
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('JOIN', queries.captured_queries[0]['sql'].upper())
+
+
+class BulkPermissionTests(APITestCase):
+    def setUp(self):
+        self.organization = mommy.make(Organization)
+        self.users = {
+            'staff': User.objects.create_user('staff', is_staff=True),
+            'viewer': User.objects.create_user('viewer'),
+            'admin': User.objects.create_user('admin'),
+            'orgadmin': User.objects.create_user('orgadmin'),
+            'orgviewer': User.objects.create_user('orgviewer'),
+            'owner': User.objects.create_user('owner'),
+            'other': User.objects.create_user('other'),
+        }
+        self.organization.admins.add(self.users['orgadmin'])
+        self.organization.viewers.add(self.users['orgviewer'])
+        self.instances = []
+        for i, (active, organization) in enumerate([
+                (True, None), (True, self.organization),
+                (False, self.organization)]):
+            datalogger = mommy.make(Datalogger, idcode='logger%d' % i,
+                                    timezone='UTC', active=active,
+                                    organization=organization,
+                                    user=self.users['owner'])
+            datalogger.viewers.add(self.users['viewer'])
+            if i != 1:
+                datalogger.admins.add(self.users['admin'])
+            self.instances.append(datalogger)
+            for j, (unit_active, read_only) in enumerate([
+                    (True, False), (False, False), (True, True)]):
+                self.instances.append(mommy.make(
+                    Unit, datalogger=datalogger, uniquename='u%d' % j,
+                    active=unit_active, api_read_only=read_only))
+            self.instances.append(mommy.make(
+                Formula, datalogger=datalogger, active=True))
+        # Reload, so that relations are not cached
+        self.instances = (
+            list(Datalogger.objects.all()) + list(Unit.objects.all()) +
+            list(Formula.objects.all()))
+
+    def test_can_view_many_matches_can_view(self):
+        for name, user in self.users.items():
+            with CaptureQueriesContext(connection) as queries:
+                result = can_view_many(user, self.instances)
+            self.assertLessEqual(len(queries), 2)
+            self.assertEqual(result, [can_view(user, i)
+                                      for i in self.instances], name)
+
+    def test_can_edit_many_matches_can_edit(self):
+        for name, user in self.users.items():
+            for check in (True, False):
+                result = can_edit_many(user, self.instances,
+                                       check_api_read_only=check)
+                self.assertEqual(
+                    result, [can_edit(user, i, check_api_read_only=check)
+                             for i in self.instances], name)
+
+    def test_export_checks_permissions_in_bulk(self):
+        self.client.force_authenticate(self.users['viewer'])
+        params = {'start': '2017-07-01T00:00:00Z',
+                  'end': '2017-07-02T00:00:00Z'}
+        units = Unit.objects.filter(active=True, datalogger__active=True)
+        response = self.client.get(reverse('v1:export-data'), dict(
+            params, unit_ids=','.join(str(u.id) for u in units)))
+        self.assertEqual(response.status_code, 200)
+        inactive = Unit.objects.filter(active=False)[0]
+        response = self.client.get(reverse('v1:export-data'), dict(
+            params, unit_ids='%d,%d' % (units[0].id, inactive.id)))
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(reverse('v1:export-data'), dict(
+            params, formula_ids='999'))
+        self.assertEqual(response.status_code, 404)
+
+    def test_datalogger_list_checks_edit_in_bulk(self):
+        self.client.force_authenticate(self.users['viewer'])
+        url = reverse('v1:datalogger-list')
+        cache.clear()  # Listings are cached
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 2)
+        mommy.make(Datalogger, idcode='logger9', timezone='UTC',
+                   active=True).viewers.add(self.users['viewer'])
+        cache.clear()
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(url)
+        self.assertEqual(len(response.data['results']), 3)
+        self.assertNotIn('admins', response.data['results'][0])
+
+
+class DataloggerListQueryTests(APITestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user('staff', is_staff=True)
+        self.organization = mommy.make(Organization)
+        self.organization.admins.add(
+            User.objects.create_user('orgadmin'))
+        self.organization.viewers.add(
+            User.objects.create_user('orgviewer'))
+        self.client.force_authenticate(self.staff)
+
+    def make_dataloggers(self, start, count):
+        for i in range(start, start + count):
+            datalogger = mommy.make(Datalogger, idcode='logger%d' % i,
+                                    timezone='UTC', active=True,
+                                    organization=self.organization)
+            admin = User.objects.create_user('admin%d' % i)
+            viewer = User.objects.create_user('viewer%d' % i)
+            datalogger.admins.add(admin)
+            datalogger.viewers.add(viewer)
+            DataloggerUser.objects.create(user=viewer, datalogger=datalogger,
+                                          role='maintainer')
+
+    def list_dataloggers(self):
+        cache.clear()  # Listings are cached
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('v1:datalogger-list'))
+        self.assertEqual(response.status_code, 200)
+        return response.data['results'], len(queries)
+
+    def test_query_count_does_not_grow(self):
+        self.make_dataloggers(0, 2)
+        results, count = self.list_dataloggers()
+        self.assertEqual(len(results), 2)
+        self.make_dataloggers(2, 8)
+        results, count_10 = self.list_dataloggers()
+        self.assertEqual(len(results), 10)
+        self.assertEqual(count, count_10)
+        self.assertLessEqual(count_10, 10)
+        logger = [r for r in results if r['idcode'] == 'logger3'][0]
+        self.assertEqual(sorted(u['username'] for u in logger['admins']),
+                         ['admin3', 'orgadmin'])
+        self.assertEqual(sorted(u['username'] for u in logger['viewers']),
+                         ['orgviewer', 'viewer3'])
+        self.assertEqual(logger['related_users'],
+                         [{'username': 'viewer3', 'role': 'maintainer'}])
+
+
+class FastDataSerializerTests(APITestCase):
+    def setUp(self):
+        cache.clear()  # Responses are cached
+        datalogger = mommy.make(Datalogger, idcode='logger1', timezone='UTC',
+                                active=True)
+        self.units = [mommy.make(Unit, datalogger=datalogger,
+                                 uniquename='u%d' % i) for i in range(2)]
+        start = datetime.datetime(2017, 7, 1, tzinfo=pytz.utc)
+        Data.objects.bulk_create([
+            Data(unit=self.units[i % 2], value=i * 1.5, valid=True,
+                 timestamp=start + datetime.timedelta(minutes=i))
+            for i in range(20)])
+        user = User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.force_authenticate(user)
+
+    def test_same_output_as_data_serializer(self):
+        response = self.client.get(reverse('v1:data-list'))
+        self.assertEqual(response.status_code, 200)
+        request = response.wsgi_request
+        request.query_params = request.GET
+        expected = serializers.DataSerializer(
+            Data.objects.order_by('-timestamp'), many=True,
+            context={'request': request}).data
+        self.assertEqual(json.loads(response.content.decode('utf-8'))[
+            'results'], json.loads(json.dumps(expected)))
+
+    def test_unit_data(self):
+        unit = self.units[0]
+        response = self.client.get(reverse('v1:unit-data', args=[unit.id]))
+        results = response.data['results']
+        self.assertEqual(len(results), 10)
+        self.assertEqual(set(r['unit'] for r in results),
+                         set([response.data['unit']]))
+
+    def test_compact(self):
+        response = self.client.get(reverse('v1:data-list'),
+                                   {'compact': 'true'})
+        self.assertEqual(set(r['unit'] for r in response.data['results']),
+                         set(u.id for u in self.units))
+
+    def test_reverse_once_per_unit(self):
+        calls = []
+        cache = serializers.UnitURLCache(None)
+        original = serializers.reverse
+        serializers.reverse = lambda *args, **kwargs: calls.append(args) or 'url'
+        try:
+            for unit_id in [1, 2, 1, 1, 2]:
+                cache.get(unit_id)
+        finally:
+            serializers.reverse = original
+        self.assertEqual(len(calls), 2)
+
+
+class ColumnarFormatTests(APITestCase):
+    def setUp(self):
+        cache.clear()  # Responses are cached
+        unit_cache.clear()
+        self.datalogger = mommy.make(Datalogger, idcode='logger1',
+                                     timezone='UTC', active=True)
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-10T08:%02d:00Z,temp=%d,hum=%d' % (
+                minute, minute, minute * 2) for minute in range(5)])
+        process_dataposts(None)
+        Data.objects.filter(value=3).update(valid=False)
+        self.temp = Unit.objects.get(uniquename='temp')
+        self.hum = Unit.objects.get(uniquename='hum')
+        user = User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.force_authenticate(user)
+        self.t0 = 1499673600  # 2017-07-10T08:00:00Z
+
+    def test_unit_data(self):
+        response = self.client.get(
+            reverse('v1:unit-data', args=[self.temp.id]),
+            {'format': 'columnar', 'show_invalid': 'true'})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['count'], 5)
+        series, = data['results']
+        self.assertEqual(series['unit'], data['unit'])
+        self.assertEqual(series['t'], [self.t0 + m * 60
+                                       for m in (4, 3, 2, 1, 0)])
+        self.assertEqual(series['v'], [4, 3, 2, 1, 0])
+        self.assertEqual(series['valid'], [True, False, True, True, True])
+
+    def test_data_list_with_cursor(self):
+        response = self.client.get(reverse('v1:data-list'), {
+            'format': 'columnar', 'pagination': 'cursor'})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertIsNone(data['next'])
+        self.assertEqual(len(data['results']), 2)
+        self.assertEqual(sorted(len(s['t']) for s in data['results']),
+                         [4, 5])
+        urls = set(s['unit'] for s in data['results'])
+        self.assertEqual(len(urls), 2)
+
+    def test_export(self):
+        formula = mommy.make(Formula, datalogger=self.datalogger,
+                             type='polynomial', parameters='c1 * 10',
+                             multiplier=1.0, unit1=self.hum, active=True)
+        response = self.client.get(reverse('v1:export-data'), {
+            'format': 'columnar', 'start': '2017-07-01T00:00:00Z',
+            'end': '2017-07-31T00:00:00Z', 'formula_ids': str(formula.id),
+            'unit_ids': '%d,%d' % (self.temp.id, self.hum.id)})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([list(s.keys())[0] for s in data['results']],
+                         ['unit', 'unit', 'formula'])
+        formula_series = data['results'][-1]
+        self.assertEqual(formula_series['v'], [0, 20, 40, 60, 80])
+        self.assertEqual(formula_series['t'][0], self.t0)
+
+    def test_max_points(self):
+        response = self.client.get(
+            reverse('v1:unit-data', args=[self.hum.id]),
+            {'format': 'columnar', 'max_points': 10})
+        data = json.loads(response.content.decode('utf-8'))
+        series, = data['results']
+        self.assertEqual(series['v'], [0, 2, 4, 6, 8])
+
+    def test_json_is_default(self):
+        response = self.client.get(reverse('v1:data-list'))
+        self.assertIn('value', response.data['results'][0])
+
+
+def unpack_series(content):
+    """Decode PackedSeriesRenderer's output."""
+    np = renderers.np
+    assert content[:8] == renderers.MAGIC
+    length, = struct.unpack('<I', content[8:12])
+    header = json.loads(content[12:12 + length].decode('utf-8'))
+    offset = 12 + length + (-(12 + length) % 8)
+    n = header['points']
+    columns = {}
+    for name, dtype, size in [('index', '<i8', 8), ('t', '<i8', 8),
+                              ('v', '<f8', 8), ('valid', 'u1', 1)]:
+        columns[name] = np.frombuffer(content[offset:offset + n * size],
+                                      dtype=dtype)
+        offset += n * size
+    assert offset == len(content)
+    return header, columns
+
+
+@unittest.skipIf(renderers.np is None, 'NumPy is not installed')
+class BinaryRendererTests(ColumnarFormatTests):
+    accept = 'application/vnd.sensdb.series'
+
+    def get(self, url, params):
+        response = self.client.get(url, params, HTTP_ACCEPT=self.accept)
+        self.assertEqual(response['Content-Type'], self.accept)
+        return response
+
+    def test_unit_data(self):
+        response = self.get(reverse('v1:unit-data', args=[self.temp.id]),
+                            {'show_invalid': 'true'})
+        header, columns = unpack_series(response.content)
+        self.assertEqual(header['count'], 5)
+        self.assertEqual(header['series'], [{'unit': header['unit']}])
+        self.assertEqual(list(columns['t']), [(self.t0 + m * 60) * 1000000
+                                              for m in (4, 3, 2, 1, 0)])
+        self.assertEqual(list(columns['v']), [4, 3, 2, 1, 0])
+        self.assertEqual(list(columns['valid']), [1, 0, 1, 1, 1])
+        self.assertEqual(list(columns['index']), [0] * 5)
+
+    def test_data_list_with_cursor(self):
+        response = self.get(reverse('v1:data-list'), {'pagination': 'cursor'})
+        header, columns = unpack_series(response.content)
+        self.assertIsNone(header['next'])
+        self.assertEqual(len(header['series']), 2)
+        self.assertEqual(sorted(renderers.np.bincount(columns['index'])),
+                         [4, 5])
+
+    def test_export(self):
+        formula = mommy.make(Formula, datalogger=self.datalogger,
+                             type='polynomial', parameters='c1 * 10',
+                             multiplier=1.0, unit1=self.hum, active=True)
+        response = self.get(reverse('v1:export-data'), {
+            'start': '2017-07-01T00:00:00Z', 'end': '2017-07-31T00:00:00Z',
+            'formula_ids': str(formula.id),
+            'unit_ids': '%d,%d' % (self.temp.id, self.hum.id)})
+        header, columns = unpack_series(response.content)
+        self.assertEqual(header['count'], 14)
+        self.assertEqual([list(s.keys()) for s in header['series']],
+                         [['unit'], ['unit'], ['formula']])
+        formula_points = columns['index'] == 2
+        self.assertEqual(list(columns['v'][formula_points]),
+                         [0, 20, 40, 60, 80])
+
+    def test_max_points(self):
+        response = self.get(reverse('v1:unit-data', args=[self.hum.id]),
+                            {'max_points': 10})
+        header, columns = unpack_series(response.content)
+        self.assertEqual(list(columns['v']), [0, 2, 4, 6, 8])
+
+    def test_error(self):
+        response = self.get(reverse('v1:unit-data', args=[self.hum.id]),
+                            {'max_points': 1})
+        self.assertEqual(response.status_code, 400)
+        header, columns = unpack_series(response.content)
+        self.assertIn('error', header)
+        self.assertEqual(header['points'], 0)
+
+
+@unittest.skipIf(renderers.pa is None, 'pyarrow is not installed')
+class ArrowRendererTests(APITestCase):
+    def test_unit_data(self):
+        pa = renderers.pa
+        datalogger = mommy.make(Datalogger, idcode='logger1', timezone='UTC',
+                                active=True)
+        unit = mommy.make(Unit, datalogger=datalogger, uniquename='temp')
+        mommy.make(Data, unit=unit, value=1.5, valid=True,
+                   timestamp=datetime.datetime(2017, 7, 1, tzinfo=pytz.utc))
+        user = User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.force_authenticate(user)
+        response = self.client.get(
+            reverse('v1:unit-data', args=[unit.id]),
+            HTTP_ACCEPT='application/vnd.apache.arrow.stream')
+        table = pa.RecordBatchStreamReader(
+            pa.BufferReader(response.content)).read_all()
+        self.assertEqual(table.column_names, ['series', 't', 'v', 'valid'])
+        self.assertEqual(table.to_pydict()['v'], [1.5])
+
+
+class DataVersionCacheTests(APITransactionTestCase):
+    # Versions are bumped on commit, TestCase would never commit
+    def setUp(self):
+        cache.clear()
+        unit_cache.clear()
+        self.datalogger = mommy.make(Datalogger, idcode='logger1',
+                                     timezone='UTC', active=True)
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-10T08:00:00Z,temp=1,hum=2'])
+        process_dataposts(None)
+        self.temp = Unit.objects.get(uniquename='temp')
+        self.hum = Unit.objects.get(uniquename='hum')
+        user = User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.force_authenticate(user)
+
+    def count(self, url, params=None):
+        return len(self.client.get(url, params or {}).data['results'])
+
+    def test_new_data_invalidates(self):
+        url = reverse('v1:unit-data', args=[self.temp.id])
+        self.assertEqual(self.count(url), 1)
+        # Data created without signals is not noticed, response is cached
+        Data.objects.bulk_create([Data(
+            unit=self.temp, value=5, valid=True,
+            timestamp=datetime.datetime(2017, 7, 10, 9, tzinfo=pytz.utc))])
+        self.assertEqual(self.count(url), 1)
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-10T10:00:00Z,temp=3'])
+        process_dataposts(None)
+        self.assertEqual(self.count(url), 3)
+
+    def test_other_units_stay_cached(self):
+        versions = get_unit_versions([self.temp.id, self.hum.id])
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-10T10:00:00Z,hum=3'])
+        process_dataposts(None)
+        new_versions = get_unit_versions([self.temp.id, self.hum.id])
+        self.assertEqual(new_versions[0], versions[0])
+        self.assertNotEqual(new_versions[1], versions[1])
+
+    def test_data_list_and_create(self):
+        url = reverse('v1:data-list')
+        params = {'unit_ids': str(self.hum.id)}
+        self.assertEqual(self.count(url, params), 1)
+        self.assertEqual(self.count(url), 2)
+        Unit.objects.filter(id=self.hum.id).update(api_read_only=False)
+        response = self.client.post(url, {
+            'unit': reverse('v1:unit-detail', args=[self.hum.id]),
+            'value': 7, 'timestamp': '2017-07-10T11:00:00Z'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.count(url, params), 2)
+        self.assertEqual(self.count(url), 3)
+
+    def test_datalogger_units(self):
+        url = reverse('v1:datalogger-units', args=['logger1'])
+        self.assertEqual(self.count(url), 2)
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-10T10:00:00Z,pressure=3'])
+        process_dataposts(None)
+        self.assertEqual(self.count(url), 3)
+        # Edits of Units are not Data, but they change the listing too
+        pressure = Unit.objects.get(uniquename='pressure')
+        pressure.name = 'Pressure'
+        pressure.save()
+        names = [u['name'] for u in self.client.get(url).data['results']]
+        self.assertIn('Pressure', names)
+        pressure.delete()
+        self.assertEqual(self.count(url), 2)
+
+    def test_evicted_versions_dont_restart(self):
+        url = reverse('v1:unit-data', args=[self.temp.id])
+        unit_key = dataversions.UNIT_KEY.format(self.temp.id)
+        self.assertEqual(self.count(url), 1)
+        # The global counter doesn't start again from a used version
+        cache.delete(dataversions.GLOBAL_KEY)
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-10T10:00:00Z,temp=3'])
+        process_dataposts(None)
+        self.assertEqual(self.count(url), 2)
+        # A response cached while the Unit's version was evicted
+        cache.delete(unit_key)
+        self.assertEqual(self.count(url), 2)
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-10T11:00:00Z,temp=4'])
+        process_dataposts(None)
+        self.assertEqual(self.count(url), 3)
+        cache.delete(unit_key)
+        self.assertEqual(self.count(url), 3)
+
+
+class LastValueTests(APITestCase):
+    def setUp(self):
+        cache.clear()  # Responses are cached
+        unit_cache.clear()
+        self.datalogger = mommy.make(Datalogger, idcode='logger1',
+                                     timezone='UTC', active=True)
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-10T08:00:00Z,temp=1,hum=2',
+            'logger1,2017-07-10T09:00:00Z,temp=3',
+        ])
+        process_dataposts(None, batchsize=10)
+        self.temp = Unit.objects.get(uniquename='temp')
+        user = User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.force_authenticate(user)
+
+    def test_ingestion_updates_last_values(self):
+        self.assertEqual(self.temp.lastvalue, 3.0)
+        self.assertEqual(self.temp.lasttimestamp.hour, 9)
+        self.assertEqual(Unit.objects.get(uniquename='hum').lastvalue, 2.0)
+        # Older Data processed later doesn't overwrite the last value
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-09T08:00:00Z,temp=10'])
+        process_dataposts(None)
+        self.assertEqual(Unit.objects.get(pk=self.temp.pk).lastvalue, 3.0)
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-10T10:00:00Z,temp=5'])
+        process_dataposts(None)
+        self.assertEqual(Unit.objects.get(pk=self.temp.pk).lastvalue, 5.0)
+
+    def test_latest_endpoint(self):
+        url = reverse('v1:datalogger-latest', args=['logger1'])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(queries), 3)
+        self.assertEqual(response.data['count'], 2)
+        values = dict((r['uniquename'], (r['value'], r['timestamp']))
+                      for r in response.data['results'])
+        self.assertEqual(values['temp'][0], 3.0)
+        self.assertEqual(values['temp'][1].hour, 9)
+        self.assertEqual(values['hum'][0], 2.0)
+        units = [r['unit'] for r in response.data['results']]
+        self.assertIn('http://testserver' + reverse(
+            'v1:unit-detail', args=[self.temp.id]), units)
+
+    def test_api_create_updates_last_value(self):
+        Unit.objects.filter(id=self.temp.id).update(api_read_only=False)
+        response = self.client.post(reverse('v1:data-list'), {
+            'unit': reverse('v1:unit-detail', args=[self.temp.id]),
+            'value': 7, 'timestamp': '2017-07-10T11:00:00Z'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Unit.objects.get(pk=self.temp.pk).lastvalue, 7.0)
+
+
+class AlertTests(TransactionTestCase):
+    # Alert e-mails are queued on commit
+    def setUp(self):
+        unit_cache.clear()
+        tools.active_alerts.clear()
+        self.datalogger = mommy.make(Datalogger, idcode='logger1',
+                                     timezone='UTC', active=True,
+                                     alertemail='a@example.com, b@example.com')
+        self.temp = mommy.make(Unit, datalogger=self.datalogger,
+                               uniquename='temp', alertlow=0.0,
+                               alerthigh=30.0)
+        self.hum = mommy.make(Unit, datalogger=self.datalogger,
+                              uniquename='hum', alerthigh=90.0)
+
+    def make_data(self, values):
+        units = {'temp': self.temp, 'hum': self.hum}
+        return [Data(unit=units[key], value=value) for key, value in values]
+
+    def test_find_alerts(self):
+        dataitems = self.make_data([('temp', 10), ('hum', 95), ('temp', -1),
+                                    ('temp', 31), ('hum', 50)])
+        expected = [(dataitems[1], False, True), (dataitems[2], True, False)]
+        self.assertEqual(tools.find_alerts(dataitems), expected)
+        with mock.patch.object(tools, 'np', None):
+            self.assertEqual(tools.find_alerts(dataitems), expected)
+        self.assertEqual(tools.find_alerts(self.make_data([('hum', 1)])), [])
+
+    @mock.patch('sensdb_api.management.commands.tools.send_alert_email_task')
+    def test_ingestion_queues_alerts(self, task):
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-10T08:00:00Z,temp=35,hum=50',
+            'logger1,2017-07-10T08:01:00Z,temp=36,hum=50',
+        ])
+        process_dataposts(None, batchsize=10)
+        alert = Alert.objects.get()
+        self.assertEqual((alert.unit_id, alert.state), (self.temp.id, 'NEW'))
+        self.assertEqual(task.delay.call_count, 1)
+        args = task.delay.call_args[0]
+        self.assertEqual(args[0], alert.id)
+        self.assertIn('HIGH: 35.000 > 30.000', args[2])
+        self.assertEqual(args[4], ['a@example.com', 'b@example.com'])
+        # The unexpired Alert suppresses new ones
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-10T08:02:00Z,temp=37'])
+        process_dataposts(None)
+        self.assertEqual(Alert.objects.count(), 1)
+        self.assertEqual(task.delay.call_count, 1)
+
+    @mock.patch('sensdb_api.management.commands.tools.send_alert_email_task')
+    def test_active_alerts_are_cached(self, task):
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-10T08:00:00Z,temp=35'])
+        process_dataposts(None)
+        for minute in range(1, 4):
+            make_sensdb_datapost('logger1', [
+                'logger1,2017-07-10T08:%02d:00Z,temp=35' % minute])
+        with CaptureQueriesContext(connection) as queries:
+            process_dataposts(None)
+        alert_queries = [q for q in queries.captured_queries
+                         if 'sensdb3_alert' in q['sql']]
+        # The created Alert is cached, it isn't read at all
+        self.assertEqual(len(alert_queries), 0)
+        self.assertEqual(Alert.objects.count(), 1)
+        # The cached Alert expires after EXPIRE_TIME
+        later = timezone.now() + datetime.timedelta(
+            seconds=tools.EXPIRE_TIME + 1)
+        make_sensdb_datapost('logger1', [
+            'logger1,2017-07-10T08:05:00Z,temp=35'])
+        with mock.patch.object(tools, 'timezone',
+                               mock.Mock(now=lambda: later)):
+            process_dataposts(None)
+        self.assertEqual(Alert.objects.count(), 2)
+        self.assertEqual(task.delay.call_count, 2)
+
+    def test_deleted_alert_is_invalidated(self):
+        future = timezone.now() + datetime.timedelta(hours=1)
+        alert = Alert.objects.create(unit=self.temp, expires=future)
+        now = timezone.now()
+        self.assertEqual(tools.active_alerts.get_active([self.temp.id], now),
+                         {self.temp.id})
+        alert.delete()
+        self.assertEqual(tools.active_alerts.get_active([self.temp.id], now),
+                         set())
+
+    def test_alerts_changed_in_other_processes_are_invalidated(self):
+        future = timezone.now() + datetime.timedelta(hours=1)
+        alert = Alert.objects.create(unit=self.temp, expires=future)
+        now = timezone.now()
+        tools.active_alerts.get_active([self.temp.id], now)
+        # E.g. admin closes the Alert, only the shared generation changes
+        Alert.objects.filter(pk=alert.pk).update(expires=now)
+        generations._bump_shared_generation(generations.ALERT_GENERATION_KEY)
+        self.assertEqual(tools.active_alerts.get_active([self.temp.id], now),
+                         set())
+
+    @mock.patch('sensdb_api.tasks.send_mail')
+    def test_delivery_retries(self, send_mail):
+        alert = Alert.objects.create(unit=self.temp, state='NEW')
+        args = (alert.id, 'subject', 'message', 'from@example.com',
+                ['a@example.com'])
+        send_mail.side_effect = [smtplib.SMTPException('down'), 1]
+        send_alert_email_task.apply(args=args)
+        self.assertEqual(send_mail.call_count, 2)
+        self.assertEqual(Alert.objects.get(pk=alert.pk).state, 'SENT')
+        send_mail.reset_mock()
+        send_mail.side_effect = smtplib.SMTPException('down')
+        send_alert_email_task.apply(args=args)
+        self.assertEqual(send_mail.call_count,
+                         send_alert_email_task.max_retries + 1)
+        self.assertEqual(Alert.objects.get(pk=alert.pk).state, 'FAILED')
+
+
+@mock.patch('sensdb_api.views.queue_dataposts')
+class BulkIngestionTests(TransactionTestCase):
+    # Processing is queued on commit
+    url = '/api/espeasy/bulk'
+
+    def setUp(self):
+        unit_cache.clear()
+        for idcode in ('logger1', 'logger2'):
+            mommy.make(Datalogger, idcode=idcode, timezone='UTC',
+                       active=True)
+
+    def test_ndjson(self, task):
+        body = '\n'.join(json.dumps(r) for r in [
+            {'idcode': 'logger1', 'sensor': 'bme280',
+             'data': 'Temperature=20.5,Humidity=40'},
+            {'idcode': 'logger2', 'sensor': 'bme280',
+             'data': 'Temperature=10'},
+            {'idcode': 'logger1', 'sensor': 'ds18b20',
+             'data': 'Temperature=19'},
+        ])
+        response = self.client.post(self.url, body,
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content.startswith(b'$OK,'))
+        dataposts = Datapost.objects.order_by('pk')
+        self.assertEqual([dp.idcode for dp in dataposts],
+                         ['logger1', 'logger2'])
+        self.assertEqual(dataposts[0].response, response.content.decode())
+        task.assert_called_once_with()
+        process_dataposts(None, pks=[dp.pk for dp in dataposts],
+                          batchsize=10)
+        self.assertEqual(Data.objects.filter(
+            unit__datalogger__idcode='logger1').count(), 3)
+        self.assertEqual(Data.objects.get(
+            unit__datalogger__idcode='logger2').value, 10.0)
+
+    def test_csv_with_timestamps(self, task):
+        body = ('logger1,bme280,2017-07-11T08:00:00Z,Temperature=20\n'
+                'logger1,bme280,2017-07-11T09:00:00Z,Temperature=25\n'
+                'logger1,bme280,,Temperature=30\n')
+        response = self.client.post(self.url, body, content_type='text/csv')
+        self.assertEqual(response.status_code, 200)
+        datapost = Datapost.objects.get()
+        process_dataposts(None, pks=[datapost.pk])
+        timestamps = list(Data.objects.order_by('timestamp')
+                          .values_list('timestamp', flat=True))
+        self.assertEqual(len(timestamps), 3)
+        self.assertEqual(timestamps[0],
+                         datetime.datetime(2017, 7, 11, 8, tzinfo=pytz.utc))
+        self.assertEqual(timestamps[2], datapost.created)
+
+    def test_invalid_line(self, task):
+        body = ('logger1,bme280,,Temperature=20\n'
+                'logger1,bme280,not a time,Temperature=25\n')
+        response = self.client.post(self.url, body, content_type='text/csv')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(b'Line 2', response.content)
+        self.assertEqual(Datapost.objects.count(), 0)
+        self.assertFalse(task.called)
+
+    def test_invalid_value(self, task):
+        for data in ['Temperature=abc', 'Temperature=1=2']:
+            body = ('logger1,bme280,,Temperature=20\n'
+                    'logger1,bme280,,{}\n'.format(data))
+            response = self.client.post(self.url, body,
+                                        content_type='text/csv')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(b'Line 2', response.content)
+        self.assertEqual(Datapost.objects.count(), 0)
+
+
+class EspeasyIngestionTests(TransactionTestCase):
+    url = '/api/espeasy'
+    body = 'idcode=logger1&sensor=bme280&id=0&data=Temperature=24.84'
+
+    def post(self):
+        return self.client.post(
+            self.url, self.body,
+            content_type='application/x-www-form-urlencoded',
+            HTTP_USER_AGENT='ESP Easy', HTTP_X_FOO='bar')
+
+    @mock.patch('sensdb_api.views.queue_dataposts')
+    def test_single_insert(self, task):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post()
+        writes = [q['sql'].split()[0] for q in queries.captured_queries
+                  if 'sensdb3_datapost' in q['sql']]
+        self.assertEqual(writes, ['INSERT'])
+        datapost = Datapost.objects.get()
+        self.assertEqual(datapost.response, response.content.decode())
+        self.assertEqual(datapost.protocol, 'ESPEASY')
+        self.assertIn('USER_AGENT: ESP Easy', datapost.httpheaders)
+        self.assertIn('X_FOO: bar', datapost.httpheaders)
+        task.assert_called_once_with()
+
+    @mock.patch('sensdb_api.views.queue_dataposts')
+    @mock.patch('sensdb3.models.DATAPOST_HEADERS',
+                frozenset(['USER_AGENT', 'CONTENT_TYPE']))
+    def test_header_allow_list(self, task):
+        self.post()
+        datapost = Datapost.objects.get()
+        self.assertEqual(datapost.httpheaders.split('\n'), [
+            'CONTENT_TYPE: application/x-www-form-urlencoded',
+            'USER_AGENT: ESP Easy'])
+        self.assertEqual(datapost.useragent, 'ESP Easy')
+
+
+@mock.patch('sensdb_api.tasks.drain_dataposts_task.apply_async')
+class DatapostQueueTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        unit_cache.clear()
+        mommy.make(Datalogger, idcode='logger1', timezone='UTC', active=True)
+
+    def test_queue_coalesces(self, apply_async):
+        for i in range(3):
+            tasks.queue_dataposts()
+        apply_async.assert_called_once_with(
+            countdown=tasks.DATAPOST_QUEUE_DEBOUNCE)
+
+    def test_drain_delay(self, apply_async):
+        self.assertEqual(tasks.get_drain_delay(100.0), 0)
+        cache.set(tasks.QUEUE_SCHEDULED_KEY, 100.0)
+        cache.set(tasks.QUEUE_LAST_KEY, 100.5)
+        # Debounce: wait until nothing has been queued for a while
+        self.assertAlmostEqual(tasks.get_drain_delay(101.0),
+                               tasks.DATAPOST_QUEUE_DEBOUNCE - 0.5)
+        # Max latency: a steady stream doesn't postpone the drain forever
+        cache.set(tasks.QUEUE_LAST_KEY, 200.0)
+        self.assertAlmostEqual(tasks.get_drain_delay(105.0),
+                               tasks.DATAPOST_QUEUE_MAX_LATENCY - 5.0)
+
+    def test_drain_processes_pending(self, apply_async):
+        for minute in range(3):
+            make_sensdb_datapost('logger1', [
+                'logger1,2017-07-11T08:%02d:00Z,temp=1' % minute])
+        tasks.queue_dataposts()
+        # Too early, the drain is postponed
+        result = tasks.drain_dataposts_task.apply().get()
+        self.assertIsNone(result)
+        self.assertEqual(apply_async.call_count, 2)
+        self.assertEqual(Datapost.objects.filter(status=0).count(), 3)
+        cache.set(tasks.QUEUE_LAST_KEY, time.time() - 60)
+        cache.set(tasks.QUEUE_SCHEDULED_KEY, time.time() - 60)
+        result = tasks.drain_dataposts_task.apply().get()
+        self.assertEqual(list(result), [3, 0, 3])
+        self.assertEqual(Datapost.objects.filter(status=0).count(), 0)
+        # A follow-up drain (the test cache is local) and a new drain
+        # scheduled by a new Datapost
+        tasks.queue_dataposts()
+        self.assertEqual(apply_async.call_count, 4)
+
+    def test_drain_requeues_pending(self, apply_async):
+        make_sensdb_datapost('logger1',
+                             ['logger1,2017-07-11T08:00:00Z,temp=1'])
+        # E.g. the Datapost arrived during the drain
+        with mock.patch.object(tasks, '_process_dataposts',
+                               return_value=(1, 0, 1)):
+            tasks.drain_dataposts_task.apply()
+        apply_async.assert_called_once_with(
+            countdown=tasks.DATAPOST_QUEUE_DEBOUNCE)
+        # A drain, which processed nothing, doesn't requeue itself forever
+        apply_async.reset_mock()
+        cache.clear()
+        with mock.patch.object(tasks, '_process_dataposts',
+                               return_value=(0, 0, 0)):
+            tasks.drain_dataposts_task.apply(kwargs={'followup': True})
+        self.assertFalse(apply_async.called)
+
+    def test_drain_isolates_failing_dataposts(self, apply_async):
+        make_espeasy_datapost('logger1', 'bme280', 'Temperature=abc')
+        make_sensdb_datapost('logger1',
+                             ['logger1,2017-07-11T08:00:00Z,temp=1'])
+        result = tasks.drain_dataposts_task.apply().get()
+        self.assertEqual(list(result), [1, 1, 1])
+        self.assertFalse(Datapost.objects.filter(status=0).exists())
+        self.assertFalse(mock.call(countdown=tasks.DATAPOST_QUEUE_DEBOUNCE)
+                         in apply_async.call_args_list)
+
+    def test_followup_drain_with_local_cache(self, apply_async):
+        # The web process may still have the scheduled key in its own cache
+        tasks.drain_dataposts_task.apply()
+        apply_async.assert_called_once_with(
+            kwargs={'followup': True},
+            countdown=tasks.DATAPOST_QUEUE_MAX_LATENCY)
+        # A follow-up, which found nothing, ends the chain
+        apply_async.reset_mock()
+        tasks.drain_dataposts_task.apply(kwargs={'followup': True})
+        self.assertFalse(apply_async.called)
+        # A shared cache needs no follow-ups
+        with mock.patch.object(tasks, 'is_shared_cache', return_value=True):
+            tasks.drain_dataposts_task.apply()
+        self.assertFalse(apply_async.called)
+
+
+class DatapostClaimTests(TestCase):
+    def setUp(self):
+        unit_cache.clear()
+        for idcode in ('logger1', 'logger2'):
+            mommy.make(Datalogger, idcode=idcode, timezone='UTC',
+                       active=True)
+            for minute in range(3):
+                make_sensdb_datapost(idcode, [
+                    '%s,2017-07-11T08:%02d:00Z,temp=%d' % (
+                        idcode, minute, minute)])
+        self.pending = Datapost.objects.filter(status=0)\
+            .order_by('created', 'idcode')
+
+    def test_dataloggers_are_claimed_by_one_worker(self):
+        batch = process_dataposts_cmd.claim_batch(self.pending, 3, 'a')
+        self.assertEqual(set(dp.idcode for dp in batch), {'logger1'})
+        self.assertEqual([dp.data for dp in batch],
+                         [dp.data for dp in self.pending
+                          .filter(idcode='logger1')])
+        # Another worker gets only the other Datalogger
+        batch = process_dataposts_cmd.claim_batch(self.pending, 10, 'b')
+        self.assertEqual(set(dp.idcode for dp in batch), {'logger2'})
+        self.assertEqual(
+            process_dataposts_cmd.claim_batch(self.pending, 10, 'c'), [])
+        process_dataposts_cmd.release_dataloggers('a')
+        batch = process_dataposts_cmd.claim_batch(self.pending, 10, 'c')
+        self.assertEqual(set(dp.idcode for dp in batch), {'logger1'})
+
+    def test_expired_lease(self):
+        process_dataposts_cmd.claim_batch(self.pending, 10, 'a')
+        Datalogger.objects.update(claimed_until=timezone.now())
+        batch = process_dataposts_cmd.claim_batch(self.pending, 10, 'b')
+        self.assertEqual(len(batch), 6)
+
+    def test_claimed_dataloggers_are_skipped(self):
+        process_dataposts_cmd.claim_batch(
+            self.pending.filter(idcode='logger1'), 10, 'other')
+        successcount, failedcount, datacount = process_dataposts(
+            None, batchsize=2)
+        self.assertEqual((successcount, failedcount, datacount), (3, 0, 3))
+        self.assertEqual(set(Datapost.objects.filter(status=0)
+                             .values_list('idcode', flat=True)), {'logger1'})
+        # Leases of the finished worker are released
+        self.assertEqual(Datalogger.objects.filter(
+            claimed_by='other').count(), 1)
+        self.assertEqual(Datalogger.objects.filter(
+            claimed_until__isnull=True).count(), 1)
+
+    def test_one_by_one_processing_claims(self):
+        process_dataposts_cmd.claim_batch(
+            self.pending.filter(idcode='logger1'), 10, 'other')
+        # E.g. cron and process_dataposts_task(pk)
+        out = StringIO()
+        call_command('process_dataposts', stdout=out)
+        self.assertIn('logger2', out.getvalue())
+        self.assertNotIn('Batch of', out.getvalue())
+        pk = self.pending.filter(idcode='logger1')[0].pk
+        self.assertEqual(process_dataposts(None, pk=pk), (0, 0, 0))
+        self.assertEqual(set(Datapost.objects.filter(status=0)
+                             .values_list('idcode', flat=True)), {'logger1'})
+        process_dataposts_cmd.release_dataloggers('other')
+        self.assertEqual(process_dataposts(None, pk=pk), (1, 0, 1))
+
+
+class DatapostShardTests(TransactionTestCase):
+    # Shard's last values are kept when transactions commit
+    def setUp(self):
+        unit_cache.clear()
+        for idcode in ('logger1', 'logger2', 'logger3', 'logger4'):
+            mommy.make(Datalogger, idcode=idcode, timezone='UTC',
+                       active=True)
+            make_sensdb_datapost(idcode, [
+                '%s,2017-07-11T08:00:00Z,temp=1' % idcode])
+
+    def test_shards_split_dataloggers(self):
+        shards = dict((idcode, process_dataposts_cmd.get_shard(idcode, 2))
+                      for idcode in ('logger1', 'logger2', 'logger3',
+                                     'logger4'))
+        process_dataposts(None, batchsize=10, shard=(0, 2))
+        self.assertEqual(
+            set(Datapost.objects.filter(status=1)
+                .values_list('idcode', flat=True)),
+            set(i for i, shard in shards.items() if shard == 0))
+        process_dataposts(None, batchsize=10, shard=(1, 2))
+        self.assertFalse(Datapost.objects.filter(status=0).exists())
+
+    def test_command_shard_option(self):
+        with self.assertRaises(CommandError):
+            call_command('process_dataposts', shard='2/2', stdout=StringIO())
+        # Options, which would be ignored
+        with self.assertRaises(CommandError):
+            call_command('process_dataposts', sharded=True,
+                         stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('process_dataposts', shard='0/2', workers=2,
+                         stdout=StringIO())
+        for index in range(3):
+            call_command('process_dataposts', shard='%d/3' % index,
+                         batchsize=1, stdout=StringIO())
+        self.assertEqual(Datapost.objects.filter(status=1).count(), 4)
+
+    def test_no_last_value_queries_within_shard(self):
+        Datapost.objects.all().delete()
+        for minute, val in enumerate(['20.0', '20.1', '25.0', '25.05']):
+            datapost = make_espeasy_datapost('logger1', 'bme280',
+                                             'Temperature={}'.format(val))
+            Datapost.objects.filter(pk=datapost.pk).update(
+                created='2017-07-11T09:%02d:00Z' % minute)
+        with CaptureQueriesContext(connection) as queries:
+            process_dataposts(None, batchsize=1, shard=(0, 1))
+        data_queries = [q['sql'] for q in queries.captured_queries
+                        if q['sql'].startswith('SELECT "sensdb3_data"')]
+        # Only the first post of the Unit reads its latest Data
+        self.assertEqual(len(data_queries), 1)
+        values = Data.objects.filter(unit__uniquename='bme280_Temperature')\
+            .order_by('timestamp').values_list('value', flat=True)
+        self.assertEqual(list(values), [20.0, 25.0])
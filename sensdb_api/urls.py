@@ -9,4 +9,6 @@ from . import views
 urlpatterns = [
     url(r'^v1/', include('sensdb_api.v1.urls', namespace='v1')),
     url(r'^espeasy/?$', views.postdata_espeasy, name='postdata_espeasy'),
+    url(r'^espeasy/bulk/?$', views.postdata_espeasy_bulk,
+        name='postdata_espeasy_bulk'),
 ]
@@ -0,0 +1,176 @@
+"""
+Streaming export of Unit and Formula series (see export_data view).
+
+Every series is read in timestamp order with QuerySet.iterator() (Formulas
+are calculated in time windows) and the series are k-way merged by
+timestamp, so memory usage doesn't depend on the length of the time range.
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+import csv
+import datetime
+import heapq
+import json
+
+from django.http import StreamingHttpResponse
+from rest_framework.reverse import reverse
+from rest_framework.utils.encoders import JSONEncoder
+from sensdb3.datatools import get_formula_data
+from sensdb3.rollups import bucket_start
+
+FIELDS = ["timestamp", "value", "unit", "formula", "id", "raw"]
+ROLLUP_FIELDS = ["min", "max", "count"]
+STREAM_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+    "columnar": "application/x-ndjson",
+}
+# Rows per written chunk and per columnar JSON object
+CHUNK_SIZE = 1000
+# Formulas are calculated in windows of this length. Must be a multiple of
+# every rollup resolution.
+FORMULA_WINDOW = datetime.timedelta(days=7)
+# Values of Formulas with these alignments at a timestamp depend only on
+# points at that timestamp, so they can be calculated in windows
+WINDOWED_ALIGNMENTS = ("inner", "outer")
+
+
+def iter_unit_series(request, queryset, unit_id, resolution=None):
+    """
+    Yield rows (tuples in FIELDS + ROLLUP_FIELDS order) of a Unit's
+    Data or DataRollups in timestamp order.
+    """
+    unit_url = reverse("v1:unit-detail", args=[unit_id], request=request)
+    queryset = queryset.filter(unit_id=unit_id)
+    # NOTE: Django 1.11's iterator() has no chunk_size argument. It uses a
+    # server-side cursor on PostgreSQL and fetches rows in chunks.
+    if resolution:
+        rows = queryset.order_by("timestamp").values_list(
+            "timestamp", "value", "min", "max", "count").iterator()
+        for timestamp, value, min_, max_, count in rows:
+            yield (timestamp, value, unit_url, None, None, False,
+                   min_, max_, count)
+    else:
+        rows = queryset.order_by("timestamp", "id").values_list(
+            "timestamp", "value", "id").iterator()
+        for timestamp, value, id in rows:
+            yield (timestamp, value, unit_url, None, id, True)
+
+
+def can_use_windows(formula):
+    """True if formula and the Formulas it uses have WINDOWED_ALIGNMENTS."""
+    while formula is not None:
+        if formula.alignment not in WINDOWED_ALIGNMENTS:
+            return False
+        formula = formula.formula1
+    return True
+
+
+def iter_formula_series(request, formula, st, et, showinvalid=False,
+                        resolution=None):
+    """
+    Yield rows of a Formula in timestamp order. The Formula is calculated
+    in FORMULA_WINDOW long parts, unless its asof or interpolate alignment
+    needs points outside of a window. Then the whole time range is
+    calculated at once.
+    """
+    formula_url = reverse("v1:formula-detail", args=[formula.id],
+                          request=request)
+    extra = (None, None, None) if resolution else ()
+    window = FORMULA_WINDOW if can_use_windows(formula) else None
+    window_start = st
+    if resolution:
+        # Rollups of a bucket overlapping st are included. Windows start at
+        # bucket boundaries, so a bucket is never in two windows.
+        window_start = bucket_start(st, resolution)
+    while window_start <= et:
+        window_end = min(window_start + window, et) if window else et
+        records = get_formula_data(formula, window_start, window_end,
+                                   showinvalid=showinvalid,
+                                   resolution=resolution)
+        for r in records:
+            # Window ends are inclusive, the next window has this point
+            if r["timestamp"] == window_end and window_end != et:
+                continue
+            # The previous window had this point
+            if r["timestamp"] < window_start:
+                continue
+            yield (r["timestamp"], r["value"], None, formula_url, None,
+                   False) + extra
+        if window_end == et:
+            break
+        window_start = window_end
+
+
+def merge_series(series):
+    """k-way merge row iterators, which are in timestamp order."""
+    def keyed(index, rows):
+        # The counter keeps rows with equal timestamps in original order
+        for n, row in enumerate(rows):
+            yield row[0], index, n, row
+    for _, _, _, row in heapq.merge(*[keyed(i, rows)
+                                      for i, rows in enumerate(series)]):
+        yield row
+
+
+def chunked(rows, size=CHUNK_SIZE):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Echo(object):
+    """A file-like object for csv.writer, write() returns the value."""
+    def write(self, value):
+        return value
+
+
+def format_timestamp(timestamp):
+    # Same representation as DRF's JSONEncoder
+    return JSONEncoder().default(timestamp)
+
+
+def render_csv(rows, fields):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for chunk in chunked(rows):
+        yield "".join(
+            writer.writerow([format_timestamp(row[0])] +
+                            ["" if v is None else v for v in row[1:]])
+            for row in chunk)
+
+
+def render_ndjson(rows, fields):
+    for chunk in chunked(rows):
+        yield "".join(
+            json.dumps(dict(zip(fields, row)), cls=JSONEncoder) + "\n"
+            for row in chunk)
+
+
+def render_columnar(rows, fields):
+    """Every line is a JSON object with a list of values per field."""
+    for chunk in chunked(rows):
+        columns = dict((field, [row[i] for row in chunk])
+                       for i, field in enumerate(fields))
+        yield json.dumps(columns, cls=JSONEncoder) + "\n"
+
+
+RENDERERS = {
+    "csv": render_csv,
+    "ndjson": render_ndjson,
+    "columnar": render_columnar,
+}
+
+
+def streaming_export_response(stream_format, series, resolution=None):
+    fields = FIELDS + ROLLUP_FIELDS if resolution else FIELDS
+    content = RENDERERS[stream_format](merge_series(series), fields)
+    response = StreamingHttpResponse(
+        content, content_type=STREAM_FORMATS[stream_format])
+    if stream_format == "csv":
+        response["Content-Disposition"] = 'attachment; filename="export.csv"'
+    return response
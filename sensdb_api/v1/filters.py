@@ -4,6 +4,7 @@ import django_filters
 from django_filters.filters import BaseInFilter, NumberFilter, CharFilter
 from django_filters.rest_framework import FilterSet
 from sensdb3 import models
+from sensdb3.rollups import get_resolution
 
 
 User = get_user_model()
@@ -31,10 +32,16 @@ class DataFilter(FilterSet):
         widget=django_filters.widgets.BooleanWidget()
     )
     unit_ids = NumberInFilter(name="unit_id", lookup_expr="in")
+    # Read aggregated data from DataRollups instead of raw Data. Views use
+    # DataRollupFilter and a DataRollup queryset, when this is given.
+    resolution = django_filters.ChoiceFilter(
+        method="filter_resolution",
+        choices=[(name, name) for name, _ in models.ROLLUP_RESOLUTIONS],
+    )
 
     class Meta:
         model = models.Data
-        fields = ["start", "end", "show_invalid", "unit"]
+        fields = ["start", "end", "show_invalid", "unit", "resolution"]
 
     def __init__(self, data=None, **kwargs):
         if data is not None and "show_invalid" not in data:
@@ -44,10 +51,25 @@ class DataFilter(FilterSet):
         super(DataFilter, self).__init__(data=data, **kwargs)
 
     def filter_show_invalid(self, queryset, name, value):
-        if not value:
+        # DataRollups contain only valid data
+        if not value and queryset.model is models.Data:
             queryset = queryset.filter(valid=True)
         return queryset
 
+    def filter_resolution(self, queryset, name, value):
+        if queryset.model is models.DataRollup:
+            queryset = queryset.filter(resolution=get_resolution(value))
+        return queryset
+
+
+class DataRollupFilter(DataFilter):
+    class Meta(DataFilter.Meta):
+        model = models.DataRollup
+
+
+def get_data_filter_class(resolution):
+    return DataRollupFilter if resolution else DataFilter
+
 
 class UserFilter(FilterSet):
     # A convenience filter for Include staff no matter what
@@ -1,6 +1,13 @@
+import binascii
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from collections import OrderedDict
-from rest_framework.pagination import PageNumberPagination
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_text
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class CustomPagination(PageNumberPagination):
@@ -25,3 +32,123 @@ class CustomPagination(PageNumberPagination):
             ('results', data)
         )
         return Response(OrderedDict(fields))
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination for Data and DataRollups ordered by newest first.
+
+    The cursor contains the (timestamp, id) of the last (or first) row of
+    the current page and the next page is fetched with
+    WHERE (timestamp, id) < cursor, so deep pages cost the same as the
+    first one. The exact count is calculated only if requested with
+    ?count=true. Response has the same fields as CustomPagination's.
+    Rows without timestamp are not listed.
+    """
+    cursor_query_param = "cursor"
+    count_query_param = "count"
+
+    def __init__(self, *custom_fields, **kwargs):
+        self.page_size = kwargs.get("page_size", None)
+        super(KeysetPagination, self).__init__()
+        self.custom_fields = custom_fields
+
+    @classmethod
+    def is_requested(cls, request):
+        """Keyset pagination is used with ?pagination=cursor or ?cursor="""
+        return (request.GET.get("pagination") == "cursor" or
+                cls.cursor_query_param in request.GET)
+
+    def get_position(self, row):
+        """
+        Return (timestamp, id) of a model instance or a
+        values_list("id", "timestamp", ...) tuple
+        """
+        if isinstance(row, tuple):
+            return row[1], row[0]
+        return row.timestamp, row.pk
+
+    def encode_cursor(self, row, reverse):
+        timestamp, pk = self.get_position(row)
+        cursor = "{}|{}|{}".format(timestamp.isoformat(), pk, int(reverse))
+        cursor = force_text(urlsafe_b64encode(cursor.encode("ascii")))
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request):
+        cursor = request.GET.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            cursor = force_text(urlsafe_b64decode(cursor.encode("ascii")))
+            timestamp, pk, reverse = cursor.split("|")
+            timestamp = parse_datetime(timestamp)
+            if timestamp is None:
+                raise ValueError(cursor)
+            return timestamp, int(pk), bool(int(reverse))
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise NotFound("Invalid cursor")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        queryset = queryset.exclude(timestamp__isnull=True)
+        self.count = None
+        if request.GET.get(self.count_query_param) in ("true", "1"):
+            self.count = queryset.count()
+        cursor = self.decode_cursor(request)
+        reverse = False
+        if cursor is None:
+            queryset = queryset.order_by("-timestamp", "-id")
+        else:
+            timestamp, pk, reverse = cursor
+            if reverse:  # previous page
+                queryset = queryset.filter(
+                    Q(timestamp__gt=timestamp) |
+                    Q(timestamp=timestamp, id__gt=pk)
+                ).order_by("timestamp", "id")
+            else:
+                queryset = queryset.filter(
+                    Q(timestamp__lt=timestamp) |
+                    Q(timestamp=timestamp, id__lt=pk)
+                ).order_by("-timestamp", "-id")
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+        # The cursor row itself is on the other side of the page
+        self.has_next = bool(rows) and (reverse or has_more)
+        self.has_previous = bool(rows) and cursor is not None and (
+            has_more if reverse else True)
+        self.rows = rows
+        return rows
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self.rows[-1], False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(self.rows[0], True)
+
+    def get_paginated_response(self, data):
+        fields = [
+            ('count', self.count),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+        ]
+        if self.custom_fields:
+            fields.extend(self.custom_fields)
+        fields.append(
+            ('results', data)
+        )
+        return Response(OrderedDict(fields))
+
+
+def get_data_paginator(request, *custom_fields, **kwargs):
+    """Return KeysetPagination if it is requested, else CustomPagination."""
+    if KeysetPagination.is_requested(request):
+        return KeysetPagination(*custom_fields, **kwargs)
+    return CustomPagination(*custom_fields, **kwargs)
@@ -0,0 +1,329 @@
+"""
+Columnar and binary time series output.
+
+Columnar JSON (?format=columnar): instead of a list of {"id", "value",
+"timestamp", "unit"} objects, results are a list of series, one per Unit
+(or Formula):
+
+    {"unit": URL, "t": [epoch seconds...], "v": [values...],
+     "valid": [booleans...]}
+
+Series are built directly from values_list() rows by transposing them, so
+no dict per row is created.
+
+Binary (Accept: application/vnd.sensdb.series or ?format=packed, needs
+NumPy): all points of a response packed as little-endian arrays:
+
+    8 bytes     magic b"SENSDB\x01\x00"
+    uint32      length of the header in bytes
+    header      UTF-8 JSON: other response fields (count, next, ...) and
+                "series": [{"unit": URL} or {"formula": URL}, ...]
+    padding     zero bytes to a multiple of 8
+    int64[N]    series index of every point (N is header's "points")
+    int64[N]    timestamp, epoch microseconds (INT64_MIN if missing)
+    float64[N]  value (NaN if missing)
+    uint8[N]    valid, 0 or 1
+
+Arrow (Accept: application/vnd.apache.arrow.stream or ?format=arrow, needs
+pyarrow): an Arrow IPC stream with columns series (dictionary of URLs),
+t (timestamp[us, UTC]), v (float64) and valid (bool). The other response
+fields are in the schema metadata key "sensdb" as JSON.
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+import calendar
+import datetime
+import json
+import struct
+from collections import OrderedDict
+
+import pytz
+from django.db.models import BooleanField, Value
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import numpy as np
+except ImportError:  # Binary output is not available without NumPy
+    np = None
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow output is optional
+    pa = None
+
+# values_list() fields of columnar rows. id and timestamp come first, like
+# in FastDataSerializer.FIELDS, so KeysetPagination can use the rows.
+COLUMNAR_FIELDS = ("id", "timestamp", "value", "unit_id", "valid")
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    """
+    Selected with ?format=columnar. Views check
+    request.accepted_renderer.format and return columnar series, which
+    are encoded as plain JSON.
+    """
+    format = "columnar"
+
+
+def is_columnar(request):
+    renderer = getattr(request, "accepted_renderer", None)
+    return getattr(renderer, "format", None) == "columnar"
+
+
+def is_binary(request):
+    renderer = getattr(request, "accepted_renderer", None)
+    return isinstance(renderer, BinarySeriesRenderer)
+
+
+def is_series_format(request):
+    """True if results should be series instead of rows."""
+    return is_columnar(request) or is_binary(request)
+
+
+def columnar_values_list(queryset, resolution=None):
+    """Return queryset as values_list() of COLUMNAR_FIELDS."""
+    if resolution:
+        # Rollups contain only valid Data
+        queryset = queryset.annotate(
+            valid=Value(True, output_field=BooleanField()))
+    return queryset.values_list(*COLUMNAR_FIELDS)
+
+
+def epoch(timestamp):
+    """Return timezone aware timestamp as epoch seconds."""
+    if timestamp is None:
+        return None
+    seconds = calendar.timegm(timestamp.utctimetuple())
+    if timestamp.microsecond:
+        return seconds + timestamp.microsecond / 1000000.0
+    return seconds
+
+
+def make_series(key, url, timestamps, values, valids):
+    return OrderedDict([
+        (key, url),
+        ("t", [epoch(t) for t in timestamps]),
+        ("v", list(values)),
+        ("valid", [bool(v) for v in valids]),
+    ])
+
+
+def unit_series(rows, unit_urls):
+    """
+    Return a list of series from values_list(*COLUMNAR_FIELDS) rows, one
+    per Unit in order of appearance. Row order is kept within a series.
+
+    Args:
+        rows (iterable): rows
+        unit_urls (UnitURLCache): gives unit URLs
+    """
+    by_unit = OrderedDict()
+    for row in rows:
+        by_unit.setdefault(row[3], []).append(row)
+    result = []
+    for unit_id, unit_rows in by_unit.items():
+        ids, timestamps, values, unit_ids, valids = zip(*unit_rows)
+        result.append(make_series("unit", unit_urls.get(unit_id),
+                                  timestamps, values, valids))
+    return result
+
+
+def dict_series(key, url, points):
+    """Return a series from data dicts like get_unit_data() returns."""
+    return make_series(key, url,
+                       [p["timestamp"] for p in points],
+                       [p["value"] for p in points],
+                       [p.get("valid", True) for p in points])
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+MISSING_TIME = -2 ** 63
+MAGIC = b"SENSDB\x01\x00"
+
+
+def _micros(timestamp):
+    if timestamp is None:
+        return MISSING_TIME
+    d = timestamp - EPOCH
+    return (d.days * 86400 + d.seconds) * 1000000 + d.microseconds
+
+
+class SeriesTable(object):
+    """
+    Points of several series as NumPy arrays, the results of a binary
+    response.
+
+    Attributes:
+        series (list): (key, url) of every series, key is "unit" or
+            "formula"
+        index (ndarray): int64 series index of every point
+        t (ndarray): int64 epoch microseconds
+        v (ndarray): float64 values, NaN if missing
+        valid (ndarray): bool
+    """
+    def __init__(self, series, index, t, v, valid):
+        self.series = series
+        self.index = index
+        self.t = t
+        self.v = v
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.t)
+
+    @classmethod
+    def from_columns(cls, series, index, timestamps, values, valids):
+        n = len(timestamps)
+        return cls(
+            series,
+            np.asarray(index, dtype=np.int64),
+            np.fromiter((_micros(t) for t in timestamps), dtype=np.int64,
+                        count=n),
+            np.array(values, dtype=np.float64),  # None becomes NaN
+            np.fromiter(valids, dtype=bool, count=n))
+
+    @classmethod
+    def from_rows(cls, rows, unit_urls):
+        """From values_list(*COLUMNAR_FIELDS) rows, row order is kept."""
+        rows = list(rows)
+        if not rows:
+            return cls.empty()
+        ids, timestamps, values, unit_ids, valids = zip(*rows)
+        unique, index = np.unique(np.array(unit_ids, dtype=np.int64),
+                                  return_inverse=True)
+        series = [("unit", unit_urls.get(int(unit_id)))
+                  for unit_id in unique]
+        return cls.from_columns(series, index, timestamps, values, valids)
+
+    @classmethod
+    def from_points(cls, key, url, points):
+        """From data dicts like get_unit_data() returns."""
+        return cls.from_columns(
+            [(key, url)], np.zeros(len(points), dtype=np.int64),
+            [p["timestamp"] for p in points],
+            [p["value"] for p in points],
+            [bool(p.get("valid", True)) for p in points])
+
+    @classmethod
+    def empty(cls):
+        return cls([], np.zeros(0, dtype=np.int64),
+                   np.zeros(0, dtype=np.int64),
+                   np.zeros(0, dtype=np.float64), np.zeros(0, dtype=bool))
+
+    @classmethod
+    def concatenate(cls, tables):
+        series, indexes, offset = [], [], 0
+        for table in tables:
+            series.extend(table.series)
+            indexes.append(table.index + offset)
+            offset += len(table.series)
+        if not tables:
+            return cls.empty()
+        return cls(series, np.concatenate(indexes),
+                   np.concatenate([table.t for table in tables]),
+                   np.concatenate([table.v for table in tables]),
+                   np.concatenate([table.valid for table in tables]))
+
+
+def unit_results(request, rows, unit_urls):
+    """Return values_list(*COLUMNAR_FIELDS) rows in the requested format."""
+    if is_binary(request):
+        return SeriesTable.from_rows(rows, unit_urls)
+    return unit_series(rows, unit_urls)
+
+
+def points_results(request, key, url, points):
+    """Return data dicts of one series in the requested format."""
+    if is_binary(request):
+        return SeriesTable.from_points(key, url, points)
+    return [dict_series(key, url, points)]
+
+
+def concatenate_results(request, results):
+    """Concatenate unit_results() and points_results() results."""
+    if is_binary(request):
+        return SeriesTable.concatenate(results)
+    return [series for result in results for series in result]
+
+
+def count_points(results):
+    """Return number of points in concatenate_results() results."""
+    if isinstance(results, SeriesTable):
+        return len(results)
+    return sum(len(series["t"]) for series in results)
+
+
+class BinarySeriesRenderer(BaseRenderer):
+    """
+    Base class of binary renderers. data["results"] is a SeriesTable, other
+    fields are put to a JSON header. Responses without a SeriesTable (e.g.
+    errors) are rendered with zero points.
+    """
+    charset = None
+    render_style = "binary"
+
+    def split(self, data):
+        data = dict(data or {})
+        table = data.pop("results", None)
+        if not isinstance(table, SeriesTable):
+            if table is not None:
+                data["results"] = table
+            table = SeriesTable.empty()
+        data["series"] = [OrderedDict([(key, url)])
+                          for key, url in table.series]
+        data["points"] = len(table)
+        header = json.dumps(data, cls=JSONEncoder).encode("utf-8")
+        return header, table
+
+
+class PackedSeriesRenderer(BinarySeriesRenderer):
+    """Packed little-endian arrays, see the module docstring."""
+    media_type = "application/vnd.sensdb.series"
+    format = "packed"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        header, table = self.split(data)
+        padding = -(len(MAGIC) + 4 + len(header)) % 8
+        return b"".join([
+            MAGIC, struct.pack("<I", len(header)), header, b"\0" * padding,
+            table.index.astype("<i8").tobytes(),
+            table.t.astype("<i8").tobytes(),
+            table.v.astype("<f8").tobytes(),
+            table.valid.astype(np.uint8).tobytes(),
+        ])
+
+
+class ArrowSeriesRenderer(BinarySeriesRenderer):
+    """Arrow IPC stream, see the module docstring."""
+    media_type = "application/vnd.apache.arrow.stream"
+    format = "arrow"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        header, table = self.split(data)
+        urls = pa.array([url for key, url in table.series], type=pa.string())
+        arrow_table = pa.Table.from_arrays([
+            pa.DictionaryArray.from_arrays(
+                pa.array(table.index.astype(np.int32)), urls),
+            pa.array(table.t, type=pa.timestamp("us", tz="UTC")),
+            pa.array(table.v, type=pa.float64()),
+            pa.array(table.valid, type=pa.bool_()),
+        ], names=["series", "t", "v", "valid"])
+        arrow_table = arrow_table.replace_schema_metadata({"sensdb": header})
+        sink = pa.BufferOutputStream()
+        writer = pa.RecordBatchStreamWriter(sink, arrow_table.schema)
+        writer.write_table(arrow_table)
+        writer.close()
+        return sink.getvalue().to_pybytes()
+
+
+SERIES_RENDERERS = (ColumnarJSONRenderer,)
+if np is not None:
+    SERIES_RENDERERS += (PackedSeriesRenderer,)
+    if pa is not None:
+        SERIES_RENDERERS += (ArrowSeriesRenderer,)
+
+
+def get_renderer_classes():
+    """Renderers of views, which can return series."""
+    return tuple(api_settings.DEFAULT_RENDERER_CLASSES) + SERIES_RENDERERS
@@ -1,10 +1,11 @@
 from __future__ import absolute_import, unicode_literals, print_function
+from collections import OrderedDict
 from django.contrib.auth import get_user_model
 from django.utils.translation import ugettext as _
 from rest_framework import serializers
 from rest_framework.exceptions import PermissionDenied, MethodNotAllowed
 from rest_framework.reverse import reverse
-from sensdb3.permissions import can_edit
+from sensdb3.permissions import can_edit, can_edit_many
 from sensdb3 import models
 
 
@@ -57,6 +58,22 @@ class RelatedDataloggerValidationMixin(GenericValidationMixin):
         return value
 
 
+class DataloggerListSerializer(serializers.ListSerializer):
+    """Resolves edit permissions of all Dataloggers with one query"""
+    def to_representation(self, data):
+        dataloggers = list(data.all() if hasattr(data, "all") else data)
+        request = self.context["request"]
+        self.child.editable_ids = set(
+            datalogger.pk for datalogger, editable in zip(
+                dataloggers, can_edit_many(request.user, dataloggers))
+            if editable)
+        try:
+            return super(DataloggerListSerializer, self).to_representation(
+                dataloggers)
+        finally:
+            self.child.editable_ids = None
+
+
 class DataloggerSerializer(serializers.ModelSerializer):
     url = serializers.HyperlinkedIdentityField(
         view_name='v1:datalogger-detail',
@@ -85,17 +102,37 @@ class DataloggerSerializer(serializers.ModelSerializer):
             "lon", "firstmeasuring", "lastmeasuring",
             "measuringcount", "datapostcount", "lastdatapost",
         )
+        list_serializer_class = DataloggerListSerializer
+
+    # Set by DataloggerListSerializer
+    editable_ids = None
+
+    def can_edit(self, instance):
+        if self.editable_ids is not None:
+            return instance.pk in self.editable_ids
+        return can_edit(self.context["request"].user, instance)
 
     def to_representation(self, instance):
         ret = super(DataloggerSerializer, self).to_representation(instance)
 
-        request = self.context["request"]
-        if can_edit(request.user, instance):
-            ret["admins"] = self._serialize_users(instance.all_admins)
-            ret["viewers"] = self._serialize_users(instance.all_viewers)
+        if self.can_edit(instance):
+            ret["admins"] = self._serialize_users(
+                self._get_users(instance, "admins"))
+            ret["viewers"] = self._serialize_users(
+                self._get_users(instance, "viewers"))
             ret["related_users"] = self._serialize_related_users(instance)
         return ret
 
+    def _get_users(self, datalogger, field):
+        """
+        Same as Datalogger.all_admins or all_viewers, but uses relations
+        prefetched by DataloggerViewSet
+        """
+        users = list(getattr(datalogger, field).all())
+        if datalogger.organization:
+            users.extend(getattr(datalogger.organization, field).all())
+        return OrderedDict((u.pk, u) for u in users).values()
+
     def _serialize_users(self, qs):
         return [
             {
@@ -105,7 +142,7 @@ class DataloggerSerializer(serializers.ModelSerializer):
         ]
 
     def _serialize_related_users(self, datalogger):
-        qs = models.DataloggerUser.objects.filter(datalogger=datalogger)
+        qs = datalogger.dataloggeruser_set.all()
         return [
             {
                 "username": d.user.username,
@@ -216,6 +253,69 @@ class DataSerializer(serializers.ModelSerializer):
         return value
 
 
+class UnitURLCache(object):
+    """Reverses the URL of each Unit only once"""
+    def __init__(self, request):
+        self.request = request
+        self._urls = {}
+
+    def get(self, unit_id):
+        url = self._urls.get(unit_id)
+        if url is None:
+            url = reverse("v1:unit-detail", args=[unit_id],
+                          request=self.request)
+            self._urls[unit_id] = url
+        return url
+
+
+class FastDataSerializer(serializers.BaseSerializer):
+    """
+    Read only serializer for listing Data. Serializes
+    values_list(*FastDataSerializer.FIELDS) tuples instead of model
+    instances, has the same output as DataSerializer and reverses the unit
+    URL once per Unit. With ?compact=true unit is the Unit id instead of
+    the URL.
+    """
+    FIELDS = ("id", "timestamp", "value", "unit_id")
+    timestamp_field = serializers.DateTimeField()
+
+    def __init__(self, *args, **kwargs):
+        super(FastDataSerializer, self).__init__(*args, **kwargs)
+        self._unit_urls = None
+
+    @property
+    def compact(self):
+        request = self.context["request"]
+        return request.query_params.get("compact", "") in ("1", "true")
+
+    def to_representation(self, row):
+        if self._unit_urls is None:
+            self._unit_urls = UnitURLCache(self.context["request"])
+            self._compact = self.compact
+        id, timestamp, value, unit_id = row
+        return OrderedDict([
+            ("id", id),
+            ("value", None if value is None else float(value)),
+            ("timestamp", self.timestamp_field.to_representation(timestamp)),
+            ("unit", unit_id if self._compact
+                else self._unit_urls.get(unit_id)),
+        ])
+
+
+class DataRollupSerializer(serializers.ModelSerializer):
+    """Read only serializer for aggregated data (resolution=1min|1h|1d)"""
+    unit = serializers.HyperlinkedRelatedField(
+        view_name='v1:unit-detail',
+        read_only=True
+    )
+
+    class Meta:
+        model = models.DataRollup
+        fields = ("value", "min", "max", "count", "first", "last",
+                  "timestamp", "unit")
+        read_only_fields = fields
+
+
 class LogSerializer(RelatedDataloggerValidationMixin,
                     serializers.ModelSerializer):
     url = serializers.HyperlinkedIdentityField(
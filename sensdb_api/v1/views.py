@@ -1,25 +1,120 @@
 from __future__ import absolute_import, unicode_literals, print_function
+from collections import OrderedDict
 from django.contrib.auth import get_user_model
 from django_filters import rest_framework as filters
 from rest_framework import viewsets, mixins
-from rest_framework.decorators import detail_route, api_view
+from rest_framework.decorators import (detail_route, api_view,
+                                       renderer_classes)
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.reverse import reverse
 from rest_framework.response import Response
 from rest_framework_extensions.cache.decorators import cache_response
 from rest_framework_extensions.cache.mixins import CacheResponseMixin
-from sensdb3.models import (Datalogger, Unit, Data, Formula, Dataloggerlog,
-                         Datapost)
-from sensdb3.datatools import get_formula_data
+from rest_framework_extensions.key_constructor import bits
+from rest_framework_extensions.key_constructor.constructors import (
+    DefaultKeyConstructor, DefaultListKeyConstructor)
+from sensdb3.models import (Datalogger, Unit, Data, DataRollup, Formula,
+                             Dataloggerlog, Datapost, update_unit_last_values)
+from sensdb3.datatools import get_formula_data, get_unit_data_points
+from sensdb3.downsampling import DOWNSAMPLE_METHODS
+from sensdb3.rollups import get_resolution, get_resolution_name
+from sensdb3.dataversions import (get_global_version, get_unit_versions,
+                                  get_datalogger_version)
 from sensdb3.permissions import (get_dataloggers, get_units, get_formulas,
-                              get_data, get_logs, can_view)
-from .filters import DataFilter, UserFilter
-from . import serializers, pagination
+                              get_data, get_logs, can_view_many)
+from .filters import DataFilter, UserFilter, get_data_filter_class
+from . import serializers, pagination, export
+from .renderers import (get_renderer_classes, is_series_format,
+                        columnar_values_list, unit_results, points_results,
+                        concatenate_results, count_points)
 
 
 DEFAULT_PAGE_SIZE = 100
 DATA_PAGE_SIZE = 1000
 User = get_user_model()
+MAX_POINTS_ERROR = ("`max_points` must be an integer >= 2 and `downsample` "
+                    "one of: {}".format(", ".join(sorted(DOWNSAMPLE_METHODS))))
+
+
+class DataVersionKeyBit(bits.KeyBitBase):
+    """
+    Data versions (see sensdb3.dataversions) of the Units or Datalogger the
+    response depends on, as returned by view's get_data_versions(). New
+    Data changes the key, so cached responses are never stale.
+    """
+    def get_data(self, params, view_instance, view_method, request, args,
+                 kwargs):
+        get_data_versions = getattr(view_instance, "get_data_versions",
+                                    None)
+        if get_data_versions is None:
+            return get_global_version()
+        return get_data_versions(request, kwargs)
+
+
+class DetailRouteKeyConstructor(DefaultKeyConstructor):
+    """
+    Cache key for detail routes: the response depends on the object, the
+    user (permissions are checked inside the cached method), GET params
+    and the object's data version.
+    """
+    kwargs = bits.KwargsKeyBit()
+    user = bits.UserKeyBit()
+    query_params = bits.QueryParamsKeyBit()
+    data_version = DataVersionKeyBit()
+
+
+class DataListKeyConstructor(DefaultListKeyConstructor):
+    """
+    Cache key for data listings: keyset pagination params (cursor, count)
+    don't change the filtered SQL, so all GET params are included.
+    """
+    query_params = bits.QueryParamsKeyBit()
+    data_version = DataVersionKeyBit()
+
+
+def get_max_points(request):
+    """
+    Return (max_points, downsampling method) from GET params or (None, None)
+    if max_points is not given. Raise ValueError if they are invalid.
+    """
+    max_points = request.GET.get("max_points")
+    if not max_points:
+        return None, None
+    max_points = int(max_points)
+    method = request.GET.get("downsample", "lttb")
+    if max_points < 2 or method not in DOWNSAMPLE_METHODS:
+        raise ValueError(MAX_POINTS_ERROR)
+    return max_points, method
+
+
+def get_unit_points(request, unit, filter_data, max_points, method):
+    """
+    Return at most max_points of unit's data (see get_unit_data_points())
+    in timestamp order. The server picks raw data or a rollup resolution
+    and downsamples if needed, both are reported in the response.
+    """
+    points, resolution, downsample = get_unit_data_points(
+        unit, max_points,
+        st=filter_data["start"],
+        et=filter_data["end"],
+        showinvalid=filter_data["show_invalid"],
+        method=method,
+    )
+    if resolution:
+        for point in points:
+            point["id"] = None
+    unit_url = reverse("v1:unit-detail", args=[unit.id], request=request)
+    if is_series_format(request):
+        results = points_results(request, "unit", unit_url, points)
+    else:
+        results = points
+    return OrderedDict([
+        ("count", len(points)),
+        ("unit", unit_url),
+        ("resolution", get_resolution_name(resolution)),
+        ("downsample", downsample),
+        ("results", results),
+    ])
 
 
 class BaseViewSet(CacheResponseMixin,
@@ -38,7 +133,9 @@ class BaseViewSet(CacheResponseMixin,
             else:
                 custom_fields = []
             page_size = getattr(self, "page_size", DEFAULT_PAGE_SIZE)
-            self._paginator = pagination.CustomPagination(
+            paginator_class = getattr(self, "paginator_class",
+                                      pagination.CustomPagination)
+            self._paginator = paginator_class(
                     *custom_fields, page_size=page_size)
         return self._paginator
 
@@ -49,11 +146,22 @@ class DataloggerViewSet(BaseViewSet):
     serializer_class = serializers.DataloggerSerializer
     lookup_field = "idcode"
 
+    def get_data_versions(self, request, kwargs):
+        datalogger_id = Datalogger.objects.filter(
+            idcode=kwargs.get("idcode")).values_list("id", flat=True).first()
+        return get_datalogger_version(datalogger_id)
+
     def get_queryset(self):
-        return get_dataloggers(self.request.user)
+        qs = get_dataloggers(self.request.user)
+        if self.action in ("list", "retrieve"):
+            # Users and roles are serialized for editors
+            qs = qs.prefetch_related(
+                "admins", "viewers", "organization__admins",
+                "organization__viewers", "dataloggeruser_set__user")
+        return qs
 
     @detail_route(methods=['get'])
-    @cache_response()
+    @cache_response(key_func=DetailRouteKeyConstructor())
     def units(self, request, *args, **kwargs):
         """List units for a single datalogger"""
         datalogger = self.get_object()
@@ -61,7 +169,7 @@ class DataloggerViewSet(BaseViewSet):
         return self._get_children(datalogger, qs, serializers.UnitSerializer)
 
     @detail_route(methods=['get'])
-    @cache_response()
+    @cache_response(key_func=DetailRouteKeyConstructor())
     def formulas(self, request, *args, **kwargs):
         """List formulas for a single datalogger"""
         datalogger = self.get_object()
@@ -69,6 +177,36 @@ class DataloggerViewSet(BaseViewSet):
         return self._get_children(
                 datalogger, qs, serializers.FormulaSerializer)
 
+    @detail_route(methods=['get'])
+    @cache_response(key_func=DetailRouteKeyConstructor())
+    def latest(self, request, *args, **kwargs):
+        """
+        List the latest valid value of every unit of a single datalogger
+        """
+        datalogger = self.get_object()
+        units = get_units(self.request.user, datalogger=datalogger)
+        unit_urls = serializers.UnitURLCache(request)
+        results = [
+            OrderedDict([
+                ("unit", unit_urls.get(id)),
+                ("uniquename", uniquename),
+                ("name", name),
+                ("symbol", symbol),
+                ("value", value),
+                ("timestamp", timestamp),
+            ])
+            for id, uniquename, name, symbol, value, timestamp
+            in units.values_list("id", "uniquename", "name", "symbol",
+                                 "lastvalue", "lasttimestamp")
+        ]
+        return Response(OrderedDict([
+            ("count", len(results)),
+            ("datalogger", reverse("v1:datalogger-detail",
+                                   args=[datalogger.idcode],
+                                   request=request)),
+            ("results", results),
+        ]))
+
     def _get_children(self, datalogger, qs, serializer_cls):
         datalogger_url = reverse(
             "v1:datalogger-detail",
@@ -102,33 +240,73 @@ class UnitViewSet(mixins.CreateModelMixin,
     def get_queryset(self):
         return get_units(self.request.user)
 
-    @detail_route(methods=['get'])
-    @cache_response()
+    def get_data_versions(self, request, kwargs):
+        return get_unit_versions([kwargs.get("pk")])
+
+    @detail_route(methods=['get'],
+                  renderer_classes=get_renderer_classes())
+    @cache_response(key_func=DetailRouteKeyConstructor())
     def data(self, request, *args, **kwargs):
         """
         List data for a single unit
 
         Same as /data/?unit_ids=ID
+
+        With ?max_points=N return at most N points of the requested time
+        range without pagination (see get_unit_points()).
+
+        With ?format=columnar results are series (see renderers).
         """
         unit = self.get_object()
+        try:
+            max_points, method = get_max_points(request)
+        except ValueError:
+            return Response({"error": MAX_POINTS_ERROR}, status=400)
+        if max_points:
+            filter = DataFilter(request.GET, queryset=unit.data_set.all())
+            if not filter.form.is_valid():
+                return Response(
+                    {"error": "error validating filter data"},
+                    status=400
+                )
+            return Response(get_unit_points(request, unit,
+                                            filter.form.cleaned_data,
+                                            max_points, method))
+        resolution = get_resolution(request.GET.get("resolution"))
         unit_url = reverse(
             "v1:unit-detail",
             args=[unit.id],
             request=self.request
         )
 
-        paginator = pagination.CustomPagination(
+        paginator = pagination.get_data_paginator(
+            self.request,
             ("unit", unit_url),
             page_size=DATA_PAGE_SIZE,
         )
 
-        data = unit.data_set.order_by("-timestamp")
-        filter = DataFilter(self.request.GET, queryset=data)
+        if resolution:
+            data = unit.rollups.filter(resolution=resolution)
+            serializer_cls = serializers.DataRollupSerializer
+        else:
+            data = unit.data_set.all()
+            serializer_cls = serializers.FastDataSerializer
+        data = data.order_by("-timestamp")
+        filter_class = get_data_filter_class(resolution)
+        filter = filter_class(self.request.GET, queryset=data)
         data = filter.qs
+        if is_series_format(request):
+            data = columnar_values_list(data, resolution)
+            data = paginator.paginate_queryset(data, self.request)
+            return paginator.get_paginated_response(
+                unit_results(request, data,
+                             serializers.UnitURLCache(request)))
+        if not resolution:
+            data = data.values_list(*serializers.FastDataSerializer.FIELDS)
         data = paginator.paginate_queryset(data, self.request)
 
         # TODO: should maybe limit visible fields here
-        serializer = serializers.DataSerializer(
+        serializer = serializer_cls(
             data,
             many=True,
             context={"request": self.request}
@@ -152,11 +330,105 @@ class DataViewSet(mixins.CreateModelMixin,
     queryset = Data.objects.all().order_by("-timestamp")
     serializer_class = serializers.DataSerializer
     filter_backends = (filters.DjangoFilterBackend,)
-    filter_class = DataFilter
     page_size = DATA_PAGE_SIZE
+    list_cache_key_func = DataListKeyConstructor()
+    renderer_classes = get_renderer_classes()
+
+    @property
+    def paginator_class(self):
+        # ?pagination=cursor or ?cursor=... selects keyset pagination
+        if pagination.KeysetPagination.is_requested(self.request):
+            return pagination.KeysetPagination
+        return pagination.CustomPagination
+
+    def get_resolution(self):
+        return get_resolution(self.request.query_params.get("resolution"))
+
+    def get_data_versions(self, request, kwargs):
+        """Versions of the filtered Units or the global version."""
+        unit_ids = request.GET.get("unit_ids", "").split(",")
+        unit_ids.append(request.GET.get("unit", ""))
+        try:
+            unit_ids = sorted(set(int(id) for id in unit_ids if id))
+        except ValueError:
+            unit_ids = []
+        if not unit_ids:
+            return get_global_version()
+        return get_unit_versions(unit_ids)
+
+    @property
+    def filter_class(self):
+        return get_data_filter_class(self.get_resolution())
+
+    def use_fast_serializer(self):
+        return (self.action == "list" and self.request.method == "GET" and
+                not self.get_resolution())
+
+    def use_series_format(self):
+        return (self.action == "list" and self.request.method == "GET" and
+                is_series_format(self.request))
 
     def get_queryset(self):
-        return get_data(self.request.user).order_by("-timestamp")
+        resolution = self.get_resolution()
+        qs = get_data(self.request.user, resolution=resolution)\
+            .order_by("-timestamp")
+        if self.use_series_format():
+            qs = columnar_values_list(qs, resolution)
+        elif self.use_fast_serializer():
+            qs = qs.values_list(*serializers.FastDataSerializer.FIELDS)
+        return qs
+
+    def get_serializer_class(self):
+        if self.request.method == "GET" and self.get_resolution():
+            return serializers.DataRollupSerializer
+        if self.use_fast_serializer():
+            return serializers.FastDataSerializer
+        return super(DataViewSet, self).get_serializer_class()
+
+    def perform_create(self, serializer):
+        data = serializer.save()
+        update_unit_last_values([data])
+
+    def list(self, request, *args, **kwargs):
+        """
+        With ?max_points=N&unit_ids=... return at most N points per unit
+        without pagination (see get_unit_points()).
+        """
+        try:
+            max_points, method = get_max_points(request)
+        except ValueError:
+            return Response({"error": MAX_POINTS_ERROR}, status=400)
+        if not max_points and self.use_series_format():
+            queryset = self.filter_queryset(self.get_queryset())
+            page = self.paginate_queryset(queryset)
+            return self.get_paginated_response(
+                unit_results(request, page,
+                             serializers.UnitURLCache(request)))
+        if not max_points:
+            return super(DataViewSet, self).list(request, *args, **kwargs)
+        filter = DataFilter(request.GET, queryset=Data.objects.none())
+        if not filter.form.is_valid():
+            return Response(
+                {"error": "error validating filter data"},
+                status=400
+            )
+        filter_data = filter.form.cleaned_data
+        unit_ids = list(filter_data["unit_ids"] or [])
+        if filter_data["unit"]:
+            unit_ids.append(filter_data["unit"].id)
+        if not unit_ids:
+            return Response(
+                {"error": "specify GET param `unit` or `unit_ids` with "
+                          "`max_points`"},
+                status=400
+            )
+        units = get_units(request.user).filter(id__in=unit_ids)
+        results = [get_unit_points(request, unit, filter_data, max_points,
+                                   method) for unit in units]
+        return Response(OrderedDict([
+            ("count", len(results)),
+            ("results", results),
+        ]))
 
 
 class LogViewSet(mixins.CreateModelMixin,
@@ -204,12 +476,18 @@ class Sendmail(mixins.CreateModelMixin,
 
 # TODO: cache this one manually
 @api_view(['GET'])
+@renderer_classes(get_renderer_classes())
 def export_data(request):
     def response_403():
         return Response({"error": "403 Forbidden"}, status=403)
 
+    resolution = get_resolution(request.GET.get("resolution"))
+    if resolution:
+        queryset = DataRollup.objects.all()
+    else:
+        queryset = Data.objects.all()
     # Reuse filter questionably
-    filter = DataFilter(request.GET, queryset=Data.objects.all())
+    filter = get_data_filter_class(resolution)(request.GET, queryset=queryset)
 
     if not request.user.is_authenticated():
         return Response(
@@ -230,56 +508,135 @@ def export_data(request):
             status=400
         )
 
-    results = []
+    stream_format = request.GET.get("stream")
+    if stream_format and stream_format not in export.STREAM_FORMATS:
+        return Response(
+            {"error": "`stream` must be one of: {}".format(
+                ", ".join(sorted(export.STREAM_FORMATS)))},
+            status=400
+        )
 
+    units = []
     if filter_data["unit_ids"]:
-        for unit in Unit.objects.filter(id__in=filter_data["unit_ids"]):
-            if not can_view(request.user, unit):
-                return response_403()
-
-        results.extend(
-            {
-                "id": d.id,
-                "value": d.value,
-                "timestamp": d.timestamp,
-                "formula": None,
-                "unit": reverse(
-                    "v1:unit-detail",
-                    args=[d.unit.id],
-                    request=request,
-                ),
-                "raw": True,
-            } for d in filter.qs.prefetch_related("unit")
-        )
+        units = list(Unit.objects.filter(id__in=filter_data["unit_ids"]))
 
+    formulas = []
     formula_ids = request.GET.get("formula_ids", "")
     if formula_ids:
-        formula_ids = map(int, formula_ids.split(","))
-        for id in formula_ids:
-            formula = Formula.objects.get(id=id)
-            if not can_view(request.user, formula):
-                return response_403()
-
-            records = get_formula_data(formula,
-                                       filter_data["start"],
-                                       filter_data["end"],
-                                       showinvalid=filter_data["show_invalid"])
-            formula_url = reverse(
-                "v1:formula-detail",
-                args=[formula.id],
-                request=request,
+        formula_ids = [int(id) for id in formula_ids.split(",")]
+        formulas = Formula.objects.in_bulk(formula_ids)
+        missing = set(formula_ids) - set(formulas)
+        if missing:
+            return Response(
+                {"error": "formulas {} not found".format(
+                    ", ".join(str(id) for id in sorted(missing)))},
+                status=404
             )
+        formulas = [formulas[id] for id in formula_ids]
+
+    # Permissions of all Units and Formulas are checked with a few queries
+    if not all(can_view_many(request.user, units + formulas)):
+        return response_403()
+
+    if stream_format:
+        # Constant memory export: series are read with iterators and
+        # merged by timestamp
+        series = [
+            export.iter_unit_series(request, filter.qs, unit.id,
+                                    resolution=resolution)
+            for unit in units
+        ]
+        series.extend(
+            export.iter_formula_series(
+                request, formula, filter_data["start"], filter_data["end"],
+                showinvalid=filter_data["show_invalid"],
+                resolution=resolution)
+            for formula in formulas
+        )
+        return export.streaming_export_response(stream_format, series,
+                                                resolution=resolution)
+
+    if is_series_format(request):
+        # One series per Unit and Formula in timestamp order
+        results = []
+        if units:
+            rows = columnar_values_list(
+                filter.qs.order_by("timestamp", "id"), resolution)
+            results.append(unit_results(request, rows,
+                                        serializers.UnitURLCache(request)))
+        for formula in formulas:
+            records = get_formula_data(
+                formula, filter_data["start"], filter_data["end"],
+                showinvalid=filter_data["show_invalid"],
+                resolution=resolution)
+            formula_url = reverse("v1:formula-detail", args=[formula.id],
+                                  request=request)
+            results.append(points_results(request, "formula", formula_url,
+                                          records))
+        results = concatenate_results(request, results)
+        return Response({
+            "results": results,
+            "count": count_points(results),
+            "next": None,
+            "previous": None,
+        })
+
+    results = []
+
+    if units:
+        unit_urls = serializers.UnitURLCache(request)
+        if resolution:
+            rows = filter.qs.values_list("value", "min", "max", "count",
+                                         "timestamp", "unit_id")
             results.extend(
                 {
                     "id": None,
-                    "value": r["value"],
-                    "timestamp": r["timestamp"],
-                    "unit": None,
-                    "formula": formula_url,
+                    "value": value,
+                    "min": min_,
+                    "max": max_,
+                    "count": count,
+                    "timestamp": timestamp,
+                    "formula": None,
+                    "unit": unit_urls.get(unit_id),
                     "raw": False,
-                } for r in records
+                } for value, min_, max_, count, timestamp, unit_id in rows
+            )
+        else:
+            rows = filter.qs.values_list("id", "value", "timestamp",
+                                         "unit_id")
+            results.extend(
+                {
+                    "id": id,
+                    "value": value,
+                    "timestamp": timestamp,
+                    "formula": None,
+                    "unit": unit_urls.get(unit_id),
+                    "raw": True,
+                } for id, value, timestamp, unit_id in rows
             )
 
+    for formula in formulas:
+        records = get_formula_data(formula,
+                                   filter_data["start"],
+                                   filter_data["end"],
+                                   showinvalid=filter_data["show_invalid"],
+                                   resolution=resolution)
+        formula_url = reverse(
+            "v1:formula-detail",
+            args=[formula.id],
+            request=request,
+        )
+        results.extend(
+            {
+                "id": None,
+                "value": r["value"],
+                "timestamp": r["timestamp"],
+                "unit": None,
+                "formula": formula_url,
+                "raw": False,
+            } for r in records
+        )
+
     results.sort(key=lambda r: r["timestamp"])
 
     return Response({
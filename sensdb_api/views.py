@@ -1,12 +1,19 @@
 import base64
+import csv
 import json
-import datetime
+import re
+from collections import OrderedDict
+import dateutil.parser
 from django.contrib.auth import authenticate
-from django.http import HttpResponse
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.utils import timezone
 from sensdb3.models import Datapost
-from sensdb_api.tasks import process_dataposts_task
+from sensdb_api.tasks import queue_dataposts
+
+IDCODE_RE = re.compile(r'^[a-zA-Z0-9\-_]+$')
 
 
 def _basicauth(request):
@@ -23,6 +30,24 @@ def _basicauth(request):
     return uname, passwd, user
 
 
+def queue_processing():
+    """
+    Queue processing after the transaction commits, so the worker never
+    sees an unsaved Datapost.
+    """
+    def queue():
+        try:
+            queue_dataposts()
+        except Exception as err:  # Broker is not listening: redis.exceptions.ConnectionError
+            # lograw.info(err)
+            print('Task error (broker not running?): {}'.format(err))
+    transaction.on_commit(queue)
+
+
+def get_response_text():
+    return '$OK,{}'.format(timezone.now().strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+
 @csrf_exempt
 def postdata_espeasy(request, version='0.0.0'):
     """
@@ -34,13 +59,14 @@ def postdata_espeasy(request, version='0.0.0'):
     # You might want to return HTTP 403 here, if user was not authenticated
     data = request.POST.get('data', '').strip()
     # lograw.info(data)
-    dp = None
+    # The response is known before saving, so the Datapost is inserted once
+    responsetext = get_response_text()
     if data:
         json_data = json.dumps(request.POST)
         idcode = request.POST.get('idcode', '').strip()
         # sensor = request.POST.get('sensor', '').strip()
         idcode = idcode.replace('\r', '').replace('\n', '')
-        dp = Datapost(data=json_data, idcode=idcode)
+        dp = Datapost(data=json_data, idcode=idcode, response=responsetext)
         if idcode == '':
             pass  # TODO: set dp.status = 'NO_IDCODE' ?
         dp.protocol = request.POST.get('protocol', 'ESPEASY').strip()
@@ -48,16 +74,87 @@ def postdata_espeasy(request, version='0.0.0'):
         dp.user = user
         dp.set_request_data(request)
         dp.save()
-        try:
-            process_dataposts_task.delay(dp.pk)
-        except Exception as err:  # Broker is not listening: redis.exceptions.ConnectionError
-            # lograw.info(err)
-            print('Task error (broker not running?): {}'.format(err))
-    utc_dt = timezone.now()
-    time_str = utc_dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-    responsetext = '$OK,{}'.format(time_str)
-    if dp:
-        dp.response = responsetext
-        dp.save()
+        queue_processing()
     response = HttpResponse(responsetext)
     return response
+
+
+def parse_bulk_readings(body, content_type):
+    """
+    Parse readings of the bulk endpoint and group them by idcode.
+
+    NDJSON (application/x-ndjson): one JSON object per line,
+        {"idcode": "logger1", "sensor": "bme280", "data": "Temperature=24.84,Humidity=52.05", "timestamp": "2017-07-11T08:49:38Z"}
+    CSV (text/csv): one reading per line,
+        logger1,bme280,2017-07-11T08:49:38Z,Temperature=24.84,Humidity=52.05
+
+    Timestamp is optional (empty in CSV), without it processing uses the
+    time of the upload.
+
+    Returns:
+        OrderedDict: idcode -> list of {"sensor", "data", "timestamp"} dicts
+
+    Raises:
+        ValueError: if a line is not valid
+    """
+    readings = OrderedDict()
+    is_csv = content_type.startswith('text/csv')
+    for lineno, line in enumerate(body.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            if is_csv:
+                row = next(csv.reader([line]))
+                idcode, sensor, timestamp = row[:3]
+                data = ','.join(row[3:])
+            else:
+                reading = json.loads(line)
+                idcode, sensor = reading['idcode'], reading['sensor']
+                data = reading['data']
+                timestamp = reading.get('timestamp') or ''
+            idcode, sensor = idcode.strip(), sensor.strip()
+            if (IDCODE_RE.match(idcode) is None or not sensor or
+                    '=' not in data):
+                raise ValueError('invalid idcode, sensor or data')
+            # Values are parsed like processing does, see
+            # add_espeasy_values()
+            for keyval in data.split(','):
+                if '=' in keyval:
+                    key, val = keyval.split('=')
+                    float(val)
+            if timestamp:
+                dateutil.parser.parse(timestamp)
+        except (KeyError, TypeError, ValueError, OverflowError) as err:
+            raise ValueError('Line {}: {}'.format(lineno, err))
+        readings.setdefault(idcode, []).append(OrderedDict([
+            ('sensor', sensor), ('data', data.strip()),
+            ('timestamp', timestamp)]))
+    return readings
+
+
+@csrf_exempt
+@require_POST
+def postdata_espeasy_bulk(request, version='0.0.0'):
+    """
+    POST many ESPEASY readings of many Dataloggers in one request, e.g. from
+    a gateway (see parse_bulk_readings() for the formats). Readings are
+    stored as one Datapost per Datalogger and processed by one task.
+    echo 'logger1,bme280,,Temperature=24.84,Humidity=52.05' |
+       http -v --auth user:pass POST http://127.0.0.1:8000/api/espeasy/bulk Content-Type:text/csv
+    """
+    uname, passwd, user = _basicauth(request)
+    try:
+        readings = parse_bulk_readings(request.body.decode('utf-8'),
+                                       request.content_type or '')
+    except (UnicodeDecodeError, ValueError) as err:
+        return HttpResponseBadRequest('$ERROR,{}'.format(err))
+    responsetext = get_response_text()
+    for idcode, lines in readings.items():
+        dp = Datapost(idcode=idcode, protocol='ESPEASY_BULK',
+                      version=version, user=user, response=responsetext,
+                      data='\n'.join(json.dumps(line) for line in lines))
+        dp.set_request_data(request)
+        dp.save()
+    if readings:
+        queue_processing()
+    return HttpResponse(responsetext)